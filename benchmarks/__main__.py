@@ -0,0 +1,123 @@
+"""Benchmarks of the processing queue, REST API, ingestion and processing loop hot paths.
+
+Run from the repository root:
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --benchmarks 'queue.*' --compare results.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import socket
+import sqlite3
+import subprocess
+import sys
+
+from benchmarks import fixtures
+from benchmarks import logger
+from benchmarks import suites
+from lib.utils import FORMATTER
+
+RESULTS_VERSION = 1
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Handbreak auto processing benchmarks',
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('-b', '--benchmarks', help='Run only the benchmarks matching these patterns, e.g. queue.* or '
+                                               'rest.queue_stats[10000]\n'
+                                               '(default: all)', nargs='+')
+parser.add_argument('--rows', help='Media files of the synthetic databases\n'
+                                   '(default: 10000 100000 1000000)', nargs='+', type=int,
+                    default=[10000, 100000, 1000000])
+parser.add_argument('--tree-files', help='Media files of the directory tree scanned and replayed as an event storm\n'
+                                         '(default: 2000)', type=int, default=2000)
+parser.add_argument('--e2e-files', help='Media files encoded by the end to end run\n'
+                                        '(default: 20)', type=int, default=20)
+parser.add_argument('--e2e-slots', help='Encode slots of the end to end run\n'
+                                        '(default: 2)', type=int, default=2)
+parser.add_argument('--e2e-duration', help='Seconds the fake HandBrake CLI takes per media file\n'
+                                           '(default: 2)', type=float, default=2)
+parser.add_argument('--e2e-file-size', help='Size of the media files of the end to end run in KB\n'
+                                            '(default: 1024)', type=int, default=1024)
+parser.add_argument('--repeat', help='Max runs of every benchmark\n'
+                                     '(default: 200)', type=int, default=200)
+parser.add_argument('--budget', help='Seconds after which a benchmark stops repeating\n'
+                                     '(default: 10)', type=float, default=10)
+parser.add_argument('--seed', help='Seed of the synthetic data\n'
+                                   '(default: 0)', type=int, default=0)
+parser.add_argument('-d', '--data-directory', help='Directory the synthetic databases are kept in between runs\n'
+                                                   '(default: <temp directory>/handbreak-auto-processing-benchmarks)',
+                    default=fixtures.DATA_DIRECTORY)
+parser.add_argument('-o', '--output', help='File the results are written to(JSON)')
+parser.add_argument('-c', '--compare', help='Results file to compare with, exits with 1 on regressions')
+parser.add_argument('-t', '--threshold', help='Median slow down reported as a regression, as a fraction\n'
+                                              '(default: 0.2)', type=float, default=0.2)
+parser.add_argument("-v", "--verbose", action='store_true', help="Log the processing queue activity too")
+
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlite': sqlite3.sqlite_version,
+            'hostname': socket.gethostname(),
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+            'commit': commit}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        ratio = results[name]['median'] / max(baseline[name]['median'], 1e-9)
+        if ratio > 1 + threshold:
+            regressions.append(name)
+        logger.info("[{}] [{:.6f}s] -> [{:.6f}s] [{:+.1%}]{}".format(name, baseline[name]['median'],
+                                                                    results[name]['median'], ratio - 1,
+                                                                    ' REGRESSION' if ratio > 1 + threshold else ''))
+    for name in sorted(set(baseline) - set(results)):
+        logger.debug("[{}] not run".format(name))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(FORMATTER)
+    logging.getLogger().addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logging.getLogger('lib').setLevel(logging.INFO if args.verbose else logging.WARN)
+
+    context = suites.BenchmarkContext(args.data_directory, args.benchmarks, args.repeat, args.budget, args.seed)
+    started = datetime.datetime.now()
+    for rows in args.rows:
+        suites.queue_suite(context, rows)
+    suites.ingest_suite(context, args.tree_files)
+    suites.end_to_end_suite(context, args.e2e_files, args.e2e_slots, args.e2e_duration, args.e2e_file_size * 1024)
+
+    results = {'version': RESULTS_VERSION,
+               'date': started.isoformat(),
+               'environment': get_environment(),
+               'parameters': {key: value for key, value in vars(args).items()
+                              if key not in ('output', 'compare', 'threshold', 'verbose')},
+               'results': context.results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        logger.info("Results written to [{}]".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(context.results, baseline['results'], args.threshold)
+        if regressions:
+            logger.warn("[{}] benchmarks slower than [{}] by more than [{:.0%}]: {}".format(
+                len(regressions), args.compare, args.threshold, regressions))
+            sys.exit(1)
+
+
+main()
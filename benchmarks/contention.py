@@ -0,0 +1,325 @@
+"""Load test of several nodes sharing one processing queue.
+
+Local processes, each standing for a node, run the real processing loop against the same queue directory, encoding
+with the fake HandBrake CLI. Run from the repository root:
+
+    python -m benchmarks.contention --nodes 4 --slots 2 --files 200 --duration 2 --distribution lognormal
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import fixtures
+from benchmarks import logger
+from benchmarks.suites import FAKE_HANDBRAKE, summarize, wait_until
+from lib.connection_manager import ConnectionManager
+from lib.media_file import MediaFile
+from lib.media_file_state import MediaFileState
+from lib.nodes.node_hardware import get_hardware_info
+from lib.utils import FORMATTER
+from lib import metrics
+
+CLAIM_FUNCTION = 'lib.media_file_processing.MediaProcessingThread.__get_media_file'
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks.contention',
+                                 description='Handbreak auto processing multi-node contention simulator',
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('-n', '--nodes', help='Nodes sharing the processing queue, one process each\n'
+                                          '(default: 4)', type=int, default=4)
+parser.add_argument('-s', '--slots', help='Encode slots of every node\n'
+                                          '(default: 1)', type=int, default=1)
+parser.add_argument('-f', '--files', help='Media files in the processing queue\n'
+                                          '(default: 100)', type=int, default=100)
+parser.add_argument('--file-size', help='Size of the media files in KB\n'
+                                        '(default: 64)', type=int, default=64)
+parser.add_argument('--duration', help='Seconds the fake HandBrake CLI takes per media file, the mean of exponential '
+                                       'durations and the median of lognormal ones\n'
+                                       '(default: 2)', type=float, default=2)
+parser.add_argument('--jitter', help='Variation of uniform durations as a fraction of the duration, the sigma of '
+                                     'lognormal ones\n'
+                                     '(default: 0.2)', type=float, default=0.2)
+parser.add_argument('--distribution', help='Distribution of the encode durations\n'
+                                           '(default: uniform)', default='uniform',
+                    choices=['uniform', 'exponential', 'lognormal'])
+parser.add_argument('--fail-rate', help='Fraction of encodes failing\n'
+                                        '(default: 0)', type=float, default=0)
+parser.add_argument('--heartbeat-interval', help='Interval between node heartbeats(seconds)\n'
+                                                 '(default: 30)', type=float, default=30)
+parser.add_argument('--node-timeout', help='Mark a node offline after it has not sent a heartbeat for that '
+                                           'long(seconds)\n'
+                                           '(default: 300)', type=float, default=300)
+parser.add_argument('--timeout', help='Give up after that long(seconds)\n'
+                                      '(default: 3 times the ideal run time plus a minute)', type=float)
+parser.add_argument('-d', '--directory', help='Directory of the shared queue, media files and node logs, kept after '
+                                              'the run\n'
+                                              '(default: a new temp directory, removed after the run)')
+parser.add_argument('-o', '--output', help='File the results are written to(JSON)')
+parser.add_argument('--worker', help=argparse.SUPPRESS, action='store_true')
+parser.add_argument('--node-name', help=argparse.SUPPRESS)
+
+
+def get_database_file(directory):
+    # same layout as the main script, so a real node can join the run
+    data_store_directory = os.path.join(directory, 'queue', '.handbreak-auto-processing')
+    if not os.path.exists(data_store_directory):
+        os.makedirs(data_store_directory)
+    return os.path.join(data_store_directory, 'data.db')
+
+
+def get_command(args, journal_file):
+    return '"{}" "{}" --duration {} --jitter {} --distribution {} --fail-rate {} --journal "{}"'.format(
+        sys.executable, FAKE_HANDBRAKE, args.duration, args.jitter, args.distribution, args.fail_rate, journal_file)
+
+
+def run_worker(args):
+    """One node: the processing loop and node liveness of the main script, under its own node name."""
+    # every node of the run shares this machine, the node name stands for its hostname
+    socket.gethostname = lambda: args.node_name
+    os.environ['BENCHMARK_NODE'] = args.node_name
+
+    from lib.media_processing import MediaProcessing
+    from lib.nodes.node_liveness import NodeLivenessThread
+
+    journal_file = os.path.join(args.directory, 'encodes.log')
+    database, mfq, nodes = fixtures.open_database(get_database_file(args.directory), get_command(args, journal_file))
+    profiler = ConnectionManager.enable_profiling()
+    fixtures.register_node(nodes, fixtures.DATA_DIRECTORY)
+    media_processing = MediaProcessing(mfq, 3600, nodes, False, encode_slots=args.slots)
+    node_liveness = NodeLivenessThread(nodes, mfq, args.node_name, args.heartbeat_interval, args.node_timeout,
+                                       name=NodeLivenessThread.__module__)
+    started = time.time()
+
+    def clean_handler(signum, frame):
+        media_processing.stop()
+        node_liveness.stop()
+        report = {'node': args.node_name,
+                  'seconds': time.time() - started,
+                  'transactions': profiler.get_stats(),
+                  'claim_races': metrics.claim_races.values.get((), 0),
+                  'lock_wait': metrics.db_transaction_wait_seconds.values.get(()),
+                  'lock_hold': metrics.db_transaction_hold_seconds.values.get(())}
+        with open(os.path.join(args.directory, '{}.json'.format(args.node_name)), 'w') as f:
+            json.dump(report, f)
+        fixtures.close_database(database)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, clean_handler)
+    node_liveness.start()
+    media_processing.start()
+
+
+@ConnectionManager.connection
+def count_finished():
+    return MediaFile.select().where(MediaFile.status << [MediaFileState.PROCESSED, MediaFileState.FAILED]).count()
+
+
+def histogram_percentile(counts, fraction, max_value):
+    """Upper bound of the bucket the `fraction` percentile falls in, capped by the largest value seen."""
+    total = sum(counts)
+    cumulative = 0
+    for bound, count in zip(metrics.db_transaction_wait_seconds.buckets + (float('inf'),), counts):
+        cumulative += count
+        if total and cumulative >= total * fraction:
+            return min(bound, max_value)
+    return None
+
+
+def read_journal(journal_file):
+    encodes = []
+    if os.path.exists(journal_file):
+        with open(journal_file) as f:
+            for line in f:
+                node, file_path, started, finished, exit_code = line.rstrip('\n').split('\t')
+                encodes.append({'node': node, 'file_path': file_path, 'started': float(started),
+                                'finished': float(finished), 'exit_code': int(exit_code)})
+    return encodes
+
+
+def analyze(args, reports, encodes, started, finished):
+    buckets = len(metrics.db_transaction_wait_seconds.buckets) + 1
+    wait_counts, wait_sum = [0] * buckets, 0
+    hold_counts, hold_sum = [0] * buckets, 0
+    max_wait = max_hold = 0
+    claims = claim_failures = claim_races = 0
+    makespan = finished - started
+    nodes = {}
+    for report in reports:
+        if report['lock_wait']:
+            wait_counts = [a + b for a, b in zip(wait_counts, report['lock_wait'][0])]
+            wait_sum += report['lock_wait'][1]
+        if report['lock_hold']:
+            hold_counts = [a + b for a, b in zip(hold_counts, report['lock_hold'][0])]
+            hold_sum += report['lock_hold'][1]
+        for stats in report['transactions'].values():
+            max_wait = max(max_wait, stats['max_wait_seconds'])
+            max_hold = max(max_hold, stats['max_hold_seconds'])
+        claim_stats = report['transactions'].get(CLAIM_FUNCTION, {'calls': 0, 'transactions': 0})
+        # a claim without a transaction is one that failed to get the database lock
+        claims += claim_stats['transactions']
+        claim_failures += claim_stats['calls'] - claim_stats['transactions']
+        claim_races += report['claim_races']
+        # busy time from the encodes journal, encodes shorter than any sampling interval included
+        node_encodes = [encode for encode in encodes if encode['node'] == report['node']]
+        busy = sum(max(min(encode['finished'], finished) - max(encode['started'], started), 0)
+                   for encode in node_encodes)
+        slot_seconds = args.slots * makespan
+        nodes[report['node']] = {'encodes': len(node_encodes),
+                                 'claims': claim_stats['transactions'],
+                                 'claim_failures': claim_stats['calls'] - claim_stats['transactions'],
+                                 'claim_races': report['claim_races'],
+                                 'busy_slot_seconds': busy,
+                                 'idle_slot_seconds': slot_seconds - busy,
+                                 'idle_fraction': 1 - busy / slot_seconds if slot_seconds else None}
+
+    encodes_by_file = {}
+    for encode in encodes:
+        encodes_by_file.setdefault(encode['file_path'], []).append(encode)
+    duplicates = {file_path: sorted(encode['node'] for encode in file_encodes)
+                  for file_path, file_encodes in encodes_by_file.items()
+                  if sum(1 for encode in file_encodes if encode['exit_code'] == 0) > 1}
+    # encodes of the same media file overlapping in time ran at the same time on two slots
+    concurrent = 0
+    for file_encodes in encodes_by_file.values():
+        file_encodes.sort(key=lambda encode: encode['started'])
+        concurrent += sum(1 for previous, encode in zip(file_encodes, file_encodes[1:])
+                          if encode['started'] < previous['finished'])
+
+    wait_count = sum(wait_counts)
+    hold_count = sum(hold_counts)
+    durations = sorted(encode['finished'] - encode['started'] for encode in encodes)
+    return {'makespan': makespan,
+            'files_per_second': args.files / makespan,
+            'ideal_makespan': sum(durations) / (args.nodes * args.slots) if durations else None,
+            'encodes': len(encodes),
+            'encode_seconds': summarize(durations) if durations else None,
+            'claims': claims,
+            'claim_failures': claim_failures,
+            'claim_races': claim_races,
+            'duplicate_media_files': len(duplicates),
+            'duplicate_encodes': sum(len(file_nodes) - 1 for file_nodes in duplicates.values()),
+            'concurrent_encodes': concurrent,
+            'duplicates': duplicates,
+            'lock_wait': {'transactions': wait_count,
+                          'mean': wait_sum / wait_count if wait_count else None,
+                          'p50': histogram_percentile(wait_counts, 0.5, max_wait),
+                          'p95': histogram_percentile(wait_counts, 0.95, max_wait),
+                          'p99': histogram_percentile(wait_counts, 0.99, max_wait),
+                          'max': max_wait},
+            'lock_hold': {'transactions': hold_count,
+                          'mean': hold_sum / hold_count if hold_count else None,
+                          'p50': histogram_percentile(hold_counts, 0.5, max_hold),
+                          'p95': histogram_percentile(hold_counts, 0.95, max_hold),
+                          'p99': histogram_percentile(hold_counts, 0.99, max_hold),
+                          'max': max_hold},
+            'nodes': nodes}
+
+
+def run(args):
+    directory = args.directory or tempfile.mkdtemp(prefix='handbreak-contention-')
+    journal_file = os.path.join(directory, 'encodes.log')
+    for file_name in os.listdir(directory) if os.path.exists(directory) else []:
+        if file_name.endswith('.json') or file_name.endswith('.log'):
+            os.remove(os.path.join(directory, file_name))
+    database_file = get_database_file(directory)
+    if os.path.exists(database_file):
+        os.remove(database_file)
+
+    logger.info("Adding [{}] media files to the processing queue in [{}]".format(args.files, directory))
+    file_paths = fixtures.build_tree(os.path.join(directory, 'media'), args.files, args.file_size * 1024)
+    database, mfq, _ = fixtures.open_database(database_file, get_command(args, journal_file))
+    mfq.add_all(file_paths)
+    # the nodes would all detect the hardware of this machine at once otherwise
+    if not os.path.exists(fixtures.DATA_DIRECTORY):
+        os.makedirs(fixtures.DATA_DIRECTORY)
+    get_hardware_info(fixtures.DATA_DIRECTORY)
+
+    workers = []
+    started = time.time()
+    try:
+        for i in range(args.nodes):
+            node_name = 'node-{}'.format(i)
+            command = [sys.executable, '-m', 'benchmarks.contention', '--worker', '--node-name', node_name,
+                       '--directory', directory] + sys.argv[1:]
+            with open(os.path.join(directory, '{}.log'.format(node_name)), 'w') as log_file:
+                workers.append(subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT))
+        logger.info("[{}] nodes with [{}] encode slots each started".format(args.nodes, args.slots))
+
+        ideal = args.files * args.duration / (args.nodes * args.slots)
+        done = wait_until(lambda: count_finished() >= args.files, args.timeout or ideal * 3 + 60, 0.2)
+        finished = time.time()
+        if not done:
+            logger.warn("[{}] of [{}] media files processed before the timeout".format(count_finished(),
+                                                                                     args.files))
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            worker.wait()
+        fixtures.close_database(database)
+
+    reports = []
+    for i in range(args.nodes):
+        report_file = os.path.join(directory, 'node-{}.json'.format(i))
+        if os.path.exists(report_file):
+            with open(report_file) as f:
+                reports.append(json.load(f))
+        else:
+            logger.warn("Node [node-{}] left no report, see [{}]".format(i, os.path.join(directory,
+                                                                                         'node-{}.log'.format(i))))
+    results = analyze(args, reports, read_journal(journal_file), started, finished)
+    results['finished'] = done
+    if not args.directory:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(FORMATTER)
+    logging.getLogger().addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logging.getLogger('lib').setLevel(logging.INFO if args.worker else logging.WARN)
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    started = datetime.datetime.now()
+    results = run(args)
+    logger.info("[{}] media files in [{:.1f}s] ([{:.1f}s] ideal), [{:.3f}] files/s".format(
+        args.files, results['makespan'], results['ideal_makespan'] or 0, results['files_per_second']))
+    logger.info("Claim transactions [{}], failed to lock [{}], lost to another node [{}]".format(
+        results['claims'], results['claim_failures'], results['claim_races']))
+    logger.info("Duplicate encodes [{}] of [{}] media files, [{}] concurrent".format(
+        results['duplicate_encodes'], results['duplicate_media_files'], results['concurrent_encodes']))
+    for kind in ('lock_wait', 'lock_hold'):
+        stats = results[kind]
+        logger.info("[{}] p50 [{:.3f}s] p95 [{:.3f}s] p99 [{:.3f}s] max [{:.3f}s] over [{}] transactions".format(
+            kind, stats['p50'] or 0, stats['p95'] or 0, stats['p99'] or 0, stats['max'], stats['transactions']))
+    for node, stats in sorted(results['nodes'].items()):
+        logger.info("[{}] encodes [{}] claims [{}] failed to lock [{}] lost [{}] idle [{:.0%}]".format(
+            node, stats['encodes'], stats['claims'], stats['claim_failures'], stats['claim_races'],
+            stats['idle_fraction'] or 0))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': started.isoformat(),
+                       'parameters': {key: value for key, value in vars(args).items()
+                                      if key not in ('output', 'worker', 'node_name')},
+                       'results': results}, f, indent=2, sort_keys=True)
+        logger.info("Results written to [{}]".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
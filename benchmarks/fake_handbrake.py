@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Stand-in for HandBrakeCLI: reports progress the way it does, rewriting the line with a carriage return, and
+copies the input file to the output file."""
+import argparse
+import os
+import random
+import shutil
+import signal
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Fake HandBrakeCLI for benchmarks')
+parser.add_argument('-i', '--input', help='input file (default: $INPUT_FILE)', default=os.environ.get('INPUT_FILE'))
+parser.add_argument('-o', '--output', help='output file (default: $OUTPUT_FILE)',
+                    default=os.environ.get('OUTPUT_FILE'))
+parser.add_argument('--duration', help='encode duration in seconds, the mean of exponential durations and the '
+                                         'median of lognormal ones', type=float, default=5)
+parser.add_argument('--jitter', help='random variation of uniform durations as a fraction of the duration, the sigma '
+                                     'of lognormal ones', type=float, default=0)
+parser.add_argument('--distribution', help='distribution of the encode durations', default='uniform',
+                    choices=['uniform', 'exponential', 'lognormal'])
+parser.add_argument('--journal', help='file a line is appended to for every encode: node($BENCHMARK_NODE), input '
+                                      'file, start and end time and exit code')
+parser.add_argument('--fps', help='average frames per second reported', type=float, default=120)
+parser.add_argument('--updates', help='progress updates per second', type=float, default=4)
+parser.add_argument('--fail-rate', help='fraction of encodes exiting with an error', type=float, default=0)
+args = parser.parse_args()
+started = time.time()
+
+
+def interrupted(signum, frame):
+    write_journal(1)
+    sys.stdout.write('\nHandBrake has exited.\n')
+    sys.stdout.flush()
+    sys.exit(1)
+
+
+signal.signal(signal.SIGINT, interrupted)
+signal.signal(signal.SIGTERM, interrupted)
+
+if args.distribution == 'exponential':
+    duration = random.expovariate(1 / args.duration) if args.duration else 0
+elif args.distribution == 'lognormal':
+    duration = args.duration * random.lognormvariate(0, args.jitter)
+else:
+    duration = max(args.duration * (1 + random.uniform(-args.jitter, args.jitter)), 0)
+
+
+def write_journal(exit_code):
+    if args.journal:
+        line = '{}\t{}\t{:.6f}\t{:.6f}\t{}\n'.format(os.environ.get('BENCHMARK_NODE', ''), args.input, started,
+                                                   time.time(), exit_code)
+        # a single write of an O_APPEND file isn't interleaved with the other processes ones
+        fd = os.open(args.journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+sys.stdout.write('[{}] Starting work at: {}\n'.format(time.strftime('%H:%M:%S'), time.strftime('%c')))
+sys.stdout.write('[{}] 1 job(s) to process\n'.format(time.strftime('%H:%M:%S')))
+sys.stdout.flush()
+
+elapsed = 0
+while elapsed < duration:
+    time.sleep(min(1 / args.updates, duration - elapsed))
+    elapsed = time.time() - started
+    progress = min(elapsed / duration, 1) * 100 if duration else 100
+    fps = args.fps * random.uniform(0.9, 1.1)
+    remaining = max(duration - elapsed, 0)
+    sys.stdout.write('Encoding: task 1 of 1, {:.2f} % ({:.2f} fps, avg {:.2f} fps, ETA {:02d}h{:02d}m{:02d}s)\r'.format(
+        progress, fps, args.fps, int(remaining // 3600), int(remaining % 3600 // 60), int(remaining % 60)))
+    sys.stdout.flush()
+
+if random.random() < args.fail_rate:
+    write_journal(3)
+    sys.stderr.write('\nEncode failed (error 3).\n')
+    sys.exit(3)
+
+shutil.copyfile(args.input, args.output)
+write_journal(0)
+sys.stdout.write('\nEncode done!\n')
+sys.stdout.write('HandBrake has exited.\n')
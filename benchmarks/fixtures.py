@@ -0,0 +1,195 @@
+import datetime
+import os
+import random
+import shutil
+import socket
+import tempfile
+import uuid
+
+from peewee import SqliteDatabase
+from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileMovedEvent, FileDeletedEvent
+
+from lib.connection_manager import ConnectionManager
+from lib.event_log import EventLog
+from lib.media_file import MediaFile
+from lib.media_file_state import MediaFileState
+from lib.nodes.node_hardware import get_hardware_info
+from lib.nodes.node_state import NodeState
+from lib.nodes.nodes_inventory import NodeInventory
+from lib.observers import FileClosedEvent
+from lib.persistent_media_files_queue import MediaFilesQueue
+from benchmarks import logger
+
+# share of every status in a long running queue, most media files are done
+STATUS_WEIGHTS = ((MediaFileState.PROCESSED, 0.88),
+                  (MediaFileState.WAITING, 0.06),
+                  (MediaFileState.FAILED, 0.03),
+                  (MediaFileState.SKIPPED, 0.02),
+                  (MediaFileState.ENCODED, 0.01))
+HISTORY_DAYS = 180
+INSERT_CHUNK = 10000
+DATA_DIRECTORY = os.path.join(tempfile.gettempdir(), 'handbreak-auto-processing-benchmarks')
+
+
+def open_database(database_file, command='true'):
+    """Registers `database_file` as the database of every queue, node and event table, like the main script."""
+    database = SqliteDatabase(database_file)
+    ConnectionManager.register_database(database)
+    event_log = EventLog()
+    mfq = MediaFilesQueue('mp4', command, None, event_log)
+    nodes = NodeInventory(event_log=event_log)
+    return database, mfq, nodes
+
+
+def close_database(database):
+    if not database.is_closed():
+        database.close()
+
+
+def copy_database(source_file, database_file):
+    for suffix in ('-wal', '-shm', '-journal'):
+        if os.path.exists(database_file + suffix):
+            os.remove(database_file + suffix)
+    shutil.copyfile(source_file, database_file)
+    return database_file
+
+
+def get_database(data_directory, rows, seed):
+    """Synthetic database of `rows` media files, built once and reused by the next runs."""
+    database_file = os.path.join(data_directory, 'data-{}-{}.db'.format(rows, seed))
+    if not os.path.exists(database_file):
+        logger.info("Building a synthetic database of [{}] media files".format(rows))
+        building_file = database_file + '.building'
+        if os.path.exists(building_file):
+            os.remove(building_file)
+        database, _, _ = open_database(building_file)
+        try:
+            insert_media_files(database, rows, random.Random(seed))
+        finally:
+            close_database(database)
+        os.rename(building_file, database_file)
+    return database_file
+
+
+def insert_media_files(database, rows, rnd):
+    now = datetime.datetime.now()
+    statuses = [status for status, _ in STATUS_WEIGHTS]
+    weights = [weight for _, weight in STATUS_WEIGHTS]
+    fields = MediaFile._meta.sorted_fields
+    sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(MediaFile._meta.table_name,
+                                                      ', '.join('"{}"'.format(field.column_name) for field in fields),
+                                                      ', '.join('?' * len(fields)))
+    hostnames = [socket.gethostname()] + ['node-{}'.format(i) for i in range(1, 8)]
+    database.connect(reuse_if_open=True)
+    with database.atomic():
+        for start in range(0, rows, INSERT_CHUNK):
+            values = []
+            for i in range(start, min(start + INSERT_CHUNK, rows)):
+                media_file = new_media_file(i, now, weighted_choice(rnd, statuses, weights), rnd, hostnames)
+                values.append([field.db_value(media_file.get(field.name)) for field in fields])
+            database.connection().executemany(sql, values)
+
+
+def weighted_choice(rnd, items, weights):
+    value = rnd.random() * sum(weights)
+    for item, weight in zip(items, weights):
+        value -= weight
+        if value < 0:
+            return item
+    return items[-1]
+
+
+def new_media_file(i, now, status, rnd, hostnames):
+    file_path = '/media/library/show-{:04d}/season-{:02d}/episode-{:07d}.mp4'.format(i % 5000, i % 12, i)
+    date_added = now - datetime.timedelta(seconds=rnd.randint(0, HISTORY_DAYS * 24 * 60 * 60))
+    file_size = int(rnd.lognormvariate(20.5, 0.8))
+    media_file = {'id': uuid.UUID(int=rnd.getrandbits(128), version=4),
+                  'file_path': file_path,
+                  'transcoded_file_path': file_path[:-4] + '_transcoded.mp4',
+                  'log_file_path': file_path[:-4] + '_transcoding.log',
+                  'status': status,
+                  'file_size': file_size,
+                  'date_added': date_added,
+                  'last_modified': date_added,
+                  'fingerprint': '{:032x}'.format(rnd.getrandbits(128)),
+                  'video_codec': rnd.choice(('h264', 'hevc', 'mpeg2video')),
+                  'width': 1920,
+                  'height': 1080,
+                  'duration': rnd.uniform(60, 7200)}
+    if status in (MediaFileState.PROCESSED, MediaFileState.FAILED, MediaFileState.ENCODED):
+        # encodes run at a few MB per second, and are done by now
+        encode_time = datetime.timedelta(seconds=file_size / rnd.uniform(2e6, 8e6))
+        date_started = date_added + datetime.timedelta(seconds=rnd.randint(0, 3 * 24 * 60 * 60))
+        date_started = max(min(date_started, now - encode_time), date_added)
+        date_finished = min(date_started + encode_time, now)
+        media_file.update(date_started=date_started,
+                          processing_node=rnd.choice(hostnames),
+                          last_modified=date_finished)
+        if status != MediaFileState.FAILED:
+            media_file['transcoded_file_size'] = int(file_size * rnd.uniform(0.2, 0.6))
+            media_file['date_encoded'] = date_finished
+        if status != MediaFileState.ENCODED:
+            media_file['date_finished'] = date_finished
+    elif status == MediaFileState.SKIPPED:
+        media_file['skip_reason'] = 'video codec [hevc] matches skip rule'
+    return media_file
+
+
+def build_tree(directory, files, file_size=4096, seed=0):
+    """Directory tree of `files` small media files, a few hundred per directory, like a media library."""
+    rnd = random.Random(seed)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    file_paths = []
+    for i in range(files):
+        sub_directory = os.path.join(directory, 'show-{:03d}'.format(i // 200), 'season-{:02d}'.format(i // 20 % 10))
+        if not os.path.exists(sub_directory):
+            os.makedirs(sub_directory)
+        file_path = os.path.join(sub_directory, u'episode-{:06d}.mp4'.format(i))
+        with open(file_path, 'wb') as f:
+            f.write(bytearray(rnd.getrandbits(8) for _ in range(file_size)))
+        file_paths.append(file_path)
+    return file_paths
+
+
+def event_storm(file_paths, modifications=5, move_ratio=0.1, delete_ratio=0.05, seed=0):
+    """File system events of copying `file_paths` into a watched directory while some of them are renamed and
+    deleted, as (action, event) tuples; actions are applied to the files before their event is replayed.
+
+    Returns the events and the file paths expected in the processing queue afterwards.
+    """
+    rnd = random.Random(seed)
+    events = []
+    expected = set()
+    for file_path in file_paths:
+        events.append((None, FileCreatedEvent(file_path)))
+        for _ in range(modifications):
+            events.append((None, FileModifiedEvent(file_path)))
+        events.append((None, FileClosedEvent(file_path)))
+        draw = rnd.random()
+        if draw < delete_ratio:
+            events.append((('delete', file_path), FileDeletedEvent(file_path)))
+        elif draw < delete_ratio + move_ratio:
+            dest_path = file_path[:-4] + '.renamed.mp4'
+            events.append((('move', file_path, dest_path), FileMovedEvent(file_path, dest_path)))
+            expected.add(dest_path)
+        else:
+            expected.add(file_path)
+    return events, expected
+
+
+def apply_action(action):
+    if action is None:
+        return
+    if action[0] == 'delete':
+        os.remove(action[1])
+    elif action[0] == 'move':
+        os.rename(action[1], action[2])
+
+
+def register_node(nodes, data_directory):
+    nodes.hardware_info = get_hardware_info(data_directory)
+    if socket.gethostname() in nodes:
+        nodes[socket.gethostname()] = NodeState.ONLINE
+    else:
+        nodes[uuid.uuid4(), socket.gethostname()] = NodeState.ONLINE
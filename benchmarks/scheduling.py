@@ -0,0 +1,458 @@
+"""Offline simulation of scheduling policies over the history of a processing queue.
+
+Media files are replayed as they arrived, with the encode time they took and the throughput, encode slots and silent
+periods of the nodes that processed them, through each policy in turn. Run from the repository root:
+
+    python -m benchmarks.scheduling --queue-directory ~ --policies current fifo smallest largest size_aware
+"""
+import argparse
+import datetime
+import heapq
+import importlib
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+import dateutil.parser
+from peewee import SQL
+
+from benchmarks import fixtures
+from benchmarks import logger
+from benchmarks.suites import percentile
+from lib.connection_manager import ConnectionManager
+from lib.media_file import MediaFile
+from lib.media_file_state import MediaFileState
+from lib.media_processing import MediaProcessing
+from lib.nodes.node import Node
+from lib.tracing import to_timestamp
+from lib.utils import FORMATTER
+
+DAY = 24 * 60 * 60
+
+
+class Job(object):
+    __slots__ = ('id', 'arrival', 'position', 'size', 'profile', 'work', 'node', 'started', 'finished')
+
+    def __init__(self, id, arrival, size, profile, work, position=None):
+        self.id = id
+        self.arrival = arrival
+        # rowid of the media file, the processing queue is peeked in table scan order
+        self.position = arrival if position is None else position
+        self.size = size
+        self.profile = profile
+        # encode seconds on a node of rate 1
+        self.work = work
+        self.node = None
+        self.started = None
+        self.finished = None
+
+
+class SimulatedNode(object):
+
+    def __init__(self, name, rate, slots, silent_periods=None):
+        self.name = name
+        self.rate = rate
+        self.slots = slots
+        self.silent_periods = silent_periods or []
+        self.windows = [parse_silent_period(period) for period in self.silent_periods]
+        if sum((end - start) % DAY for start, end in self.windows) >= DAY:
+            raise Exception('node [{}] is silent all day long'.format(name))
+        # bytes per second of the media files it processed, outside of silent periods
+        self.speeds = []
+
+    def next_silent_interval(self, t):
+        """Current or next silent interval ending after `t`, as (start, end) timestamps."""
+        midnight = to_timestamp(datetime.datetime.combine(datetime.date.fromtimestamp(t), datetime.time()))
+        result = None
+        for day in (-1, 0, 1):
+            for start, end in self.windows:
+                interval_start = midnight + day * DAY + start
+                interval_end = interval_start + (end - start) % DAY
+                if interval_end > t and (result is None or interval_start < result[0]):
+                    result = (interval_start, interval_end)
+        return result
+
+    def finish_time(self, start, seconds):
+        """When an encode of `seconds` started at `start` ends, encodes being suspended during silent periods."""
+        t, remaining = start, seconds
+        while remaining > 0:
+            interval = self.next_silent_interval(t)
+            if interval is None or interval[0] >= t + remaining:
+                return t + remaining
+            if interval[0] > t:
+                remaining -= interval[0] - t
+            t = interval[1]
+        return t
+
+    def active_seconds(self, start, end):
+        """Seconds between `start` and `end` outside of silent periods."""
+        t, active = start, 0
+        while t < end:
+            interval = self.next_silent_interval(t)
+            if interval is None or interval[0] >= end:
+                return active + end - t
+            active += max(interval[0] - t, 0)
+            t = interval[1]
+        return active
+
+
+def parse_silent_period(period):
+    # same format as the --silent-period option, e.g. 18:45-20:45
+    start, end = [dateutil.parser.parse(value) for value in period.split('-')]
+    return start.hour * 3600 + start.minute * 60, end.hour * 3600 + end.minute * 60
+
+
+class Policy(object):
+    """Decides which waiting media file a free encode slot of a node takes.
+
+    `add` is called when a media file arrives; `take` when a slot of `node` looks for work and returns the media file
+    it processes, or None to leave the slot idle until the next look.
+    """
+
+    name = None
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def add(self, job, now):
+        raise NotImplementedError
+
+    def take(self, node, now):
+        raise NotImplementedError
+
+
+class PriorityPolicy(Policy):
+    """Media files are taken in the order of `key`, whichever node asks."""
+
+    def __init__(self, nodes):
+        super(PriorityPolicy, self).__init__(nodes)
+        self.heap = []
+
+    def key(self, job):
+        raise NotImplementedError
+
+    def add(self, job, now):
+        heapq.heappush(self.heap, (self.key(job), job.id, job))
+
+    def take(self, node, now):
+        return heapq.heappop(self.heap)[2] if self.heap else None
+
+
+class CurrentPolicy(PriorityPolicy):
+    """Table scan order, the order the processing queue is peeked in: peek has no ORDER BY(the model order_by is
+    ignored by peewee), so media files are taken in the order their rows were added, requeued ones keeping their
+    place."""
+    name = 'current'
+
+    def key(self, job):
+        return job.position
+
+
+class FifoPolicy(PriorityPolicy):
+    name = 'fifo'
+
+    def key(self, job):
+        return job.arrival
+
+
+class SmallestFirstPolicy(PriorityPolicy):
+    name = 'smallest'
+
+    def key(self, job):
+        return job.size
+
+
+class LargestFirstPolicy(PriorityPolicy):
+    name = 'largest'
+
+    def key(self, job):
+        return -job.size
+
+
+class SizeAwarePolicy(Policy):
+    """Nodes faster than the median take the largest media files, the others the smallest ones."""
+    name = 'size_aware'
+
+    def __init__(self, nodes):
+        super(SizeAwarePolicy, self).__init__(nodes)
+        rates = sorted(node.rate for node in nodes)
+        self.median_rate = rates[len(rates) // 2]
+        self.largest = []
+        self.smallest = []
+        self.taken = set()
+
+    def add(self, job, now):
+        heapq.heappush(self.largest, (-job.size, job.id, job))
+        heapq.heappush(self.smallest, (job.size, job.id, job))
+
+    def take(self, node, now):
+        heap = self.largest if node.rate >= self.median_rate else self.smallest
+        while heap:
+            job = heapq.heappop(heap)[2]
+            if job.id not in self.taken:
+                self.taken.add(job.id)
+                return job
+        return None
+
+
+POLICIES = {policy.name: policy for policy in (CurrentPolicy, FifoPolicy, SmallestFirstPolicy, LargestFirstPolicy,
+                                                 SizeAwarePolicy)}
+
+
+def load_policy(path):
+    """Policy class from a `package.module:ClassName` path."""
+    module_name, class_name = path.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def simulate(policy_class, jobs, nodes, idle_timeout):
+    """Discrete-event replay of `jobs` arrivals on `nodes`; slots finding nothing look again every `idle_timeout`
+    seconds, like the encode worker pool, and slots of silent nodes once their silent period ends."""
+    policy = policy_class(nodes)
+    events = []
+    sequence = [0]
+
+    def push(t, kind, payload):
+        sequence[0] += 1
+        heapq.heappush(events, (t, sequence[0], kind, payload))
+
+    # idle slots, with the time they last found nothing to process
+    idle_slots = {(node.name, slot): None for node in nodes for slot in range(node.slots)}
+    nodes_by_name = {node.name: node for node in nodes}
+    results = {}
+    for job in jobs:
+        push(job.arrival, 'arrival', job)
+
+    while events:
+        t, _, kind, payload = heapq.heappop(events)
+        if kind == 'arrival':
+            policy.add(payload, t)
+            for slot, last_look in idle_slots.items():
+                if last_look is not False:
+                    next_look = t if last_look is None else \
+                        last_look + math.ceil((t - last_look) / idle_timeout) * idle_timeout
+                    idle_slots[slot] = False
+                    push(next_look, 'look', slot)
+        elif kind == 'look':
+            node = nodes_by_name[payload[0]]
+            interval = node.next_silent_interval(t)
+            if interval is not None and interval[0] <= t:
+                # a silent node claims nothing until its silent period ends
+                idle_slots[payload] = False
+                push(interval[1], 'look', payload)
+                continue
+            job = policy.take(node, t)
+            if job is None:
+                idle_slots[payload] = t
+                continue
+            idle_slots.pop(payload, None)
+            seconds = job.work / node.rate
+            finished = node.finish_time(t, seconds)
+            results[job.id] = (node.name, t, finished)
+            push(finished, 'finish', payload)
+        else:
+            idle_slots[payload] = False
+            push(t, 'look', payload)
+
+    simulated = []
+    for job in jobs:
+        node_name, started, finished = results[job.id]
+        simulated_job = Job(job.id, job.arrival, job.size, job.profile, job.work, job.position)
+        simulated_job.node, simulated_job.started, simulated_job.finished = node_name, started, finished
+        simulated.append(simulated_job)
+    return simulated
+
+
+def summarize_run(jobs, nodes):
+    first_arrival = min(job.arrival for job in jobs)
+    makespan = max(job.finished for job in jobs) - first_arrival
+    waits = sorted(job.started - job.arrival for job in jobs)
+    turnarounds = sorted(job.finished - job.arrival for job in jobs)
+    node_stats = {}
+    for node in nodes:
+        node_jobs = [job for job in jobs if job.node == node.name]
+        busy_seconds = sum(job.finished - job.started for job in node_jobs)
+        node_stats[node.name] = {'jobs': len(node_jobs),
+                                 'busy_seconds': busy_seconds,
+                                 'utilization': busy_seconds / (node.slots * makespan) if makespan else None}
+    return {'media_files': len(jobs),
+            'makespan': makespan,
+            'wait_mean': sum(waits) / len(waits),
+            'wait_p95': percentile(waits, 0.95),
+            'wait_max': waits[-1],
+            'turnaround_mean': sum(turnarounds) / len(turnarounds),
+            'turnaround_p95': percentile(turnarounds, 0.95),
+            'nodes': node_stats}
+
+
+def get_max_concurrency(intervals):
+    points = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    running = result = 0
+    for _, change in points:
+        running += change
+        result = max(result, running)
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+@ConnectionManager.connection
+def read_history(since=None, until=None):
+    query = MediaFile.select(MediaFile.id, MediaFile.status, MediaFile.file_size, MediaFile.profile,
+                             MediaFile.date_added, MediaFile.date_started, MediaFile.date_encoded,
+                             MediaFile.date_finished,
+                             MediaFile.processing_node, SQL('rowid').alias('position')) \
+        .where(MediaFile.status == MediaFileState.PROCESSED) \
+        .where(~(MediaFile.date_started >> None) & ~(MediaFile.date_finished >> None)
+               & ~(MediaFile.processing_node >> None))
+    if since:
+        query = query.where(MediaFile.date_added >= since)
+    if until:
+        query = query.where(MediaFile.date_added < until)
+    media_files = list(query.order_by(MediaFile.date_added))
+    nodes = {node.hostname: node for node in Node.select()}
+    return media_files, nodes
+
+
+def build_model(media_files, node_rows, slots=None):
+    """Jobs and nodes of the simulation: node rates are their median throughput relative to the fleet one, slots
+    the most media files they processed at once."""
+    history = {}
+    encodes = {}
+    for media_file in media_files:
+        history.setdefault(media_file.processing_node, []).append(media_file)
+        # post processing and the wait for it aren't encode work, media files processed before the encode end was
+        # recorded fall back to the processing end
+        encodes[media_file.id] = (to_timestamp(media_file.date_started),
+                                  to_timestamp(media_file.date_encoded or media_file.date_finished))
+
+    nodes = []
+    for hostname in sorted(history):
+        node_row = node_rows.get(hostname)
+        silent_periods = json.loads(node_row.silent_periods) if node_row and node_row.silent_periods else None
+        node = SimulatedNode(hostname, 1, 1, silent_periods)
+        intervals = [encodes[media_file.id] for media_file in history[hostname]]
+        node.slots = slots or max(get_max_concurrency(intervals), 1)
+        for media_file, (start, end) in zip(history[hostname], intervals):
+            active_seconds = node.active_seconds(start, end)
+            if active_seconds > 0:
+                node.speeds.append(media_file.file_size / active_seconds)
+        nodes.append(node)
+
+    fleet_speed = median([speed for node in nodes for speed in node.speeds] or [1])
+    for node in nodes:
+        node.rate = median(node.speeds) / fleet_speed if node.speeds else 1
+
+    jobs = []
+    nodes_by_name = {node.name: node for node in nodes}
+    for media_file in media_files:
+        node = nodes_by_name[media_file.processing_node]
+        started, finished = encodes[media_file.id]
+        job = Job(str(media_file.id), to_timestamp(media_file.date_added), media_file.file_size, media_file.profile,
+                  node.active_seconds(started, finished) * node.rate, media_file.position)
+        job.node, job.started, job.finished = node.name, started, finished
+        jobs.append(job)
+    return jobs, nodes
+
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks.scheduling',
+                                 description='Handbreak auto processing scheduling policies simulator',
+                                 formatter_class=argparse.RawTextHelpFormatter)
+parser.add_argument('-q', '--queue-directory', help='Directory of the processing queue to replay\n'
+                                                    '(default: run user home directory)',
+                    default=os.path.expanduser('~'))
+parser.add_argument('--database', help='Processing queue database to replay, instead of the one of the queue '
+                                       'directory')
+parser.add_argument('-p', '--policies', help='Policies to simulate, built in ones: {}\n'
+                                             '(default: all of them)'.format(', '.join(sorted(POLICIES))),
+                    nargs='+')
+parser.add_argument('--policy', help='Policy class to simulate too, as package.module:ClassName. You can provide '
+                                     'multiple policies', action='append', default=[])
+parser.add_argument('--since', help='Replay media files added since this date')
+parser.add_argument('--until', help='Replay media files added before this date')
+parser.add_argument('--arrival-scale', help='Scale of the time between arrivals, e.g. 0.5 replays the same media '
+                                            'files arriving twice as fast\n'
+                                            '(default: 1)', type=float, default=1)
+parser.add_argument('--slots', help='Encode slots of every node\n'
+                                    '(default: the most media files each node processed at once)', type=int)
+parser.add_argument('--idle-timeout', help='Seconds an encode slot finding nothing to process waits before looking '
+                                           'again\n'
+                                           '(default: {})'.format(
+                                               MediaProcessing.SCAN_FOR_NEW_MEDIA_FILES_FOR_PROCESSING_TIMEOUT),
+                    type=float, default=MediaProcessing.SCAN_FOR_NEW_MEDIA_FILES_FOR_PROCESSING_TIMEOUT)
+parser.add_argument('-o', '--output', help='File the results are written to(JSON)')
+
+
+def main():
+    args = parser.parse_args()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(FORMATTER)
+    logging.getLogger().addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logging.getLogger('lib').setLevel(logging.WARN)
+
+    policies = [POLICIES[name] for name in args.policies] if args.policies else \
+        [POLICIES[name] for name in sorted(POLICIES)]
+    policies += [load_policy(path) for path in args.policy]
+
+    database_file = args.database or os.path.join(args.queue_directory, '.handbreak-auto-processing', 'data.db')
+    if not os.path.exists(database_file):
+        parser.error('no processing queue database [{}]'.format(database_file))
+    # the queue is read from a copy, running nodes keep using theirs
+    temp_directory = tempfile.mkdtemp(prefix='handbreak-scheduling-')
+    try:
+        database, _, _ = fixtures.open_database(fixtures.copy_database(database_file,
+                                                                       os.path.join(temp_directory, 'data.db')))
+        try:
+            media_files, node_rows = read_history(dateutil.parser.parse(args.since) if args.since else None,
+                                                  dateutil.parser.parse(args.until) if args.until else None)
+        finally:
+            fixtures.close_database(database)
+    finally:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+    if not media_files:
+        parser.error('no processed media files to replay')
+
+    jobs, nodes = build_model(media_files, node_rows, args.slots)
+    if args.arrival_scale != 1:
+        first_arrival = jobs[0].arrival
+        for job in jobs:
+            job.arrival = first_arrival + (job.arrival - first_arrival) * args.arrival_scale
+    logger.info("Replaying [{}] media files on [{}] nodes".format(len(jobs), len(nodes)))
+    for node in nodes:
+        logger.info("[{}] rate [{:.2f}] slots [{}] silent periods {}".format(node.name, node.rate, node.slots,
+                                                                             node.silent_periods))
+
+    results = {'history': summarize_run(jobs, nodes)}
+    for policy_class in policies:
+        results[policy_class.name or policy_class.__name__] = summarize_run(
+            simulate(policy_class, jobs, nodes, args.idle_timeout), nodes)
+
+    for name in ['history'] + [policy_class.name or policy_class.__name__ for policy_class in policies]:
+        result = results[name]
+        logger.info("[{}] makespan [{:.0f}s] wait mean [{:.0f}s] p95 [{:.0f}s] turnaround mean [{:.0f}s] p95 "
+                    "[{:.0f}s] utilization {}".format(name, result['makespan'], result['wait_mean'],
+                                                      result['wait_p95'], result['turnaround_mean'],
+                                                      result['turnaround_p95'],
+                                                      {node: '{:.0%}'.format(stats['utilization'] or 0)
+                                                       for node, stats in sorted(result['nodes'].items())}))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': datetime.datetime.now().isoformat(),
+                       'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+                       'nodes': {node.name: {'rate': node.rate, 'slots': node.slots,
+                                             'silent_periods': node.silent_periods} for node in nodes},
+                       'results': results}, f, indent=2, sort_keys=True)
+        logger.info("Results written to [{}]".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
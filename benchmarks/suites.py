@@ -0,0 +1,254 @@
+import fnmatch
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import uuid
+
+from benchmarks import fixtures
+from benchmarks import logger
+from lib.connection_manager import ConnectionManager
+from lib.event_handlers import MediaFilesEventHandler
+from lib.media_file import MediaFile
+from lib.media_file_state import MediaFileState
+from lib.media_processing import MediaProcessing
+from lib.namespaces import queue
+from lib.path_matcher import PathMatcher
+from lib.response_cache import response_cache
+from lib.rest_api import app
+
+FAKE_HANDBRAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_handbrake.py')
+QUEUE_BENCHMARKS = ('queue.len', 'queue.contains', 'queue.contains_missing', 'queue.getitem', 'queue.setitem',
+                    'queue.peek', 'queue.claim', 'queue.list', 'rest.queue_stats', 'rest.queue_stats_cached',
+                    'rest.queue_load', 'rest.queue_size', 'queue.retry_media_files')
+INGEST_BENCHMARKS = ('ingest.initial_processing', 'ingest.event_storm')
+
+
+class BenchmarkContext(object):
+    """Options shared by the suites and the results they collect, by benchmark name."""
+
+    def __init__(self, data_directory, patterns=None, repeat=200, budget=10, seed=0):
+        self.data_directory = data_directory
+        self.work_directory = os.path.join(data_directory, 'work')
+        self.patterns = patterns or ['*']
+        self.repeat = repeat
+        self.budget = budget
+        self.seed = seed
+        self.results = {}
+        if not os.path.exists(self.work_directory):
+            os.makedirs(self.work_directory)
+
+    def selected(self, *names):
+        return any(fnmatch.fnmatch(name, pattern) for name in names for pattern in self.patterns)
+
+    def measure(self, name, func, setup=None, repeat=None, **extra):
+        """Runs `func` up to `repeat` times, or less once the time budget is spent, and records its timings."""
+        if not self.selected(name):
+            return None
+        repeat = repeat or self.repeat
+        samples = []
+        deadline = time.time() + self.budget
+        while len(samples) < repeat and (not samples or time.time() < deadline):
+            if setup:
+                setup()
+            started = time.time()
+            func()
+            samples.append(time.time() - started)
+        return self.record(name, samples, **extra)
+
+    def record(self, name, samples, **extra):
+        result = summarize(samples)
+        result.update(extra)
+        self.results[name] = result
+        logger.info("[{}] median [{:.6f}s] p95 [{:.6f}s] over [{}] runs".format(name, result['median'], result['p95'],
+                                                                               result['runs']))
+        return result
+
+
+def percentile(sorted_samples, fraction):
+    return sorted_samples[min(int(len(sorted_samples) * fraction), len(sorted_samples) - 1)]
+
+
+def summarize(samples):
+    sorted_samples = sorted(samples)
+    return {'unit': 'seconds',
+            'runs': len(samples),
+            'min': sorted_samples[0],
+            'median': percentile(sorted_samples, 0.5),
+            'p95': percentile(sorted_samples, 0.95),
+            'max': sorted_samples[-1],
+            'mean': sum(samples) / len(samples)}
+
+
+def wait_until(predicate, timeout, interval=0.05):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+@ConnectionManager.connection(transaction=True)
+def claim(mfq):
+    media_file = mfq.peek(MediaFileState.WAITING, mfq.profiles.get_names())
+    mfq.claim(media_file, MediaFileState.PROCESSING)
+
+
+@ConnectionManager.connection
+def get_ids(status):
+    return [media_file.id for media_file in MediaFile.select(MediaFile.id).where(MediaFile.status == status)]
+
+
+@ConnectionManager.connection
+def get_file_paths():
+    return set(media_file.file_path for media_file in MediaFile.select(MediaFile.file_path)
+               .where(MediaFile.date_deleted.is_null()))
+
+
+@ConnectionManager.connection
+def get_finished_media_files():
+    return list(MediaFile.select().where(MediaFile.status << [MediaFileState.PROCESSED, MediaFileState.FAILED]))
+
+
+def create_event_handler(mfq, journal_file):
+    return MediaFilesEventHandler(mfq, PathMatcher(['*.mp4'], None, True), False, 0, journal_file)
+
+
+def queue_suite(context, rows):
+    """Queue operations and REST endpoints against a copy of a synthetic database of `rows` media files."""
+    if not context.selected(*['{}[{}]'.format(name, rows) for name in QUEUE_BENCHMARKS]):
+        return
+    source_file = fixtures.get_database(context.data_directory, rows, context.seed)
+    database_file = fixtures.copy_database(source_file, os.path.join(context.work_directory, 'queue.db'))
+    database, mfq, nodes = fixtures.open_database(database_file)
+    try:
+        rnd = random.Random(context.seed)
+        processed_ids = get_ids(MediaFileState.PROCESSED)
+        waiting_count = len(get_ids(MediaFileState.WAITING))
+        media_processing = MediaProcessing(mfq, 3600, nodes, False)
+        queue.mp = media_processing
+        client = app.test_client()
+
+        def get(path):
+            response = client.get(path)
+            if response.status_code != 200:
+                raise Exception('[{}] answered [{}]'.format(path, response.status_code))
+
+        def invalidate():
+            response_cache.version = None
+
+        context.measure('queue.len[{}]'.format(rows), lambda: len(mfq))
+        context.measure('queue.contains[{}]'.format(rows), lambda: rnd.choice(processed_ids) in mfq)
+        context.measure('queue.contains_missing[{}]'.format(rows), lambda: uuid.uuid4() in mfq)
+        context.measure('queue.getitem[{}]'.format(rows), lambda: mfq[rnd.choice(processed_ids)])
+        context.measure('queue.setitem[{}]'.format(rows),
+                        lambda: mfq.__setitem__(rnd.choice(processed_ids), MediaFileState.PROCESSED))
+        context.measure('queue.peek[{}]'.format(rows), lambda: mfq.peek(MediaFileState.WAITING))
+        context.measure('queue.claim[{}]'.format(rows), lambda: claim(mfq), repeat=min(context.repeat, waiting_count))
+        context.measure('queue.list[{}]'.format(rows), mfq.list, repeat=5)
+        context.measure('rest.queue_stats[{}]'.format(rows), lambda: get('/queue/stats?humanize=false'),
+                        setup=invalidate, repeat=5)
+        context.measure('rest.queue_stats_cached[{}]'.format(rows), lambda: get('/queue/stats?humanize=false'))
+        context.measure('rest.queue_load[{}]'.format(rows), lambda: get('/queue/load'), setup=invalidate, repeat=5)
+        context.measure('rest.queue_size[{}]'.format(rows), lambda: get('/queue/size?humanize=false'),
+                        setup=invalidate)
+        # every media file is returned to the queue, it runs last
+        context.measure('queue.retry_media_files[{}]'.format(rows), media_processing.retry_media_files, repeat=1)
+    finally:
+        fixtures.close_database(database)
+
+
+def ingest_suite(context, files):
+    """Initial scan of a directory tree of `files` media files, and replay of a file system event storm over it."""
+    if not context.selected(*['{}[{}]'.format(name, files) for name in INGEST_BENCHMARKS]):
+        return
+    tree_directory = os.path.join(context.work_directory, 'tree')
+    timeout = max(files / 10.0, 60)
+
+    def run(name, feed, expected_file_paths):
+        database_file = os.path.join(context.work_directory, 'ingest.db')
+        if os.path.exists(database_file):
+            os.remove(database_file)
+        database, mfq, nodes = fixtures.open_database(database_file)
+        event_handler = create_event_handler(mfq, os.path.join(context.work_directory, 'pending.json'))
+        try:
+            event_handler.start()
+            started = time.time()
+            feed(MediaProcessing(mfq, 3600, nodes, False), event_handler)
+            fed = time.time()
+            drained = wait_until(lambda: not any(event_handler.get_backlog().values()) and
+                                 len(get_file_paths()) >= len(expected_file_paths), timeout)
+            finished = time.time()
+            file_paths = get_file_paths()
+            context.record(name, [finished - started], feed_seconds=fed - started, drained=drained,
+                           files_per_second=len(file_paths) / (finished - started),
+                           missing=len(expected_file_paths - file_paths),
+                           unexpected=len(file_paths - expected_file_paths))
+        finally:
+            event_handler.stop()
+            fixtures.close_database(database)
+
+    if context.selected('ingest.initial_processing[{}]'.format(files)):
+        file_paths = fixtures.build_tree(tree_directory, files, seed=context.seed)
+        run('ingest.initial_processing[{}]'.format(files),
+            lambda media_processing, event_handler: media_processing.initial_processing([tree_directory],
+                                                                                        event_handler),
+            set(file_paths))
+
+    if context.selected('ingest.event_storm[{}]'.format(files)):
+        file_paths = fixtures.build_tree(tree_directory, files, seed=context.seed)
+        events, expected_file_paths = fixtures.event_storm(file_paths, seed=context.seed)
+
+        def replay(media_processing, event_handler):
+            for action, event in events:
+                fixtures.apply_action(action)
+                event_handler.on_any_event(event)
+
+        run('ingest.event_storm[{}]'.format(files), replay, expected_file_paths)
+    shutil.rmtree(tree_directory, ignore_errors=True)
+
+
+def end_to_end_suite(context, files, slots, duration, file_size):
+    """Media files encoded by the fake HandBrake CLI through the real processing loop."""
+    name = 'end_to_end[{}x{}s,{}slots]'.format(files, duration, slots)
+    if not context.selected(name):
+        return
+    tree_directory = os.path.join(context.work_directory, 'end-to-end')
+    file_paths = fixtures.build_tree(tree_directory, files, file_size, context.seed)
+    database_file = os.path.join(context.work_directory, 'end-to-end.db')
+    if os.path.exists(database_file):
+        os.remove(database_file)
+    command = '"{}" "{}" --duration {} --jitter 0.2'.format(sys.executable, FAKE_HANDBRAKE, duration)
+    database, mfq, nodes = fixtures.open_database(database_file, command)
+    media_processing = MediaProcessing(mfq, 3600, nodes, True, encode_slots=slots)
+    # slots finding the queue empty look again right away instead of waiting
+    media_processing.SCAN_FOR_NEW_MEDIA_FILES_FOR_PROCESSING_TIMEOUT = 1
+    processing_thread = threading.Thread(target=media_processing.start, name='benchmarks.end_to_end')
+    try:
+        fixtures.register_node(nodes, context.data_directory)
+        started = time.time()
+        mfq.add_all(file_paths)
+        processing_thread.start()
+        finished_all = wait_until(lambda: len(get_finished_media_files()) >= files,
+                                  files * duration * 3 / slots + 60, 0.2)
+        finished = time.time()
+        media_files = get_finished_media_files()
+        latencies = sorted((media_file.date_finished - media_file.date_added).total_seconds()
+                           for media_file in media_files)
+        context.record(name, [finished - started],
+                       finished=finished_all,
+                       failed=sum(1 for media_file in media_files if media_file.status == MediaFileState.FAILED),
+                       files_per_second=len(media_files) / (finished - started),
+                       bytes_per_second=len(media_files) * file_size / (finished - started),
+                       slot_utilization=files * duration / ((finished - started) * slots),
+                       latency_median=percentile(latencies, 0.5) if latencies else None,
+                       latency_p95=percentile(latencies, 0.95) if latencies else None)
+    finally:
+        media_processing.stop()
+        if processing_thread.isAlive():
+            processing_thread.join()
+        fixtures.close_database(database)
+        shutil.rmtree(tree_directory, ignore_errors=True)
@@ -1,37 +1,34 @@
 #!/usr/bin/env python2
+import time
+
+STARTUP_TIME = time.time()
+
 import argparse
 import logging.handlers
 import os
 import signal
 import socket
 import sys
-import tempfile
 from os.path import expanduser
 from uuid import uuid4
 
-from watchdog.observers import Observer
 from peewee import SqliteDatabase
 
-from lib.utils import configure_logging
-from lib.event_handlers import MediaFilesEventHandler
+from lib.utils import configure_logging, is_filesystem_case_sensitive
 from lib.media_file_state import MediaFileState
-from lib.media_processing import MediaProcessing
+from lib.media_prober import MediaRule
 from lib.nodes.node_state import NodeState
 from lib.nodes.nodes_inventory import NodeInventory
 from lib.persistent_media_files_queue import MediaFilesQueue
-from lib.rest_api import RestApi
+from lib.event_log import EventLog
+from lib.profiles import load_profiles
 from lib.connection_manager import ConnectionManager
+from lib import metrics
+from lib import tracing
 
 DEFAULT_INCLUDE_PATTERN = ['*.mp4', '*.mpg', '*.mov', '*.mkv', '*.avi']
 SCAN_FOR_NEW_MEDIA_FILES_FOR_PROCESSING_TIMEOUT = 10
-
-
-def is_filesystem_case_sensitive():
-    result = True
-    tmphandle, tmppath = tempfile.mkstemp()
-    if os.path.exists(tmppath.upper()):
-        result = False
-    return result
+READ_ONLY_STARTUP_BUDGET = 0.5
 
 
 parser = argparse.ArgumentParser(description='Watch for new media files and automatically process them with Handbreak')
@@ -65,13 +62,54 @@ parser.add_argument('-e', '--exclude-pattern', help='Exclude for processing file
                     action='append')
 parser.add_argument('-s', '--case-sensitive', help='Whether pattern matching should be case sensitive\n'
                                                    '(default: depends on the filesystem)',
-                    default=is_filesystem_case_sensitive(), action='store_true')
+                    default=None, action='store_true')
 
 parser.add_argument('-z', '--silent-period',
                     help='A silent period(the media processing command will be suspended) defined as so: [18:45:20:45]. '
                          'You can provide multiple periods', action='append')
-parser.add_argument("-x", "--rest-api", action="store_true", default=False, help="Enable REST API on port 6767")
-
+parser.add_argument("-x", "--rest-api", action="store_true", default=False, help="Enable REST API")
+parser.add_argument('--rest-api-host', help='Address the REST API listens on\n'
+                                            '(default: 0.0.0.0)', default='0.0.0.0')
+parser.add_argument('--rest-api-port', help='Port the REST API listens on\n'
+                                            '(default: 6767)', default=6767)
+parser.add_argument('--rest-api-threads', help='Number of REST API requests handled at the same time\n'
+                                               '(default: 8)', default=8)
+parser.add_argument('--rest-api-timeout', help='Time a REST API connection is kept open while idle(seconds)\n'
+                                               '(default: 30)', default=30)
+parser.add_argument('--heartbeat-interval', help='Interval between node heartbeats(seconds)\n'
+                                                 '(default: 30)', default=30)
+parser.add_argument('--node-timeout', help='Mark a node offline and return its media files to the processing queue '
+                                           'after it has not sent a heartbeat for that long(seconds)\n'
+                                           '(default: 300)', default=300)
+parser.add_argument('--stable-period', help='Add a new media file to processing queue only after its size and '
+                                            'modification time have not changed for that long or it has been '
+                                            'closed after writing(seconds)\n'
+                                            '(default: 15)', default=15)
+parser.add_argument('--network-share', help='Watch directory on a network share(NFS/SMB) periodically scanned for '
+                                            'changes made by other hosts, optionally with its own scan interval: '
+                                            '[/mnt/media:120]. You can provide multiple directories',
+                    action='append')
+parser.add_argument('--network-scan-interval', help='Interval between scans of network shares(seconds)\n'
+                                                    '(default: 60)', default=60)
+parser.add_argument('--probe-command', help='ffprobe compatible command printing codec, resolution, duration and bit '
+                                            'rate of INPUT_FILE as JSON, e.g. [ffprobe -v quiet -print_format json '
+                                            '-show_format -show_streams "$INPUT_FILE"]\n'
+                                            '(default: built-in MP4 and Matroska header parser)')
+parser.add_argument('--skip-if', help='Skip media files matching all the conditions of a rule instead of processing '
+                                      'them: [video_codec=hevc|av1,bit_rate<6M]. Fields: video_codec, width, height, '
+                                      'duration, bit_rate. You can provide multiple rules', action='append')
+parser.add_argument('--calibration-command', help='Short encode command used once per machine to measure a relative '
+                                                  'node performance score(all nodes should use the same command)\n'
+                                                  '(default: built-in CPU benchmark)')
+
+parser.add_argument('--db-profile', help='Record connect time, lock wait and hold times and query count of every '
+                                         'database function, available on the REST API', action='store_true')
+parser.add_argument('--db-slow-transaction', help='Log transactions holding the database lock longer than this while '
+                                                  'profiling(seconds)\n'
+                                                  '(default: 1)', type=float, default=1)
+parser.add_argument('--db-profile-file', help='File the database profile is written to on exit')
+parser.add_argument('--trace-file', help='File the queue wait, claim, stage-in, probe, encode, post processing and '
+                                         'state write spans of every media file are appended to(JSON lines)')
 parser.add_argument("-v", "--verbose", action='count', help="Enable verbose log output")
 parser.add_argument('-m', '--max-log-size', help='Max log size in MB; set to 0 to disable log file rotating\n'
                                                  '(default: 100)', default=100)
@@ -84,6 +122,32 @@ parser.add_argument('-t', '--handbreak-timeout', help='Timeout of Handbreak comm
 parser.add_argument('-f', '--file-extension', help='Output file extension\n'
                                                    '(default: mp4)', default='mp4')
 parser.add_argument('-d', '--delete', help='Delete original file', action='store_true')
+parser.add_argument('--profiles-file', help='JSON file with a list of processing profiles, each with a name, a '
+                                            'command, and optionally a file_extension, a cost(1 being a full encode '
+                                            'slot), a watch_directory, patterns and media rules; media files matching '
+                                            'no profile are processed with the Handbreak command')
+parser.add_argument('--post-stage', help='Post processing stage run after the Handbreak command on its own worker '
+                                         'pool, e.g. [rename \'filebot -rename "$OUTPUT_FILE"\']. '
+                                         'You can provide multiple stages, they are run in order',
+                    nargs=2, metavar=('NAME', 'COMMAND'), action='append')
+parser.add_argument('--encode-slots', help='Number of media files processed by the Handbreak command at the same time\n'
+                                           '(default: 1)', default=1)
+parser.add_argument('--post-slots', help='Number of media files going through post processing stages at the same '
+                                         'time\n'
+                                         '(default: 1)', default=1)
+parser.add_argument('--batch-size-threshold', help='Media files up to this size(MB) are claimed in batches and '
+                                                  'processed one after the other by the same encode slot\n'
+                                                  '(default: disabled)')
+parser.add_argument('--batch-max-files', help='Max number of media files claimed in a batch\n'
+                                             '(default: 10)', default=10)
+parser.add_argument('--scratch-directory', help='Local directory(SSD or tmpfs) media files are copied to for '
+                                                'processing, the output file is moved back to the watch directory '
+                                                'once processed')
+parser.add_argument('--prefetch-progress', help='Claim and stage the next media file in the scratch directory once '
+                                                'the processing command reports that much progress(percent)\n'
+                                                '(default: disabled)')
+parser.add_argument('--prefetch-budget', help='Max size of a prefetched media file(MB)\n'
+                                              '(default: 20480)', default=20480)
 
 list_command_group._group_actions.append(list_arg)
 args = parser.parse_args()
@@ -93,6 +157,8 @@ queue_directory = args.queue_directory
 include_pattern = args.include_pattern if args.include_pattern is not None else DEFAULT_INCLUDE_PATTERN
 exclude_pattern = args.exclude_pattern
 case_sensitive = args.case_sensitive
+if case_sensitive is None and watch_directories:
+    case_sensitive = is_filesystem_case_sensitive(watch_directories[0])
 max_log_size = args.max_log_size
 max_log_file_to_keep = args.max_log_file_to_keep
 
@@ -107,6 +173,17 @@ handbreak_command = args.handbreak_command
 handbreak_timeout = float(args.handbreak_timeout) * 60 * 60
 file_extension = args.file_extension
 delete = args.delete
+post_stages = [tuple(post_stage) for post_stage in args.post_stage or []]
+encode_slots = int(args.encode_slots)
+post_slots = int(args.post_slots)
+batch_size_threshold = int(float(args.batch_size_threshold) * 1024 * 1024) \
+    if args.batch_size_threshold is not None else None
+batch_max_files = int(args.batch_max_files)
+scratch_directory = args.scratch_directory
+prefetch_progress = float(args.prefetch_progress) if args.prefetch_progress is not None else None
+prefetch_budget = int(args.prefetch_budget) * 1024 * 1024
+if prefetch_progress is not None and not scratch_directory:
+    parser.error('--prefetch-progress requires --scratch-directory')
 list_processing_queue = args.list_processing_queue
 retry_media_file = args.retry_media_file
 retry_all_media_files = args.retry_all_media_files
@@ -114,6 +191,30 @@ initial_processing = args.initial_processing
 reprocess = args.reprocess
 silent_period = args.silent_period
 enable_rest_api = args.rest_api
+rest_api_host = args.rest_api_host
+rest_api_port = int(args.rest_api_port)
+rest_api_threads = int(args.rest_api_threads)
+rest_api_timeout = float(args.rest_api_timeout)
+heartbeat_interval = float(args.heartbeat_interval)
+node_timeout = float(args.node_timeout)
+calibration_command = args.calibration_command
+stable_period = float(args.stable_period)
+probe_command = args.probe_command
+try:
+    skip_rules = [MediaRule(rule) for rule in args.skip_if or []]
+except ValueError as e:
+    parser.error(str(e))
+network_scan_interval = float(args.network_scan_interval)
+network_shares = {}
+for network_share in args.network_share or []:
+    network_share_directory, _, network_share_interval = network_share.rpartition(':')
+    try:
+        network_shares[network_share_directory] = float(network_share_interval)
+    except ValueError:
+        network_share_directory = network_share
+        network_shares[network_share_directory] = network_scan_interval
+    if network_share_directory not in (watch_directories or []):
+        parser.error('network share [{}] is not one of the watch directories'.format(network_share_directory))
 
 logger = logging.getLogger(__name__)
 configure_logging('handbreak-auto-processing.log', max_log_size, max_log_file_to_keep, logging_level,
@@ -126,11 +227,23 @@ if not os.path.exists(data_store_directory):
 database_file = os.path.join(data_store_directory, 'data.db')
 database = SqliteDatabase(database_file)
 ConnectionManager.register_database(database)
+if args.db_profile or args.db_profile_file:
+    ConnectionManager.enable_profiling(args.db_slow_transaction)
+if args.trace_file:
+    tracing.configure(os.path.expanduser(args.trace_file))
+
+try:
+    profiles = load_profiles(args.profiles_file, handbreak_command, file_extension, case_sensitive)
+except (IOError, ValueError) as e:
+    parser.error('invalid profiles file: {}'.format(e))
 
-mfq = MediaFilesQueue(file_extension)
-nodes = NodeInventory()
+event_log = EventLog()
+mfq = MediaFilesQueue(file_extension, handbreak_command, profiles, event_log)
+nodes = NodeInventory(event_log=event_log)
 
 rest_api = None
+event_handler = None
+node_liveness = None
 observers_list = []
 
 
@@ -143,46 +256,81 @@ def clean_handler(signal, frame):
     for observer in observers_list:
         observer.stop()
         observer.join()
-    toggle_node_state()
+    if event_handler:
+        event_handler.stop()
+    if node_liveness:
+        node_liveness.stop()
+    nodes[socket.gethostname()] = NodeState.OFFLINE
+    if args.db_profile_file:
+        ConnectionManager.get_profiler().dump(os.path.expanduser(args.db_profile_file))
     exit(0)
 
 
-def toggle_node_state():
+def register_node():
+    nodes.hardware_info = get_hardware_info(data_store_directory, calibration_command)
     if socket.gethostname() in nodes:
-        current_state = nodes[socket.gethostname()].status
-        if current_state == NodeState.OFFLINE:
-            nodes[socket.gethostname()] = NodeState.ONLINE
-        else:
-            nodes[socket.gethostname()] = NodeState.OFFLINE
+        requeued = mfq.requeue_orphaned([socket.gethostname()])
+        if requeued:
+            logger.info("[{}] media files left by the previous run of this node returned to processing queue".format(
+                requeued))
+        nodes[socket.gethostname()] = NodeState.ONLINE
+        nodes.update_hardware_info(socket.gethostname())
     else:
         nodes[uuid4(), socket.gethostname()] = NodeState.ONLINE
 
 
 if __name__ == "__main__":
-    toggle_node_state()
-    if silent_period:
-        nodes.set_silent_periods(socket.gethostname(), silent_period)
+    if list_processing_queue:
+        media_files = mfq.list()
+        if media_files:
+            logger.info("Current processing queue:")
+            for media_file in media_files:
+                logger.info("[{} : {}]".format(media_file['id'], media_file['status']))
+        else:
+            logger.info("Processing queue is empty")
+
+        startup_time = time.time() - STARTUP_TIME
+        if startup_time > READ_ONLY_STARTUP_BUDGET:
+            logger.warn("Listing the processing queue took [{:.3f}s], over the [{}s] budget".format(
+                startup_time, READ_ONLY_STARTUP_BUDGET))
+        else:
+            logger.debug("Listing the processing queue took [{:.3f}s]".format(startup_time))
+        exit(0)
 
+    from lib.event_handlers import MediaFilesEventHandler
+    from lib.media_processing import MediaProcessing
+    from lib.media_prober import MediaProber
+    from lib.nodes.node_hardware import get_hardware_info
+    from lib.nodes.node_liveness import NodeLivenessThread
+    from lib.network_observer import NetworkShareObserver
+    from lib.observers import create_observer
+    from lib.path_matcher import PathMatcher
+    from lib.prefetcher import Prefetcher
+    from lib.staging import StagingArea
+
+    matcher = PathMatcher(include_pattern, exclude_pattern, case_sensitive)
+    staging_area = StagingArea(scratch_directory) if scratch_directory else None
     media_processing = MediaProcessing(
         mfq,
-        handbreak_command,
         handbreak_timeout,
         nodes,
-        delete
+        delete,
+        staging_area,
+        Prefetcher(mfq, staging_area, prefetch_progress, prefetch_budget) if prefetch_progress is not None else None,
+        post_stages,
+        encode_slots,
+        post_slots,
+        batch_size_threshold,
+        batch_max_files
     )
 
     if enable_rest_api:
-        rest_api = RestApi(media_processing, nodes)
+        from lib.rest_api import RestApi
+        rest_api = RestApi(media_processing, nodes, rest_api_host, rest_api_port, rest_api_threads, rest_api_timeout)
 
-    if list_processing_queue:
-        if len(mfq) > 0:
-            logger.info("Current processing queue:")
-            media_files = media_processing.get_queue_files()
-            for media_file, status in media_files.items():
-                logger.info("[{} : {}]".format(media_file, status.value))
-        else:
-            logger.info("Processing queue is empty")
-        exit(0)
+    register_node()
+    if silent_period:
+        nodes.set_silent_periods(socket.gethostname(), silent_period)
 
     if retry_all_media_files:
         media_processing.retry_media_files()
@@ -193,21 +341,37 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, clean_handler)
     signal.signal(signal.SIGTERM, clean_handler)
 
+    node_liveness = NodeLivenessThread(nodes, mfq, socket.gethostname(), heartbeat_interval, node_timeout,
+                                       name=NodeLivenessThread.__module__)
+    node_liveness.start()
+
     logger.info("Handbreak media processor started pid: [{}]".format(os.getpid()))
     logger.info("Watching directories: {}".format(watch_directories))
+    if network_shares:
+        logger.info("Scanning network shares: {}".format(network_shares))
     logger.info("Include patterns: {}".format(include_pattern))
     logger.info("Exclude patterns: {}".format(exclude_pattern))
     logger.info("Case sensitive: [{}]".format(case_sensitive))
+    if len(profiles):
+        logger.info("Processing profiles: {}".format(list(profiles)))
     logger.info("Processing queue size: [{}]".format(len(mfq)))
 
     # watch for media files
-    event_handler = MediaFilesEventHandler(mfq, include_pattern, exclude_pattern, case_sensitive, reprocess)
+    event_handler = MediaFilesEventHandler(mfq, matcher, reprocess, stable_period,
+                                           os.path.join(data_store_directory,
+                                                        'pending-{}.json'.format(socket.gethostname())),
+                                           MediaProber(probe_command, skip_rules))
+    event_handler.start()
+    metrics.ingestion_backlog.set_function(event_handler.get_backlog)
 
     if initial_processing:
         media_processing.initial_processing(watch_directories, event_handler)
 
     for watch_directory in watch_directories:
-        observer = Observer()
+        if watch_directory in network_shares:
+            observer = NetworkShareObserver(network_shares[watch_directory], data_store_directory)
+        else:
+            observer = create_observer()
         observer.schedule(event_handler, watch_directory, recursive=True)
         observer.setDaemon(True)
         observer.start()
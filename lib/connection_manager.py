@@ -1,10 +1,86 @@
 import functools
+import json
+import os
+import threading
+import time
+
+from playhouse.migrate import SqliteMigrator, migrate
+
+from lib import logger
+from lib import metrics
+
+
+class TransactionProfiler(object):
+    """Connect time, lock wait and hold times and query count of every ConnectionManager decorated function.
+
+    Queries are counted for every decorated function they run under; lock times only for the outermost
+    transaction, the one actually holding the database lock.
+    """
+
+    def __init__(self, slow_transaction=1.0):
+        self.slow_transaction = slow_transaction
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enter(self, name):
+        frame = {'name': name, 'connect': 0, 'wait': None, 'hold': None, 'queries': 0}
+        self.__get_frames().append(frame)
+        return frame
+
+    def count_query(self):
+        for frame in self.__get_frames():
+            frame['queries'] += 1
+
+    def exit(self, frame):
+        self.__get_frames().remove(frame)
+        with self.lock:
+            stats = self.stats.setdefault(frame['name'], {
+                'calls': 0, 'transactions': 0, 'slow_transactions': 0, 'queries': 0, 'max_queries': 0,
+                'connect_seconds': 0, 'wait_seconds': 0, 'max_wait_seconds': 0, 'hold_seconds': 0,
+                'max_hold_seconds': 0})
+            stats['calls'] += 1
+            stats['queries'] += frame['queries']
+            stats['max_queries'] = max(stats['max_queries'], frame['queries'])
+            stats['connect_seconds'] += frame['connect']
+            if frame['hold'] is not None:
+                stats['transactions'] += 1
+                stats['wait_seconds'] += frame['wait']
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], frame['wait'])
+                stats['hold_seconds'] += frame['hold']
+                stats['max_hold_seconds'] = max(stats['max_hold_seconds'], frame['hold'])
+                if frame['hold'] >= self.slow_transaction:
+                    stats['slow_transactions'] += 1
+        if frame['hold'] is not None and frame['hold'] >= self.slow_transaction:
+            logger.warn("Slow transaction [{}]: waited [{:.3f}s] and held the database lock for [{:.3f}s] running "
+                        "[{}] queries".format(frame['name'], frame['wait'], frame['hold'], frame['queries']))
+
+    def get_stats(self):
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def dump(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.get_stats(), f, indent=2, sort_keys=True)
+
+    def __get_frames(self):
+        if not hasattr(self.local, 'frames'):
+            self.local.frames = []
+        return self.local.frames
 
 
 class ConnectionManager(object):
 
     __active_transactions = 0
     __database = None
+    __changes = 0
+    __profiler = None
+    # decorated functions running on each thread, the outermost one closes the connection
+    __local = threading.local()
 
     @classmethod
     def register_database(cls, database):
@@ -14,6 +90,46 @@ class ConnectionManager(object):
     def initialize_proxy(cls, proxy):
         proxy.initialize(cls.__get_database())
 
+    @classmethod
+    def migrate_table(cls, model):
+        database = cls.__get_database()
+        table_name = model._meta.table_name
+        existing_columns = [column.name for column in database.get_columns(table_name)]
+        migrator = SqliteMigrator(database)
+        operations = [migrator.add_column(table_name, field.column_name, field)
+                      for field in model._meta.sorted_fields if field.column_name not in existing_columns]
+        if operations:
+            migrate(*operations)
+        model._schema.create_indexes(safe=True)
+
+    @classmethod
+    def enable_profiling(cls, slow_transaction=1.0):
+        database = cls.__get_database()
+        profiler = TransactionProfiler(slow_transaction)
+        execute_sql = database.execute_sql
+
+        def profiled_execute_sql(*args, **kwargs):
+            profiler.count_query()
+            return execute_sql(*args, **kwargs)
+
+        database.execute_sql = profiled_execute_sql
+        cls.__profiler = profiler
+        return profiler
+
+    @classmethod
+    def get_profiler(cls):
+        return cls.__profiler
+
+    @classmethod
+    def get_data_version(cls):
+        # changes committed by this process, and the database file state for the ones committed by other nodes
+        database = cls.__get_database()
+        try:
+            database_stat = os.stat(database.database)
+            return cls.__changes, database_stat.st_mtime, database_stat.st_size
+        except OSError:
+            return cls.__changes, None, None
+
     @classmethod
     def __get_database(cls):
         if cls.__database:
@@ -29,15 +145,41 @@ class ConnectionManager(object):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             database = cls.__get_database()
-            database.connect(reuse_if_open=True)
-            if transaction:
-                with database.atomic('EXCLUSIVE'):
-                    cls.__active_transactions += 1
+            profiler = cls.__profiler
+            if profiler:
+                frame = profiler.enter('{}.{}.{}'.format(func.__module__, type(args[0]).__name__, func.__name__)
+                                       if args else '{}.{}'.format(func.__module__, func.__name__))
+                started = time.time()
+            cls.__local.depth = getattr(cls.__local, 'depth', 0) + 1
+            try:
+                database.connect(reuse_if_open=True)
+                if profiler:
+                    frame['connect'] = time.time() - started
+                if transaction:
+                    outermost = not database.in_transaction()
+                    started = time.time()
+                    with database.atomic('EXCLUSIVE'):
+                        acquired = time.time()
+                        cls.__active_transactions += 1
+                        try:
+                            result = func(*args, **kwargs)
+                        finally:
+                            cls.__active_transactions -= 1
+                    if outermost:
+                        wait, hold = acquired - started, time.time() - acquired
+                        metrics.db_transaction_wait_seconds.observe(wait)
+                        metrics.db_transaction_hold_seconds.observe(hold)
+                        if profiler:
+                            frame['wait'], frame['hold'] = wait, hold
+                else:
                     result = func(*args, **kwargs)
-                    cls.__active_transactions -= 1
-            else:
-                result = func(*args, **kwargs)
-            if cls.__active_transactions == 0 and not database.is_closed():
-                database.close()
+            finally:
+                cls.__local.depth -= 1
+                if cls.__local.depth == 0 and cls.__active_transactions == 0 and not database.is_closed():
+                    if database.connection().total_changes:
+                        cls.__changes += 1
+                    database.close()
+                if profiler:
+                    profiler.exit(frame)
             return result
         return wrapper
\ No newline at end of file
@@ -1,47 +1,174 @@
-import logging
-from uuid import uuid4
+import json
+import os
+import time
+from threading import Thread
 
-from pathtools.patterns import match_path
-from watchdog.events import EVENT_TYPE_CREATED
+from watchdog.events import EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED
 from watchdog.events import FileSystemEventHandler
 
+from lib.file_stabilizer import FileStabilizer
+from lib.fingerprint import get_fingerprint
+from lib.ingestion import IngestionQueue
 from lib.media_file_state import MediaFileState
-from lib.connection_manager import ConnectionManager
+from lib.observers import FileClosedEvent
 from lib import logger
+from lib import tracing
 
 
 class MediaFilesEventHandler(FileSystemEventHandler):
+    INGESTION_QUEUE_CAPACITY = 10000
+    INGESTION_BATCH_SIZE = 500
+
     mfq = None
-    include_pattern = None
-    exclude_pattern = None
-    case_sensitive = None
+    matcher = None
 
-    def __init__(self, mfq, include_pattern, exclude_pattern, case_sensitive, reprocess):
+    def __init__(self, mfq, matcher, reprocess, stable_period, journal_file, prober=None):
         self.mfq = mfq
-        self.include_pattern = include_pattern
-        self.exclude_pattern = exclude_pattern
-        self.case_sensitive = case_sensitive
+        self.matcher = matcher
+        self.prober = prober
         self.reprocess = reprocess
+        self.journal_file = journal_file
+        self.stabilizer = FileStabilizer(stable_period)
+        self.ingestion_queue = IngestionQueue(self.INGESTION_QUEUE_CAPACITY)
+        self.ingestion_thread = Thread(target=self.__ingest, name='lib.ingestion')
+        self.ingestion_thread.setDaemon(True)
+        self.backpressure_reported = False
+
+    def start(self):
+        self.__load_journal()
+        self.ingestion_thread.start()
+
+    def stop(self):
+        self.ingestion_queue.close()
+        self.ingestion_thread.join()
+        self.__save_journal()
 
     def on_any_event(self, event):
         if not event.is_directory \
-                and match_path(event.src_path,
-                               included_patterns=self.include_pattern,
-                               excluded_patterns=self.exclude_pattern,
-                               case_sensitive=self.case_sensitive) \
-                and event.event_type == EVENT_TYPE_CREATED:
+                and (event.event_type != EVENT_TYPE_MODIFIED or isinstance(event, FileClosedEvent)):
+            # a move isn't replaced by the events of a new file at its source path
+            self.ingestion_queue.put((event.event_type, event.src_path, event.dest_path)
+                                     if event.event_type == EVENT_TYPE_MOVED else event.src_path, event)
+
+    def stats(self):
+        result = self.ingestion_queue.stats()
+        result['pending_stabilization'] = len(self.stabilizer)
+        return result
+
+    def get_backlog(self):
+        return {('ingestion',): len(self.ingestion_queue), ('stabilization',): len(self.stabilizer)}
+
+    def __ingest(self):
+        next_tick = time.time() + self.stabilizer.tick
+        while not self.ingestion_queue.is_drained():
+            for event in self.ingestion_queue.get_batch(self.INGESTION_BATCH_SIZE,
+                                                        max(next_tick - time.time(), 0)):
+                self.__route(event)
+            self.__report_backpressure()
+
+            if time.time() >= next_tick:
+                next_tick = time.time() + self.stabilizer.tick
+                stable_file_paths = self.stabilizer.advance()
+                if stable_file_paths:
+                    self.__add_stable_files(stable_file_paths)
+
+    def __route(self, event):
+        try:
+            if event.event_type == EVENT_TYPE_MOVED:
+                if self.__matches(event.src_path) or self.__matches(event.dest_path):
+                    self.__move(self.__decode(event.src_path), self.__decode(event.dest_path),
+                                self.__matches(event.dest_path))
+            elif self.__matches(event.src_path):
+                file_path = self.__decode(event.src_path)
+                if event.event_type == EVENT_TYPE_CREATED:
+                    self.stabilizer.add(file_path)
+                elif isinstance(event, FileClosedEvent):
+                    self.stabilizer.close(file_path)
+                elif event.event_type == EVENT_TYPE_DELETED:
+                    self.stabilizer.discard(file_path)
+                    if self.mfq.mark_deleted(file_path):
+                        logger.info("File [{}] in processing queue was deleted".format(file_path))
+        except Exception:
+            logger.exception("An error occurred during handling of [{}] event for [{}]".format(
+                event.event_type, event.src_path))
+
+    def __move(self, src_path, dest_path, dest_matches):
+        if src_path in self.stabilizer:
+            if dest_matches:
+                self.stabilizer.move(src_path, dest_path)
+            else:
+                self.stabilizer.discard(src_path)
+        elif self.mfq.move(src_path, dest_path):
+            logger.info("File [{}] in processing queue was moved to [{}]".format(src_path, dest_path))
+        elif dest_matches:
+            self.stabilizer.add(dest_path)
+
+    def __matches(self, path):
+        return self.matcher.match(path)
+
+    @staticmethod
+    def __decode(path):
+        return path if isinstance(path, unicode) else path.decode('utf-8')
+
+    def __add_stable_files(self, file_paths):
+        for file_paths_chunk in [file_paths[i:i + self.INGESTION_BATCH_SIZE]
+                                 for i in range(0, len(file_paths), self.INGESTION_BATCH_SIZE)]:
             try:
-                file_path = event.src_path.decode('utf-8')
-                media_file = self.add_to_processing_queue(file_path)
-                if media_file:
-                    logger.info("File [{}] added to processing queue".format(media_file.identifier))
+                media_info = {}
+                inspect_times = {}
+                # media files already in processing queue are requeued as they are, only new ones are inspected
+                for file_path in self.mfq.get_new_file_paths(file_paths_chunk):
+                    inspect_started = time.time()
+                    media_info[file_path] = self.__inspect(file_path)
+                    inspect_times[file_path] = inspect_started, time.time()
+                for media_file in self.mfq.add_all(file_paths_chunk, self.reprocess, media_info):
+                    if media_file.file_path in inspect_times:
+                        tracing.record('probe', media_file, *inspect_times[media_file.file_path])
+                    if media_file.status == MediaFileState.SKIPPED:
+                        logger.info("File [{}] skipped, {}".format(media_file.identifier, media_file.skip_reason))
+                    else:
+                        logger.info("File [{}] added to processing queue".format(media_file.identifier))
                     logger.debug(media_file)
             except Exception:
-                logger.exception("An error occurred during adding of [{}] to processing queue".format(file_path))
-
-    @ConnectionManager.connection(transaction=True)
-    def add_to_processing_queue(self, file_path):
-        if file_path not in self.mfq or self.reprocess:
-            id = uuid4()
-            self.mfq[id, file_path] = MediaFileState.WAITING
-            return self.mfq[id, file_path]
+                logger.exception("An error occurred during adding of {} to processing queue, retrying after the "
+                                 "stable period".format(file_paths_chunk))
+                for file_path in file_paths_chunk:
+                    self.stabilizer.add(file_path)
+
+    def __inspect(self, file_path):
+        media_info = self.prober.probe(file_path) if self.prober else {}
+        try:
+            media_info['fingerprint'] = get_fingerprint(file_path)
+        except (IOError, OSError):
+            logger.warn("Unable to fingerprint media file [{}]".format(file_path))
+        media_info['profile'] = self.mfq.profiles.match(file_path, media_info).name
+        return media_info
+
+    def __report_backpressure(self):
+        stats = self.ingestion_queue.stats()
+        if stats['size'] >= stats['capacity'] and not self.backpressure_reported:
+            logger.warn("File system events ingestion queue is full, slowing down the observers: {}".format(stats))
+            self.backpressure_reported = True
+        elif stats['size'] == 0 and self.backpressure_reported:
+            logger.info("File system events ingestion queue drained: {}".format(stats))
+            self.backpressure_reported = False
+
+    def __load_journal(self):
+        try:
+            with open(self.journal_file) as f:
+                file_paths = json.load(f)
+            os.remove(self.journal_file)
+        except (IOError, OSError, ValueError):
+            return
+        for file_path in file_paths:
+            self.stabilizer.add(file_path)
+        logger.info("[{}] media files pending stabilization restored from [{}]".format(
+            len(file_paths), self.journal_file))
+
+    def __save_journal(self):
+        file_paths = self.stabilizer.file_paths()
+        if file_paths:
+            with open(self.journal_file, 'w') as f:
+                json.dump(file_paths, f)
+            logger.info("[{}] media files pending stabilization saved to [{}]".format(
+                len(file_paths), self.journal_file))
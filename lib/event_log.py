@@ -0,0 +1,70 @@
+import datetime
+import json
+import socket
+
+from peewee import Proxy, Model, AutoField, DateTimeField, CharField, TextField, chunked
+
+from lib.connection_manager import ConnectionManager
+
+proxy = Proxy()
+
+
+class Event(Model):
+    id = AutoField(column_name='id')
+    date = DateTimeField(column_name='date')
+    node = CharField(column_name='node')
+    type = CharField(column_name='type')
+    data = TextField(column_name='data')
+
+    class Meta:
+        database = proxy
+        table_name = 'events'
+
+    def dict(self):
+        result = json.loads(self.data)
+        result['date'] = self.date.isoformat()
+        result['node'] = self.node
+        return result
+
+
+class EventLog(object):
+    """Change log of media files and nodes kept in the shared database, so changes made by any node can be
+    followed by the others. Events are kept for MAX_EVENT_AGE, and the last MAX_EVENTS ones for longer."""
+
+    MAX_EVENTS = 10000
+    MAX_EVENT_AGE = datetime.timedelta(days=1)
+    SQLITE_MAX_VARIABLES = 999
+
+    def __init__(self):
+        ConnectionManager.initialize_proxy(proxy)
+        self.__create_table()
+
+    @ConnectionManager.connection(transaction=True)
+    def __create_table(self):
+        Event.create_table(True)
+        ConnectionManager.migrate_table(Event)
+
+    def append(self, event_type, **data):
+        self.append_all(event_type, [data])
+
+    @ConnectionManager.connection(transaction=True)
+    def append_all(self, event_type, data_list):
+        now = datetime.datetime.now()
+        hostname = socket.gethostname()
+        rows = [{'date': now, 'node': hostname, 'type': event_type, 'data': json.dumps(data)} for data in data_list]
+        for rows_chunk in chunked(rows, self.SQLITE_MAX_VARIABLES // 4):
+            Event.insert_many(rows_chunk).execute()
+
+    @ConnectionManager.connection
+    def since(self, event_id, limit=1000):
+        return list(Event.select().where(Event.id > event_id).order_by(Event.id).limit(limit))
+
+    @ConnectionManager.connection
+    def last_id(self):
+        return Event.select(Event.id).order_by(Event.id.desc()).scalar() or 0
+
+    @ConnectionManager.connection(transaction=True)
+    def trim(self):
+        # a bulk change logs an event per media file, those are kept until every node had the time to read them
+        return Event.delete().where((Event.id <= self.last_id() - self.MAX_EVENTS) &
+                                    (Event.date < datetime.datetime.now() - self.MAX_EVENT_AGE)).execute()
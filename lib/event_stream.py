@@ -0,0 +1,131 @@
+from collections import deque
+from threading import Thread, Condition
+
+from lib import logger
+from lib.exceptions import TooManySubscribersError
+
+
+class Subscription(object):
+    """Events handed to a subscribed client, closing it frees the subscriber slot even if it was never iterated."""
+
+    def __init__(self, event_stream, events):
+        self.event_stream = event_stream
+        self.events = events
+        self.closed = False
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        self.events.close()
+        with self.event_stream.condition:
+            if not self.closed:
+                self.closed = True
+                self.event_stream.subscribers -= 1
+
+
+class EventStream(Thread):
+    """Follows the event log of the shared database and hands new events to subscribed clients.
+
+    The last events are kept in a ring buffer so clients resuming from an event id are served from memory, older
+    events are read back from the event log. Events trimmed from the event log before being read are replaced by a
+    reset event, after which clients should reload the processing queue.
+    """
+
+    POLL_INTERVAL = 1
+    WAIT_TIMEOUT = 5
+    BATCH_SIZE = 1000
+
+    def __init__(self, event_log, buffer_size=1000, max_subscribers=4, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.daemon = True
+        self.event_log = event_log
+        self.events = deque(maxlen=buffer_size)
+        self.last_id = event_log.last_id()
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+        self.stopped = False
+        self.condition = Condition()
+        self.__listeners = []
+        self.__reset_listeners = []
+
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    def add_reset_listener(self, listener):
+        self.__reset_listeners.append(listener)
+
+    def run(self):
+        while not self.stopped:
+            events = []
+            try:
+                events = self.event_log.since(self.last_id, self.BATCH_SIZE)
+                if events:
+                    missed = self.__get_missed(self.last_id, events)
+                    with self.condition:
+                        if missed:
+                            self.events.append(missed)
+                        self.events.extend((event.id, event.type, event.dict()) for event in events)
+                        self.last_id = events[-1].id
+                        self.condition.notify_all()
+                    if missed:
+                        logger.warn("Events [{}-{}] were trimmed from the event log before being read".format(
+                            *missed[2]['missed']))
+                        for listener in self.__reset_listeners:
+                            listener()
+                    for listener in self.__listeners:
+                        listener(events)
+            except Exception:
+                logger.exception("Unable to read the event log")
+            # a full batch means more events are waiting
+            if len(events) < self.BATCH_SIZE:
+                with self.condition:
+                    if not self.stopped:
+                        self.condition.wait(self.POLL_INTERVAL)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.join()
+
+    def subscribe(self, last_event_id=None):
+        """Subscription to the events after `last_event_id`(only new ones when not given) as (id, type, data)
+        tuples; None is yielded every WAIT_TIMEOUT seconds without events."""
+        with self.condition:
+            if self.subscribers >= self.max_subscribers:
+                raise TooManySubscribersError('too many subscribers')
+            self.subscribers += 1
+        return Subscription(self, self.__iter_events(self.last_id if last_event_id is None else last_event_id))
+
+    @staticmethod
+    def __get_missed(last_event_id, events):
+        # event ids have no holes, except for the events trimmed from the event log
+        if events[0].id > last_event_id + 1:
+            return events[0].id - 1, 'reset', {'missed': [last_event_id + 1, events[0].id - 1]}
+        return None
+
+    def __iter_events(self, last_event_id):
+        # an id from ahead of this node, or from a cleared event log, resumes from the last known event
+        last_event_id = min(last_event_id, self.last_id)
+        while not self.stopped:
+            with self.condition:
+                if self.last_id <= last_event_id:
+                    self.condition.wait(self.WAIT_TIMEOUT)
+                if self.last_id <= last_event_id:
+                    events = []
+                elif self.events and self.events[0][0] <= last_event_id + 1:
+                    events = [event for event in self.events if event[0] > last_event_id]
+                else:
+                    events = None
+            if events is None:
+                # the client is further behind than the ring buffer
+                log_events = self.event_log.since(last_event_id, self.BATCH_SIZE)
+                missed = self.__get_missed(last_event_id, log_events) if log_events else None
+                events = ([missed] if missed else []) + [(event.id, event.type, event.dict()) for event in log_events]
+            if events:
+                for event in events:
+                    yield event
+                last_event_id = events[-1][0]
+            elif not self.stopped:
+                yield None
@@ -4,3 +4,11 @@ class HandbreakProcessInterrupted(Exception):
 
 class MediaProcessingNonRecoverableError(Exception):
     pass
+
+
+class TooManySubscribersError(Exception):
+    pass
+
+
+class MediaFileClaimLostError(Exception):
+    pass
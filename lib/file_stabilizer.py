@@ -0,0 +1,91 @@
+import math
+import os
+
+
+class PendingFile(object):
+    __slots__ = ('stat', 'slot', 'closed')
+
+    def __init__(self, stat):
+        self.stat = stat
+        self.slot = None
+        self.closed = False
+
+
+class FileStabilizer(object):
+    """Holds new files until their size and modification time stop changing.
+
+    Pending files are kept on a time wheel: a ring of buckets advanced once per tick, so scheduling and expiring
+    a check costs the same for ten or ten thousand pending files.
+    """
+
+    def __init__(self, stable_period, tick=1.0):
+        self.tick = tick
+        self.wheel = [set() for _ in range(max(int(math.ceil(float(stable_period) / tick)), 1) + 1)]
+        self.position = 0
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, file_path):
+        return file_path in self.pending
+
+    def file_paths(self):
+        return list(self.pending)
+
+    def add(self, file_path):
+        if file_path not in self.pending:
+            self.pending[file_path] = PendingFile(self.__stat(file_path))
+            self.__schedule(file_path, len(self.wheel) - 1)
+
+    def close(self, file_path):
+        pending_file = self.pending.setdefault(file_path, PendingFile(None))
+        pending_file.closed = True
+        self.__schedule(file_path, 1)
+
+    def move(self, src_path, dest_path):
+        pending_file = self.pending.get(src_path)
+        if pending_file:
+            self.discard(src_path)
+            self.add(dest_path)
+            if pending_file.closed:
+                self.close(dest_path)
+
+    def discard(self, file_path):
+        pending_file = self.pending.pop(file_path, None)
+        if pending_file:
+            self.wheel[pending_file.slot].discard(file_path)
+
+    def advance(self):
+        self.position = (self.position + 1) % len(self.wheel)
+        due_file_paths = self.wheel[self.position]
+        self.wheel[self.position] = set()
+
+        stable_file_paths = []
+        for file_path in due_file_paths:
+            pending_file = self.pending[file_path]
+            current_stat = self.__stat(file_path)
+            if current_stat is None:
+                del self.pending[file_path]
+            elif pending_file.closed or pending_file.stat == current_stat:
+                del self.pending[file_path]
+                stable_file_paths.append(file_path)
+            else:
+                pending_file.stat = current_stat
+                self.__schedule(file_path, len(self.wheel) - 1)
+        return stable_file_paths
+
+    def __schedule(self, file_path, ticks):
+        pending_file = self.pending[file_path]
+        if pending_file.slot is not None:
+            self.wheel[pending_file.slot].discard(file_path)
+        pending_file.slot = (self.position + ticks) % len(self.wheel)
+        self.wheel[pending_file.slot].add(file_path)
+
+    @staticmethod
+    def __stat(file_path):
+        try:
+            stat = os.stat(file_path)
+            return stat.st_size, stat.st_mtime
+        except OSError:
+            return None
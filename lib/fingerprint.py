@@ -0,0 +1,30 @@
+import hashlib
+import os
+
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+FINGERPRINT_MIDDLE_BLOCKS = 3
+
+
+def get_fingerprint(file_path, block_size=FINGERPRINT_BLOCK_SIZE, middle_blocks=FINGERPRINT_MIDDLE_BLOCKS):
+    """Sampled content fingerprint: the size plus the head, the tail and a few evenly spaced middle blocks, so
+    fingerprinting a file of any size reads at most (middle_blocks + 2) * block_size bytes."""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        digest.update(str(size))
+        if size <= (middle_blocks + 2) * block_size:
+            digest.update(f.read())
+        else:
+            offsets = [0] + [size * (i + 1) // (middle_blocks + 1) for i in range(middle_blocks)] + \
+                      [size - block_size]
+            for offset in offsets:
+                f.seek(offset)
+                digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def get_command_digest(command, output_file_extension):
+    # commands read from a profiles file are unicode, the ones from the command line byte strings
+    command, output_file_extension = [value.decode('utf-8') if isinstance(value, str) else value
+                                      for value in (command, output_file_extension)]
+    return hashlib.sha1(u'{}\n{}'.format(command, output_file_extension).encode('utf-8')).hexdigest()
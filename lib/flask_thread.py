@@ -1,13 +1,196 @@
-from threading import Thread
+import os
+import select
+import socket
+import time
+from Queue import Queue, Full
+from threading import Thread, Lock
 
-from werkzeug.serving import make_server
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from lib import logger
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    # persistent connections, closed after being idle for the server request timeout
+    protocol_version = 'HTTP/1.1'
+    # status line, headers and body are sent at once, small responses aren't held back by delayed acknowledgements
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        # a single request, between requests the server parks the connection instead of holding a thread
+        self.close_connection = 1
+        try:
+            self.handle_one_request()
+        except (socket.error, socket.timeout) as e:
+            self.connection_dropped(e)
+            self.close_connection = 1
+
+    def finish(self):
+        if not self.close_connection:
+            try:
+                self.wfile.flush()
+                return
+            except socket.error:
+                self.close_connection = 1
+        WSGIRequestHandler.finish(self)
+
+    def has_buffered_input(self):
+        # a pipelined request already read into the buffer isn't seen by select
+        buffer = getattr(self.rfile, '_rbuf', None)
+        return buffer is not None and buffer.tell() > 0
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """WSGI server handling requests on a fixed number of threads.
+
+    Requests received while every thread is busy wait in a bounded backlog, once it's full they are answered with 503
+    right away. Idle keep-alive connections don't hold a thread, they are watched by a single thread until their next
+    request arrives; past MAX_IDLE_CONNECTIONS the longest idle ones are closed.
+    """
+
+    multithread = True
+    # select can't watch file descriptors past FD_SETSIZE(1024), poll is used where available
+    MAX_IDLE_CONNECTIONS = 512
+    SERVICE_UNAVAILABLE = 'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+    def __init__(self, host, port, app, threads=8, backlog=64, request_timeout=30):
+        BaseWSGIServer.__init__(self, host, port, app, handler=KeepAliveRequestHandler)
+        self.request_timeout = request_timeout
+        self.requests = Queue(backlog)
+        self.idle_connections = {}
+        self.idle_lock = Lock()
+        self.wakeup_reader, self.wakeup_writer = os.pipe()
+        self.closed = False
+        self.workers = [Thread(target=self.__process_requests, name='{}-{}'.format(__name__, i))
+                        for i in range(threads)]
+        self.workers.append(Thread(target=self.__watch_idle_connections, name='{}-idle'.format(__name__)))
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.__dispatch((request, client_address))
+
+    def server_close(self):
+        BaseWSGIServer.server_close(self)
+        self.closed = True
+        os.write(self.wakeup_writer, '\0')
+        for _ in self.workers:
+            self.requests.put(None)
+
+    def __dispatch(self, item):
+        try:
+            self.requests.put_nowait(item)
+        except Full:
+            if isinstance(item, KeepAliveRequestHandler):
+                request, client_address = item.request, item.client_address
+                item.close_connection = 1
+                item.finish()
+            else:
+                request, client_address = item
+            logger.warn("REST API is busy, rejecting request from [{}]".format(client_address[0]))
+            try:
+                request.sendall(self.SERVICE_UNAVAILABLE)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+    def __park(self, handler):
+        if handler.has_buffered_input():
+            self.__dispatch(handler)
+            return
+        with self.idle_lock:
+            self.idle_connections[handler.connection] = handler, time.time() + self.request_timeout
+            excess = sorted(self.idle_connections.items(), key=lambda item: item[1][1])[
+                :max(len(self.idle_connections) - self.MAX_IDLE_CONNECTIONS, 0)]
+            for connection, _ in excess:
+                del self.idle_connections[connection]
+        for _, (idle_handler, _) in excess:
+            self.__close(idle_handler)
+        os.write(self.wakeup_writer, '\0')
+
+    def __close(self, handler):
+        handler.close_connection = 1
+        handler.finish()
+        self.shutdown_request(handler.request)
+
+    def __process_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            if isinstance(item, KeepAliveRequestHandler):
+                handler = item
+                request, client_address = handler.request, handler.client_address
+            else:
+                handler = None
+                request, client_address = item
+            try:
+                if handler:
+                    handler.handle()
+                    handler.finish()
+                else:
+                    handler = self.RequestHandlerClass(request, client_address, self)
+            except Exception:
+                handler = None
+                self.handle_error(request, client_address)
+            if handler and not handler.close_connection and not self.closed:
+                self.__park(handler)
+            else:
+                self.shutdown_request(request)
+
+    def __wait_readable(self, connections, timeout):
+        if not hasattr(select, 'poll'):
+            return select.select(connections + [self.wakeup_reader], [], [], timeout)[0]
+        poller = select.poll()
+        by_fd = {self.wakeup_reader: self.wakeup_reader}
+        poller.register(self.wakeup_reader, select.POLLIN)
+        for connection in connections:
+            try:
+                by_fd[connection.fileno()] = connection
+                poller.register(connection, select.POLLIN)
+            except socket.error:
+                # closed since it was parked, it's dropped as expired or ready
+                continue
+        return [by_fd[fd] for fd, _ in poller.poll(timeout * 1000)]
+
+    def __watch_idle_connections(self):
+        while not self.closed:
+            try:
+                with self.idle_lock:
+                    connections = list(self.idle_connections)
+                    timeout = min([deadline for _, deadline in self.idle_connections.values()] or
+                                  [time.time() + self.request_timeout]) - time.time()
+                readable = self.__wait_readable(connections, max(timeout, 0))
+                if self.wakeup_reader in readable:
+                    os.read(self.wakeup_reader, 4096)
+
+                now = time.time()
+                with self.idle_lock:
+                    ready = [self.idle_connections.pop(connection)[0] for connection in readable
+                             if connection in self.idle_connections]
+                    expired = [connection for connection, (_, deadline) in self.idle_connections.items()
+                               if deadline <= now or self.closed]
+                    expired = [self.idle_connections.pop(connection)[0] for connection in expired]
+                for handler in ready:
+                    self.__dispatch(handler)
+                for handler in expired:
+                    self.__close(handler)
+            except Exception:
+                logger.exception("Unable to watch idle REST API connections")
+                time.sleep(1)
 
 
 class FlaskAppWrapper(Thread):
 
-    def __init__(self, app, **kwargs):
+    def __init__(self, app, host='0.0.0.0', port=6767, threads=8, request_timeout=30, **kwargs):
         Thread.__init__(self, **kwargs)
-        self.srv = make_server('0.0.0.0', 6767, app)
+        self.srv = ThreadPoolWSGIServer(host, port, app, threads, request_timeout=request_timeout)
         self.ctx = app.app_context()
         self.ctx.push()
 
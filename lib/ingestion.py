@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from threading import Condition
+
+
+class IngestionQueue(object):
+    """Bounded queue of file system events, coalesced by key so only the latest event per key is kept, in the
+    position of the latest one.
+
+    A producer blocks while the queue is full, which pushes back on the observer instead of growing without bounds.
+    After the queue is closed producers are never blocked, so no event is lost while it's being drained.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.events = OrderedDict()
+        self.condition = Condition()
+        self.closed = False
+
+        self.received = 0
+        self.coalesced = 0
+        self.blocked_puts = 0
+        self.blocked_time = 0.0
+        self.high_watermark = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def put(self, key, event):
+        with self.condition:
+            self.received += 1
+            if key in self.events:
+                del self.events[key]
+                self.events[key] = event
+                self.coalesced += 1
+                return
+
+            if len(self.events) >= self.capacity and not self.closed:
+                self.blocked_puts += 1
+                started = time.time()
+                while len(self.events) >= self.capacity and not self.closed:
+                    self.condition.wait()
+                self.blocked_time += time.time() - started
+
+            self.events[key] = event
+            self.high_watermark = max(self.high_watermark, len(self.events))
+            self.condition.notify_all()
+
+    def get_batch(self, max_size, timeout):
+        with self.condition:
+            if not self.events and not self.closed:
+                self.condition.wait(timeout)
+            batch = []
+            while self.events and len(batch) < max_size:
+                batch.append(self.events.popitem(last=False)[1])
+            if batch:
+                self.condition.notify_all()
+            return batch
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def is_drained(self):
+        with self.condition:
+            return self.closed and not self.events
+
+    def stats(self):
+        with self.condition:
+            return {
+                'size': len(self.events),
+                'capacity': self.capacity,
+                'high_watermark': self.high_watermark,
+                'received': self.received,
+                'coalesced': self.coalesced,
+                'blocked_puts': self.blocked_puts,
+                'blocked_time': self.blocked_time
+            }
@@ -1,5 +1,6 @@
 import logging
 import os
+import re
 import select
 import signal
 import subprocess
@@ -7,12 +8,17 @@ from threading import Thread
 
 
 class InterruptableSystemCommandThread(Thread):
+    READ_SIZE = 4096
+    # progress reports are usually rewritten in place with a carriage return
+    LINE_PATTERN = re.compile(r'([^\r\n]*)(\r\n|\r|\n)')
+    PROGRESS_PATTERN = re.compile(r'(\d+(?:\.\d+)?) ?%')
+    FPS_PATTERN = re.compile(r'(\d+(?:\.\d+)?) fps')
 
     def __init__(self, command, env, stdout_log_level=logging.INFO,
-                 stderr_log_level=logging.ERROR, **kwargs):
+                 stderr_log_level=logging.ERROR, logger_name=__name__, **kwargs):
         Thread.__init__(self, **kwargs)
 
-        self.logger = logging.getLogger(__name__)
+        self.logger = logging.getLogger(logger_name)
 
         self.interrupted = False
         self.exit_code = None
@@ -27,18 +33,25 @@ class InterruptableSystemCommandThread(Thread):
         self.stderr_log_level = stderr_log_level
         self.call_process = None
         self.log_levels = {}
+        self.buffers = {}
         self.suspended = False
+        self.progress = None
+        self.fps = None
 
     def run(self):
         self.call_process = subprocess.Popen(self.command, env=self.env, shell=True, stdout=subprocess.PIPE,
                                              stderr=subprocess.PIPE, stdin=subprocess.PIPE, preexec_fn=os.setpgrp)
         self.log_levels = {self.call_process.stdout: self.stdout_log_level,
                            self.call_process.stderr: self.stderr_log_level}
+        self.buffers = {self.call_process.stdout: '', self.call_process.stderr: ''}
 
         while self.call_process.poll() is None:
             self.__check_io()
 
-        self.__check_io()
+        while self.__check_io(0):
+            pass
+        for io, buffer in self.buffers.items():
+            self.__log_line(io, buffer, False)
         self.exit_code = self.call_process.wait()
 
     def kill(self, soft_kill=True):
@@ -65,8 +78,27 @@ class InterruptableSystemCommandThread(Thread):
         else:
             raise Exception("process is already running")
 
-    def __check_io(self):
-        ready_to_read = select.select([self.call_process.stdout, self.call_process.stderr], [], [], 1)[0]
+    def __check_io(self, timeout=1):
+        read = False
+        ready_to_read = select.select([self.call_process.stdout, self.call_process.stderr], [], [], timeout)[0]
         for io in ready_to_read:
-            line = io.readline()
-            self.logger.log(self.log_levels[io], line[:-1])
+            chunk = os.read(io.fileno(), self.READ_SIZE)
+            if chunk:
+                read = True
+                data = self.buffers[io] + chunk
+                end = 0
+                for match in self.LINE_PATTERN.finditer(data):
+                    end = match.end()
+                    self.__log_line(io, match.group(1), match.group(2) == '\r')
+                self.buffers[io] = data[end:]
+        return read
+
+    def __log_line(self, io, line, rewritten):
+        if line:
+            progress = self.PROGRESS_PATTERN.search(line)
+            if progress:
+                self.progress = float(progress.group(1))
+            fps = self.FPS_PATTERN.search(line)
+            if fps:
+                self.fps = float(fps.group(1))
+            self.logger.log(logging.DEBUG if rewritten else self.log_levels[io], line)
@@ -2,7 +2,8 @@ import uuid
 from datetime import datetime
 
 from humanize import naturalsize, naturaltime
-from peewee import Proxy, Model, UUIDField, DateTimeField, TextField, BigIntegerField
+from peewee import Proxy, Model, UUIDField, DateTimeField, TextField, BigIntegerField, CharField, IntegerField, \
+    FloatField
 
 from lib.media_file_state import MediaFileStateField, MediaFileState
 
@@ -22,7 +23,7 @@ class BaseModel(Model):
 class MediaFile(BaseModel):
     id = UUIDField(column_name='id', index=True, unique=True, primary_key=True)
     file_path = TextField(column_name='file_path', index=True, unique=True)
-    transcoded_file_path = TextField(column_name='transcoded_file_path')
+    transcoded_file_path = TextField(column_name='transcoded_file_path', index=True)
     log_file_path = TextField(column_name='log_file_path')
     status = MediaFileStateField(column_name='status')
     file_size = BigIntegerField(column_name='file_sizes')
@@ -30,7 +31,20 @@ class MediaFile(BaseModel):
     date_added = DateTimeField(column_name='date_added')
     last_modified = DateTimeField(column_name='last_modified', index=True)
     date_started = DateTimeField(column_name='date_started', null=True)
+    date_encoded = DateTimeField(column_name='date_encoded', null=True)
     date_finished = DateTimeField(column_name='date_finished', null=True)
+    processing_node = CharField(column_name='processing_node', index=True, null=True)
+    claim_token = CharField(column_name='claim_token', null=True)
+    date_deleted = DateTimeField(column_name='date_deleted', null=True)
+    video_codec = CharField(column_name='video_codec', null=True)
+    width = IntegerField(column_name='width', null=True)
+    height = IntegerField(column_name='height', null=True)
+    duration = FloatField(column_name='duration', null=True)
+    bit_rate = BigIntegerField(column_name='bit_rate', null=True)
+    skip_reason = TextField(column_name='skip_reason', null=True)
+    fingerprint = CharField(column_name='fingerprint', index=True, null=True)
+    command_digest = CharField(column_name='command_digest', null=True)
+    profile = CharField(column_name='profile', index=True, null=True)
 
     def __repr__(self):
         return "<{klass} @{id:x} {attrs}>".format(
@@ -1,41 +1,102 @@
 import logging
 import os
+import socket
+import time
 from threading import Thread
 from threading import Timer
 
-from lib.exceptions import HandbreakProcessInterrupted
+from lib.exceptions import HandbreakProcessInterrupted, MediaFileClaimLostError
 from lib.interruptable_system_command import InterruptableSystemCommandThread
 from lib.media_file_state import MediaFileState
 from lib.connection_manager import ConnectionManager
+from lib.staging import link_file
 from lib import logger
+from lib import metrics
+from lib import tracing
+
+
+def get_command_logger_name(slot):
+    if slot:
+        return '{}.{}'.format(InterruptableSystemCommandThread.__module__, slot)
+    return InterruptableSystemCommandThread.__module__
+
+
+def configure_command_logger(logger_name, log_file_path):
+    command_logger = logging.getLogger(logger_name)
+    formatter = logging.Formatter('[%(asctime)-15s] [%(levelname)s]: %(message)s')
+    file_handler = logging.FileHandler(filename=log_file_path, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    for handler in command_logger.handlers:
+        handler.close()
+    command_logger.handlers = [file_handler]
+    command_logger.propagate = False
+    command_logger.setLevel(logger.level)
+
+
+def delete_original_file(mfq, media_file):
+    # the source file could have been moved while it was processed
+    file_path = mfq[media_file.id].file_path
+    logger.debug("Removing the source file [{}]".format(file_path))
+    os.remove(file_path)
+
 
 class MediaProcessingThread(Thread):
 
     def __init__(self,
                  mfq,
-                 handbreak_command,
                  handbreak_timeout,
                  delete_orig_file,
+                 staging_area=None,
+                 prefetcher=None,
+                 post_stages=None,
+                 slot=None,
+                 max_cost=None,
+                 batch_size_threshold=None,
+                 batch_max_files=1,
                  **kwargs):
         Thread.__init__(self, **kwargs)
 
         self.system_call_thread = None
         self.current_processing_file = None
+        self.batch = []
+        self.idle = False
+        self.stopped = False
+        self.suspended = False
+        self.slot = slot
+        self.command_logger_name = get_command_logger_name(slot)
         self.mfq = mfq
-        self.handbreak_command = handbreak_command
         self.handbreak_timeout = handbreak_timeout
         self.delete_orig_file = delete_orig_file
+        self.staging_area = staging_area
+        self.prefetcher = prefetcher
+        self.post_stages = post_stages
+        self.max_cost = max_cost
+        # until a media file is claimed the thread reserves all the cost it's allowed to take
+        self.cost = max_cost if max_cost is not None else float('inf')
+        self.batch_size_threshold = batch_size_threshold
+        self.batch_max_files = batch_max_files
 
     def run(self):
         self.__process_media_file()
 
+    @property
+    def progress(self):
+        return self.system_call_thread.progress if self.system_call_thread else None
+
+    @property
+    def fps(self):
+        return self.system_call_thread.fps if self.system_call_thread else None
+
     def join(self, timeout=None):
+        self.stopped = True
         if self.system_call_thread and self.system_call_thread.isAlive():
             self.system_call_thread.kill()
             self.system_call_thread.join()
         super(MediaProcessingThread, self).join(timeout)
 
     def suspend_media_processing(self):
+        # the rest of a batch is left for when media processing resumes
+        self.suspended = True
         try:
             self.system_call_thread.suspend()
             logger.info("Media processing is suspended")
@@ -43,6 +104,7 @@ class MediaProcessingThread(Thread):
             logger.warn("Media processing is already suspended")
 
     def resume_media_processing(self):
+        self.suspended = False
         try:
             self.system_call_thread.resume()
             logger.info("Media processing is resumed")
@@ -50,54 +112,119 @@ class MediaProcessingThread(Thread):
             logger.warn("Media processing is already running")
 
     def __process_media_file(self):
-        self.__get_media_file()
+        prefetched_media_file = self.prefetcher.take(self.max_cost) if self.prefetcher else None
+        claim_started = time.time()
+        self.__get_media_file(prefetched_media_file)
+        claim_finished = time.time()
+        metrics.claim_seconds.observe(claim_finished - claim_started)
+        if prefetched_media_file and (self.current_processing_file is None or
+                                      self.current_processing_file.id != prefetched_media_file.id):
+            self.staging_area.release(prefetched_media_file)
 
-        if self.current_processing_file is not None:
+        if self.current_processing_file is None:
+            self.idle = True
+            return
+
+        for media_file in [self.current_processing_file] + self.batch:
+            tracing.record('claim', media_file, claim_started, claim_finished, slot=self.slot)
+            if not prefetched_media_file or media_file.id != prefetched_media_file.id:
+                # a prefetched media file waited in the queue until the prefetcher claimed it
+                tracing.record('queue_wait', media_file, tracing.to_timestamp(media_file.last_modified),
+                               claim_started, slot=self.slot)
+        interrupted = not self.__process_current_processing_file()
+        while self.batch:
+            if interrupted or self.stopped or self.suspended:
+                self.__return_batch()
+                break
+            self.current_processing_file = self.batch.pop(0)
+            # each media file of the batch is started, and later finished, on its own
             try:
-                logger.info("Processing file [{}]".format(self.current_processing_file.identifier))
-                logger.debug(self.current_processing_file)
+                self.mfq.set_claimed(self.current_processing_file, MediaFileState.PROCESSING)
+            except MediaFileClaimLostError:
+                logger.warn("File [{}] of the batch was claimed by another node, skipping it".format(
+                    self.current_processing_file.identifier))
+                continue
+            interrupted = not self.__process_current_processing_file()
+
+    def __process_current_processing_file(self):
+        media_file = self.current_processing_file
+        try:
+            logger.info("Processing file [{}]".format(self.current_processing_file.identifier))
+            logger.debug(self.current_processing_file)
+            duplicate_media_file = self.mfq.find_processed_duplicate(media_file)
+            if duplicate_media_file and os.path.exists(duplicate_media_file.transcoded_file_path):
+                self.__reuse_transcoded_file(duplicate_media_file)
+            else:
                 self.__execute_handbreak_command()
 
-                logger.info("File [{}] processed successfully".format(self.current_processing_file.identifier))
-                logger.debug(self.current_processing_file)
-                self.mfq[
-                    self.current_processing_file.id, self.current_processing_file.file_path] = MediaFileState.PROCESSED
-                self.current_processing_file = None
-            except HandbreakProcessInterrupted:
-                self.__return_current_processing_file(MediaFileState.WAITING)
-            except Exception:
-                logger.exception(
-                    "File [{}] returning to processing queue after processing error, status [{}]".format(
-                        self.current_processing_file.identifier, MediaFileState.FAILED.value))
-                self.__return_current_processing_file(MediaFileState.FAILED)
+            with tracing.span('state_write', media_file, slot=self.slot):
+                if self.post_stages:
+                    logger.info("File [{}] encoded, status [{}]".format(self.current_processing_file.identifier,
+                                                                       MediaFileState.ENCODED.value))
+                    self.mfq.set_claimed(self.current_processing_file, MediaFileState.ENCODED)
+                else:
+                    logger.info("File [{}] processed successfully".format(self.current_processing_file.identifier))
+                    self.mfq.set_claimed(self.current_processing_file, MediaFileState.PROCESSED)
+            logger.debug(self.current_processing_file)
+            self.current_processing_file = None
+        except HandbreakProcessInterrupted:
+            self.__return_current_processing_file(MediaFileState.WAITING)
+            return False
+        except MediaFileClaimLostError:
+            logger.warn("File [{}] was claimed by another node while it was processed, leaving its state to it".format(
+                self.current_processing_file.identifier))
+            self.current_processing_file = None
+        except Exception:
+            logger.exception(
+                "File [{}] returning to processing queue after processing error, status [{}]".format(
+                    self.current_processing_file.identifier, MediaFileState.FAILED.value))
+            self.__return_current_processing_file(MediaFileState.FAILED)
+        finally:
+            if self.staging_area:
+                self.staging_area.release(media_file)
+        return True
 
     def __execute_handbreak_command(self):
-        handbreak_command_logger = logging.getLogger(InterruptableSystemCommandThread.__module__)
-        formatter = logging.Formatter('[%(asctime)-15s] [%(levelname)s]: %(message)s')
-        file_handler = logging.FileHandler(filename=self.current_processing_file.log_file_path, encoding='utf-8')
-        file_handler.setFormatter(formatter)
-        handbreak_command_logger.handlers = [file_handler]
-        handbreak_command_logger.setLevel(logger.level)
+        configure_command_logger(self.command_logger_name, self.current_processing_file.log_file_path)
+
+        input_file = self.current_processing_file.file_path
+        output_file = self.current_processing_file.transcoded_file_path
+        if self.staging_area:
+            with tracing.span('stage_in', self.current_processing_file, slot=self.slot):
+                input_file, output_file = self.staging_area.stage_in(self.current_processing_file)
 
         current_env = os.environ.copy()
-        current_env["INPUT_FILE"] = self.current_processing_file.file_path
-        current_env["OUTPUT_FILE"] = self.current_processing_file.transcoded_file_path
+        current_env["INPUT_FILE"] = input_file
+        current_env["OUTPUT_FILE"] = output_file
 
-        logger.debug("Handbreak input file: {}".format(self.current_processing_file.file_path))
-        logger.debug("Handbreak output file: {}".format(self.current_processing_file.transcoded_file_path))
+        logger.debug("Handbreak input file: {}".format(input_file))
+        logger.debug("Handbreak output file: {}".format(output_file))
 
-        self.system_call_thread = InterruptableSystemCommandThread(self.handbreak_command,
+        profile = self.mfq.profiles[self.current_processing_file.profile]
+        if profile.name != self.current_processing_file.profile:
+            logger.warn("Profile [{}] of file [{}] no longer exists, processing it with the default profile".format(
+                self.current_processing_file.profile, self.current_processing_file.identifier))
+        logger.debug("Processing profile: {}".format(profile))
+        self.system_call_thread = InterruptableSystemCommandThread(profile.command,
                                                                    env=current_env,
+                                                                   logger_name=self.command_logger_name,
                                                                    name=InterruptableSystemCommandThread.__module__)
 
         timer = Timer(self.handbreak_timeout, self.system_call_thread.kill)
         timer.start()
 
+        encode_started = time.time()
         self.system_call_thread.start()
         self.system_call_thread.join()
+        encode_finished = time.time()
 
         if timer.is_alive():
             timer.cancel()
+            metrics.encode_seconds.inc(encode_finished - encode_started)
+            tracing.record('encode', self.current_processing_file, encode_started, encode_finished,
+                           'ok' if self.system_call_thread.exit_code == 0 else 'error', slot=self.slot,
+                           profile=profile.name, exit_code=self.system_call_thread.exit_code,
+                           interrupted=self.system_call_thread.interrupted or None)
 
             if self.system_call_thread.interrupted:
                 message = "Handbreak process interrupted softly"
@@ -108,29 +235,195 @@ class MediaProcessingThread(Thread):
                     "Handbreak processes failed. Please, check the transcoding log file [{}]"
                         .format(self.current_processing_file.log_file_path))
             else:
+                metrics.encoded_bytes.inc(self.current_processing_file.file_size)
                 logger.debug(
                     "Handbreak process finished successfully, removing the transcoding log file [{}]"
                         .format(self.current_processing_file.log_file_path))
                 os.remove(self.current_processing_file.log_file_path)
-                if self.delete_orig_file:
-                    logger.debug("Removing the source file [{}]".format(self.current_processing_file.file_path))
-                    os.remove(self.current_processing_file.file_path)
+                if self.staging_area:
+                    with tracing.span('stage_out', self.current_processing_file, slot=self.slot):
+                        self.staging_area.stage_out(self.current_processing_file)
+                self.__delete_original_file()
         else:
+            tracing.record('encode', self.current_processing_file, encode_started, encode_finished, 'error',
+                           slot=self.slot, profile=profile.name, timeout=True)
             raise Exception("Handbreak processes killed after {} hours".format(self.handbreak_timeout / 60 / 60))
 
+    def __reuse_transcoded_file(self, duplicate_media_file):
+        logger.info("File [{}] has the same content as the already processed file [{}], reusing its transcoded file"
+                    .format(self.current_processing_file.identifier, duplicate_media_file.identifier))
+        with tracing.span('reuse', self.current_processing_file, slot=self.slot,
+                          duplicate_of=str(duplicate_media_file.id)):
+            link_file(duplicate_media_file.transcoded_file_path, self.current_processing_file.transcoded_file_path)
+        self.__delete_original_file()
+
+    def __delete_original_file(self):
+        # with post processing stages the source file is removed once they all succeed
+        if self.delete_orig_file and not self.post_stages:
+            with tracing.span('delete_original', self.current_processing_file, slot=self.slot):
+                delete_original_file(self.mfq, self.current_processing_file)
+
     @ConnectionManager.connection(transaction=True)
-    def __get_media_file(self):
+    def __get_media_file(self, prefetched_media_file=None):
         try:
-            self.current_processing_file = self.mfq.peek(MediaFileState.WAITING)
-            self.mfq[
-                self.current_processing_file.id, self.current_processing_file.file_path] = MediaFileState.PROCESSING
+            media_file = self.mfq[prefetched_media_file.id] if prefetched_media_file else None
+            if media_file and media_file.status == MediaFileState.PREFETCHING \
+                    and media_file.processing_node == socket.gethostname() \
+                    and media_file.claim_token == prefetched_media_file.claim_token:
+                self.current_processing_file = media_file
+            else:
+                self.current_processing_file = self.mfq.peek(MediaFileState.WAITING,
+                                                             self.mfq.profiles.get_names(self.max_cost))
+            self.mfq.claim(self.current_processing_file, MediaFileState.PROCESSING)
+            self.cost = self.mfq.profiles[self.current_processing_file.profile].cost
         except Exception:
+            self.cost = 0
             logger.warn("Can't obtain media file to process")
+            return
+
+        # short clips are dominated by the fixed cost of each claim and thread, small media files of the same
+        # profile are claimed together and processed one after the other by this thread
+        if self.batch_size_threshold and self.batch_max_files > 1 and not prefetched_media_file \
+                and self.current_processing_file.file_size <= self.batch_size_threshold:
+            self.batch = self.mfq.peek_many(self.batch_max_files - 1,
+                                            MediaFileState.WAITING,
+                                            [self.current_processing_file.profile],
+                                            self.batch_size_threshold)
+            for media_file in list(self.batch):
+                try:
+                    self.mfq.claim(media_file, MediaFileState.PROCESSING)
+                except MediaFileClaimLostError:
+                    self.batch.remove(media_file)
+            if self.batch:
+                logger.debug("Claimed a batch of [{}] more media files".format(len(self.batch)))
+
+    def __return_batch(self):
+        for media_file in self.batch:
+            try:
+                self.mfq.set_claimed(media_file, MediaFileState.WAITING)
+            except MediaFileClaimLostError:
+                continue
+            logger.debug("File [{}] returned to processing queue, status [{}]".format(media_file.identifier,
+                                                                                     MediaFileState.WAITING.value))
+        self.batch = []
 
     def __return_current_processing_file(self, media_file_state):
         if self.current_processing_file is not None:
-            self.mfq[self.current_processing_file.id, self.current_processing_file.file_path] = media_file_state
+            try:
+                self.mfq.set_claimed(self.current_processing_file, media_file_state)
+            except MediaFileClaimLostError:
+                logger.warn("File [{}] was claimed by another node, leaving its state to it".format(
+                    self.current_processing_file.identifier))
+                return
             logger.info(
                 "File [{}] returned to processing queue, status [{}]".format(self.current_processing_file.identifier,
                                                                              media_file_state.value))
             logger.debug(self.current_processing_file)
+
+
+class PostProcessingThread(Thread):
+    """Runs the post processing stages(renames, uploads...) of an encoded media file, one stage after the other."""
+
+    def __init__(self, mfq, post_stages, timeout, delete_orig_file, slot=None, **kwargs):
+        Thread.__init__(self, **kwargs)
+
+        self.system_call_thread = None
+        self.current_processing_file = None
+        self.idle = False
+        self.slot = slot
+        self.command_logger_name = get_command_logger_name(slot)
+        self.mfq = mfq
+        self.post_stages = post_stages
+        self.timeout = timeout
+        self.delete_orig_file = delete_orig_file
+
+    def run(self):
+        claim_started = time.time()
+        self.__get_media_file()
+
+        if self.current_processing_file is None:
+            self.idle = True
+            return
+
+        media_file = self.current_processing_file
+        tracing.record('post_queue_wait', media_file, tracing.to_timestamp(media_file.last_modified), claim_started,
+                       slot=self.slot)
+        tracing.record('post_claim', media_file, claim_started, time.time(), slot=self.slot)
+        try:
+            for stage_name, stage_command in self.post_stages:
+                logger.info("Running [{}] stage for file [{}]".format(stage_name,
+                                                                     self.current_processing_file.identifier))
+                with tracing.span('post_stage', media_file, slot=self.slot, stage=stage_name):
+                    self.__execute_stage_command(stage_name, stage_command)
+            os.remove(self.current_processing_file.log_file_path)
+            if self.delete_orig_file:
+                with tracing.span('delete_original', media_file, slot=self.slot):
+                    delete_original_file(self.mfq, self.current_processing_file)
+
+            logger.info("File [{}] processed successfully".format(self.current_processing_file.identifier))
+            logger.debug(self.current_processing_file)
+            with tracing.span('state_write', media_file, slot=self.slot):
+                self.mfq.set_claimed(self.current_processing_file, MediaFileState.PROCESSED)
+        except HandbreakProcessInterrupted:
+            self.__return_current_processing_file(MediaFileState.ENCODED)
+        except MediaFileClaimLostError:
+            logger.warn("File [{}] was claimed by another node while it was post processed, leaving its state to "
+                        "it".format(self.current_processing_file.identifier))
+        except Exception:
+            logger.exception(
+                "File [{}] returning to processing queue after post processing error, status [{}]".format(
+                    self.current_processing_file.identifier, MediaFileState.FAILED.value))
+            self.__return_current_processing_file(MediaFileState.FAILED)
+
+    def join(self, timeout=None):
+        if self.system_call_thread and self.system_call_thread.isAlive():
+            self.system_call_thread.kill()
+            self.system_call_thread.join()
+        super(PostProcessingThread, self).join(timeout)
+
+    def __execute_stage_command(self, stage_name, stage_command):
+        configure_command_logger(self.command_logger_name, self.current_processing_file.log_file_path)
+
+        current_env = os.environ.copy()
+        current_env["INPUT_FILE"] = self.mfq[self.current_processing_file.id].file_path
+        current_env["OUTPUT_FILE"] = self.current_processing_file.transcoded_file_path
+
+        self.system_call_thread = InterruptableSystemCommandThread(stage_command,
+                                                                   env=current_env,
+                                                                   logger_name=self.command_logger_name,
+                                                                   name=InterruptableSystemCommandThread.__module__)
+
+        timer = Timer(self.timeout, self.system_call_thread.kill)
+        timer.start()
+
+        self.system_call_thread.start()
+        self.system_call_thread.join()
+
+        if not timer.is_alive():
+            raise Exception("[{}] stage process killed after {} hours".format(stage_name, self.timeout / 60 / 60))
+        timer.cancel()
+        if self.system_call_thread.interrupted:
+            raise HandbreakProcessInterrupted("[{}] stage process interrupted softly".format(stage_name))
+        elif self.system_call_thread.exit_code != 0:
+            raise Exception("[{}] stage process failed. Please, check the transcoding log file [{}]".format(
+                stage_name, self.current_processing_file.log_file_path))
+
+    @ConnectionManager.connection(transaction=True)
+    def __get_media_file(self):
+        try:
+            self.current_processing_file = self.mfq.peek(MediaFileState.ENCODED)
+            self.mfq.claim(self.current_processing_file, MediaFileState.POST_PROCESSING)
+        except Exception:
+            self.current_processing_file = None
+
+    def __return_current_processing_file(self, media_file_state):
+        try:
+            self.mfq.set_claimed(self.current_processing_file, media_file_state)
+        except MediaFileClaimLostError:
+            logger.warn("File [{}] was claimed by another node, leaving its state to it".format(
+                self.current_processing_file.identifier))
+            return
+        logger.info(
+            "File [{}] returned to processing queue, status [{}]".format(self.current_processing_file.identifier,
+                                                                         media_file_state.value))
+        logger.debug(self.current_processing_file)
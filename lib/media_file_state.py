@@ -4,9 +4,13 @@ from peewee import CharField
 
 class MediaFileState(Enum):
     PROCESSING = "processing"
+    PREFETCHING = "prefetching"
+    ENCODED = "encoded"
+    POST_PROCESSING = "post-processing"
     PROCESSED = "processed"
     WAITING = "waiting"
     FAILED = "failed"
+    SKIPPED = "skipped"
 
 
 class MediaFileStateField(CharField):
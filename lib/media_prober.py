@@ -0,0 +1,287 @@
+import json
+import operator
+import os
+import re
+import struct
+import subprocess
+from threading import Timer
+
+from lib import logger
+
+MEDIA_INFO_FIELDS = ('video_codec', 'width', 'height', 'duration', 'bit_rate')
+
+CODEC_NAMES = {
+    'avc1': 'h264', 'avc3': 'h264', 'V_MPEG4/ISO/AVC': 'h264',
+    'hvc1': 'hevc', 'hev1': 'hevc', 'V_MPEGH/ISO/HEVC': 'hevc',
+    'av01': 'av1', 'V_AV1': 'av1',
+    'vp09': 'vp9', 'V_VP9': 'vp9',
+    'vp08': 'vp8', 'V_VP8': 'vp8',
+    'mp4v': 'mpeg4', 'V_MPEG4/ISO/ASP': 'mpeg4', 'V_MPEG4/ISO/SP': 'mpeg4',
+    'V_MPEG2': 'mpeg2video', 'V_MS/VFW/FOURCC': 'vfw'
+}
+
+
+class MediaRule(object):
+    """A rule on probed media properties, e.g. [video_codec=hevc|av1,bit_rate<6M].
+
+    All the comma separated conditions must hold; numbers accept k, M and G suffixes.
+    """
+
+    CONDITION_PATTERN = re.compile(r'^\s*(\w+)\s*(!=|<=|>=|=|<|>)\s*(.+?)\s*$')
+    NUMBER_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)([kMG]?)$')
+    MULTIPLIERS = {'': 1, 'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+    OPERATORS = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt,
+                 '>=': operator.ge}
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.conditions = []
+        for condition in rule.split(','):
+            match = self.CONDITION_PATTERN.match(condition)
+            if not match or match.group(1) not in MEDIA_INFO_FIELDS:
+                raise ValueError('invalid media rule condition [{}]'.format(condition))
+            field, operator_name, value = match.groups()
+            if field == 'video_codec':
+                if operator_name not in ('=', '!='):
+                    raise ValueError('invalid media rule condition [{}]'.format(condition))
+                values = [codec.lower() for codec in value.split('|')]
+            else:
+                number = self.NUMBER_PATTERN.match(value)
+                if not number:
+                    raise ValueError('invalid media rule condition [{}]'.format(condition))
+                values = float(number.group(1)) * self.MULTIPLIERS[number.group(2)]
+            self.conditions.append((field, operator_name, values))
+
+    def __repr__(self):
+        return self.rule
+
+    def matches(self, media_info):
+        for field, operator_name, values in self.conditions:
+            value = media_info.get(field)
+            if value is None:
+                return False
+            if field == 'video_codec':
+                if (value.lower() in values) != (operator_name == '='):
+                    return False
+            elif not self.OPERATORS[operator_name](value, values):
+                return False
+        return True
+
+
+class MediaProber(object):
+    """Reads codec, resolution, duration and bit rate of media files from their container headers only.
+
+    An ffprobe compatible command(JSON output of -show_format -show_streams) is used when given, with the built-in
+    MP4 and Matroska header parsers as a fallback.
+    """
+
+    PROBE_TIMEOUT = 30
+
+    def __init__(self, probe_command=None, skip_rules=None):
+        self.probe_command = probe_command
+        self.skip_rules = skip_rules or []
+
+    def probe(self, file_path):
+        media_info = {}
+        try:
+            if self.probe_command:
+                media_info = self.__run_probe_command(file_path)
+        except Exception as e:
+            logger.debug("Probe command failed for [{}]: {}".format(file_path, e))
+        try:
+            if not media_info.get('video_codec'):
+                media_info = parse_media_headers(file_path)
+        except Exception as e:
+            logger.debug("Unable to parse media headers of [{}]: {}".format(file_path, e))
+
+        if media_info.get('duration') and not media_info.get('bit_rate'):
+            media_info['bit_rate'] = int(os.path.getsize(file_path) * 8 / media_info['duration'])
+        for skip_rule in self.skip_rules:
+            if skip_rule.matches(media_info):
+                media_info['skip_reason'] = 'skip rule [{}] matched'.format(skip_rule)
+                break
+        return media_info
+
+    def __run_probe_command(self, file_path):
+        env = os.environ.copy()
+        env['INPUT_FILE'] = file_path
+        process = subprocess.Popen(self.probe_command, env=env, shell=True, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        timer = Timer(self.PROBE_TIMEOUT, process.kill)
+        timer.start()
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            timer.cancel()
+        if process.returncode != 0:
+            raise Exception('exit code [{}]: {}'.format(process.returncode, stderr.strip()))
+
+        result = json.loads(stdout)
+        media_info = {}
+        for stream in result.get('streams', []):
+            if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic'):
+                media_info['video_codec'] = stream.get('codec_name')
+                media_info['width'] = stream.get('width')
+                media_info['height'] = stream.get('height')
+                break
+        media_format = result.get('format', {})
+        if media_format.get('duration'):
+            media_info['duration'] = float(media_format['duration'])
+        if media_format.get('bit_rate'):
+            media_info['bit_rate'] = int(media_format['bit_rate'])
+        return media_info
+
+
+def parse_media_headers(file_path):
+    with open(file_path, 'rb') as f:
+        signature = f.read(8)
+        file_size = os.fstat(f.fileno()).st_size
+        if signature[:4] == '\x1a\x45\xdf\xa3':
+            return _parse_matroska(f, file_size)
+        elif signature[4:8] in ('ftyp', 'moov', 'mdat', 'free', 'wide', 'skip'):
+            return _parse_mp4(f, file_size)
+    return {}
+
+
+MP4_CONTAINER_BOXES = ('moov', 'trak', 'mdia', 'minf', 'stbl')
+
+
+def _parse_mp4(f, file_size):
+    media_info = {}
+    _walk_mp4_boxes(f, 0, file_size, media_info, None)
+    return media_info
+
+
+def _walk_mp4_boxes(f, start, end, media_info, track):
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        box_size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if box_size == 1:
+            box_size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif box_size == 0:
+            box_size = end - offset
+        if box_size < header_size:
+            break
+
+        body = offset + header_size
+        if box_type == 'trak':
+            track = {}
+            _walk_mp4_boxes(f, body, offset + box_size, media_info, track)
+            if track.get('handler') == 'vide' and 'video_codec' not in media_info:
+                media_info['video_codec'] = CODEC_NAMES.get(track.get('format'), track.get('format'))
+                media_info['width'] = track.get('width')
+                media_info['height'] = track.get('height')
+        elif box_type in MP4_CONTAINER_BOXES:
+            _walk_mp4_boxes(f, body, offset + box_size, media_info, track)
+        elif box_type == 'mvhd':
+            version = ord(f.read(4)[0])
+            if version == 1:
+                f.seek(16, os.SEEK_CUR)
+                timescale, duration = struct.unpack('>IQ', f.read(12))
+            else:
+                f.seek(8, os.SEEK_CUR)
+                timescale, duration = struct.unpack('>II', f.read(8))
+            if timescale:
+                media_info['duration'] = float(duration) / timescale
+        elif track is not None and box_type == 'tkhd':
+            version = ord(f.read(4)[0])
+            f.seek((32 if version == 1 else 20) + 52, os.SEEK_CUR)
+            width, height = struct.unpack('>II', f.read(8))
+            track['width'] = width >> 16
+            track['height'] = height >> 16
+        elif track is not None and box_type == 'hdlr':
+            f.seek(8, os.SEEK_CUR)
+            track['handler'] = f.read(4)
+        elif track is not None and box_type == 'stsd':
+            f.seek(12, os.SEEK_CUR)
+            track['format'] = f.read(4)
+        offset += box_size
+
+
+MATROSKA_SEGMENT = 0x18538067
+MATROSKA_CLUSTER = 0x1F43B675
+MATROSKA_MASTER_ELEMENTS = (MATROSKA_SEGMENT, 0x1549A966, 0x1654AE6B, 0xAE, 0xE0)
+
+
+def _parse_matroska(f, file_size):
+    elements = {}
+    tracks = []
+    _walk_matroska_elements(f, 0, file_size, elements, tracks)
+
+    media_info = {}
+    for track in tracks:
+        if track.get(0x83) == 1:
+            codec_id = track.get(0x86)
+            media_info['video_codec'] = CODEC_NAMES.get(codec_id, codec_id)
+            media_info['width'] = track.get(0xB0)
+            media_info['height'] = track.get(0xBA)
+            break
+    if 0x4489 in elements:
+        media_info['duration'] = elements[0x4489] * elements.get(0x2AD7B1, 1000000) / 1e9
+    return media_info
+
+
+def _walk_matroska_elements(f, start, end, elements, tracks):
+    offset = start
+    f.seek(offset)
+    while offset < end:
+        element_id = _read_matroska_vint(f, True)
+        element_size = _read_matroska_vint(f, False)
+        if element_id is None or element_size is None:
+            return False
+        if element_id == MATROSKA_CLUSTER:
+            # headers are over, the rest of the file is media data
+            return False
+        body = f.tell()
+        element_end = end if element_size < 0 else body + element_size
+
+        if element_id in MATROSKA_MASTER_ELEMENTS:
+            target = elements
+            if element_id == 0xAE:
+                target = {}
+                tracks.append(target)
+            elif element_id == 0xE0 and tracks:
+                target = tracks[-1]
+            if not _walk_matroska_elements(f, body, element_end, target, tracks):
+                return False
+        elif element_id in (0x83, 0xB0, 0xBA, 0x2AD7B1):
+            elements[element_id] = _read_matroska_uint(f.read(element_size))
+        elif element_id == 0x86:
+            elements[element_id] = f.read(element_size).rstrip('\x00')
+        elif element_id == 0x4489:
+            elements[element_id] = struct.unpack('>f' if element_size == 4 else '>d', f.read(element_size))[0]
+
+        offset = element_end
+        f.seek(offset)
+    return True
+
+
+def _read_matroska_vint(f, keep_marker):
+    first = f.read(1)
+    if not first:
+        return None
+    value = ord(first)
+    length = 1
+    mask = 0x80
+    while length <= 8 and not value & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        return None
+    if not keep_marker:
+        value &= mask - 1
+    unknown = value == mask - 1
+    for byte in f.read(length - 1):
+        value = (value << 8) | ord(byte)
+        unknown = unknown and ord(byte) == 0xFF
+    return -1 if unknown and not keep_marker else value
+
+
+def _read_matroska_uint(data):
+    value = 0
+    for byte in data:
+        value = (value << 8) | ord(byte)
+    return value
@@ -9,27 +9,40 @@ import schedule
 from watchdog.events import EVENT_TYPE_CREATED
 from watchdog.events import FileSystemEvent
 
-from lib.media_file_processing import MediaProcessingThread
+from lib.media_file_processing import MediaProcessingThread, PostProcessingThread
 from lib.media_file_state import MediaFileState
+from lib.nodes.node_cache import NodeCache
 from lib.nodes.node_state import NodeState
 from lib.utils import compare_list
+from lib.worker_pool import WorkerPool
 from lib.connection_manager import ConnectionManager
 from lib import logger
 
+
 class MediaProcessing(object):
     SCAN_FOR_NEW_MEDIA_FILES_FOR_PROCESSING_TIMEOUT = 10
+    CHECK_INTERVAL = 10
 
-    def __init__(self, mfq, handbreak_command, handbreak_timeout, nodes, delete):
+    def __init__(self, mfq, handbreak_timeout, nodes, delete, staging_area=None, prefetcher=None, post_stages=None,
+                 encode_slots=1, post_slots=1, batch_size_threshold=None, batch_max_files=1):
         self.mfq = mfq
 
-        self.handbreak_command = handbreak_command
         self.handbreak_timeout = handbreak_timeout
         self.delete = delete
-
-        self.system_call_thread = None
+        self.staging_area = staging_area
+        self.prefetcher = prefetcher
+        self.post_stages = post_stages or []
+        self.batch_size_threshold = batch_size_threshold
+        self.batch_max_files = batch_max_files
+
+        self.encode_pool = WorkerPool('encode', encode_slots, self.__create_encode_thread)
+        self.post_pool = WorkerPool('post', post_slots if self.post_stages else 0, self.__create_post_thread)
         self.exiting = False
         self.lock = threading.Lock()
+        self.state_lock = threading.RLock()
         self.nodes = nodes
+        self.node = NodeCache(nodes, socket.gethostname())
+        self.node.add_listener(self.__on_node_changed)
         self.last_silent_periods = None
         self.suspended = False
 
@@ -41,7 +54,8 @@ class MediaProcessing(object):
 
     @ConnectionManager.connection(transaction=True)
     def delete_media_file(self, media_file):
-        if media_file in self.mfq and self.mfq[media_file].status != MediaFileState.PROCESSING:
+        if media_file in self.mfq and self.mfq[media_file].status not in (MediaFileState.PROCESSING,
+                                                                          MediaFileState.POST_PROCESSING):
             del self.mfq[media_file]
         else:
             raise Exception('can\'t delete {} while it\'s processing'.format(media_file))
@@ -57,51 +71,105 @@ class MediaProcessing(object):
             self.mfq[media_file] = MediaFileState.WAITING
 
     def start(self):
-        while not self.exiting:
-            with self.lock:
-                self.system_call_thread = MediaProcessingThread(self.mfq,
-                                                                self.handbreak_command,
-                                                                self.handbreak_timeout,
-                                                                self.delete,
-                                                                name=MediaProcessingThread.__module__)
-                self.system_call_thread.start()
-                while self.system_call_thread.isAlive():
+        next_check = 0
+        try:
+            while not self.exiting:
+                with self.lock:
+                    if not self.suspended:
+                        self.encode_pool.fill(self.SCAN_FOR_NEW_MEDIA_FILES_FOR_PROCESSING_TIMEOUT)
+                    self.post_pool.fill(self.SCAN_FOR_NEW_MEDIA_FILES_FOR_PROCESSING_TIMEOUT)
+                if time.time() >= next_check:
+                    next_check = time.time() + self.CHECK_INTERVAL
                     self.__check_media_processing_state()
                     self.__schedule_silent_periods()
-                    time.sleep(10)
-                self.system_call_thread = None
-            time.sleep(self.SCAN_FOR_NEW_MEDIA_FILES_FOR_PROCESSING_TIMEOUT)
+                    self.__prefetch()
+                time.sleep(1)
+        finally:
+            # also reached when the exit of a signal handler unwinds the loop
+            if self.prefetcher:
+                self.prefetcher.release()
 
     def stop(self):
+        # stop() may run in a signal handler interrupting this very loop in the middle of a prefetch claim, so the
+        # prefetched media file is released by the loop once it's unwound
         self.exiting = True
-        if self.system_call_thread:
-            self.system_call_thread.join()
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.encode_pool.join()
+        self.post_pool.join()
 
-    @ConnectionManager.connection(transaction=True)
     def initial_processing(self, watch_directories, event_handler):
         for watch_directory in watch_directories:
             for root, dir_names, file_names in os.walk(watch_directory):
                 for filename in file_names:
-                    file_path = os.path.join(root, filename).decode('utf-8')
-                    if file_path not in self.mfq or (
-                            file_path in self.mfq
-                            and self.mfq[file_path].status != MediaFileState.FAILED):
-                        file_event = FileSystemEvent(file_path)
-                        file_event.is_directory = False
-                        file_event.event_type = EVENT_TYPE_CREATED
-                        event_handler.on_any_event(file_event)
+                    file_path = os.path.join(root, filename)
+                    if not event_handler.matcher.match(file_path):
+                        continue
+                    file_event = FileSystemEvent(file_path)
+                    file_event.is_directory = False
+                    file_event.event_type = EVENT_TYPE_CREATED
+                    event_handler.on_any_event(file_event)
 
     def __check_media_processing_state(self):
-        if not self.suspended and self.nodes[socket.gethostname()].status == NodeState.SUSPENDED:
-            self.__suspend_media_processing()
-            self.suspended = True
-        elif self.suspended and self.nodes[socket.gethostname()].status == NodeState.ONLINE:
-            self.__resume_media_processing()
-            self.suspended = False
+        with self.state_lock:
+            status = self.node.get().status
+            if not self.suspended and status == NodeState.SUSPENDED:
+                self.__suspend_media_processing()
+                self.suspended = True
+            elif self.suspended and status == NodeState.ONLINE:
+                self.__resume_media_processing()
+                self.suspended = False
+
+    def __create_encode_thread(self, slot):
+        # profiles declare the cost of their media files, one being a full encode slot; a node with nothing
+        # running takes whatever comes next
+        running = self.encode_pool.running()
+        max_cost = len(self.encode_pool) - sum(thread.cost for thread in running) if running else None
+        if max_cost is not None and max_cost <= 0:
+            return None
+        return MediaProcessingThread(self.mfq,
+                                     self.handbreak_timeout,
+                                     self.delete,
+                                     self.staging_area,
+                                     self.prefetcher,
+                                     self.post_stages,
+                                     slot,
+                                     max_cost,
+                                     self.batch_size_threshold,
+                                     self.batch_max_files,
+                                     name='{}.{}'.format(MediaProcessingThread.__module__, slot))
+
+    def __create_post_thread(self, slot):
+        return PostProcessingThread(self.mfq,
+                                    self.post_stages,
+                                    self.handbreak_timeout,
+                                    self.delete,
+                                    slot,
+                                    name='{}.{}'.format(PostProcessingThread.__module__, slot))
+
+    def __on_node_changed(self):
+        # applied even with nothing running, so no media file is claimed in the meantime
+        try:
+            self.__check_media_processing_state()
+        except Exception:
+            logger.debug('unable to apply node state change immediately, it will be applied on the next check')
+
+    def __prefetch(self):
+        if self.prefetcher and not self.suspended and not self.exiting:
+            try:
+                running = self.encode_pool.running()
+                progress = [thread.progress for thread in running if thread.progress is not None]
+                # the prefetched media file starts once the most advanced one is done, in the cost the others leave
+                most_advanced = max(running, key=lambda thread: thread.progress) if running else None
+                others = [thread for thread in running if thread is not most_advanced]
+                max_cost = len(self.encode_pool) - sum(thread.cost for thread in others) if others else None
+                self.prefetcher.on_progress(max(progress) if progress else None, max_cost)
+            except Exception:
+                logger.exception("Unable to prefetch the next media file")
 
     def __schedule_silent_periods(self):
         try:
-            periods = self.nodes.get_silent_periods(socket.gethostname())
+            periods = self.node.get_silent_periods()
             if not self.last_silent_periods or not compare_list(self.last_silent_periods, periods):
                 schedule.clear()
                 for period in periods:
@@ -118,13 +186,11 @@ class MediaProcessing(object):
             logger.debug('no silent periods configured')
 
     def __suspend_media_processing(self):
-        if self.system_call_thread:
-            self.system_call_thread.suspend_media_processing()
-        else:
-            raise Exception('no running media processing found')
+        if self.prefetcher:
+            self.prefetcher.release()
+        for thread in self.encode_pool.running():
+            thread.suspend_media_processing()
 
     def __resume_media_processing(self):
-        if self.system_call_thread:
-            self.system_call_thread.resume_media_processing()
-        else:
-            raise Exception('no running media processing found')
+        for thread in self.encode_pool.running():
+            thread.resume_media_processing()
@@ -0,0 +1,166 @@
+import bisect
+import threading
+
+REGISTRY = []
+
+
+class Metric(object):
+    """In-memory metric in Prometheus text exposition format, one value per combination of label values."""
+
+    type = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label_name, '')) for label_name in self.label_names)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in pairs) + '}'
+
+    def _samples(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.type)]
+        for key, value in self._samples():
+            lines.append('{}{} {}'.format(self.name, self._format_labels(key), repr(float(value))))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, description, label_names=()):
+        super(Gauge, self).__init__(name, description, label_names)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Value read when exposed, `function` returns a number or, with labels, a dict of label values tuples to
+        numbers."""
+        self.function = function
+
+    def _samples(self):
+        if self.function is None:
+            return super(Gauge, self)._samples()
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        return sorted(value.items()) if isinstance(value, dict) else [((), value)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.type)]
+        for key, (counts, total) in self._samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, self._format_labels(
+                    key, [('le', '+Inf' if bound == float('inf') else repr(float(bound)))]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self._format_labels(key), repr(float(total))))
+            lines.append('{}_count{} {}'.format(self.name, self._format_labels(key), cumulative))
+        return lines
+
+
+class QueueDepth(object):
+    """Media files by status, kept up to date from the media file events of the whole fleet instead of counting
+    table rows."""
+
+    def __init__(self, statuses):
+        self.lock = threading.Lock()
+        self.reset(statuses)
+
+    def get_counts(self):
+        with self.lock:
+            return {(status,): count for status, count in self.counts.items()}
+
+    def reset(self, statuses):
+        counts = {}
+        for status in statuses.values():
+            counts[status] = counts.get(status, 0) + 1
+        with self.lock:
+            self.statuses = dict(statuses)
+            self.counts = counts
+
+    def update(self, events):
+        with self.lock:
+            for event in events:
+                if event.type != 'media_file':
+                    continue
+                data = event.dict()
+                status = data.get('status')
+                previous_status = self.statuses.pop(data['id'], None)
+                if previous_status is not None:
+                    self.counts[previous_status] -= 1
+                if status != 'removed':
+                    self.statuses[data['id']] = status
+                    self.counts[status] = self.counts.get(status, 0) + 1
+
+
+def expose():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+media_files_enqueued = Counter('handbreak_media_files_enqueued_total', 'Media files added to the processing queue')
+media_files_finished = Counter('handbreak_media_files_finished_total', 'Media files done processing, by status',
+                               ['status'])
+queue_media_files = Gauge('handbreak_queue_media_files', 'Media files in the processing queue, by status',
+                          ['status'])
+claim_seconds = Histogram('handbreak_claim_seconds', 'Time taken to claim a media file to process')
+claim_races = Counter('handbreak_claim_races_total', 'Claims lost to another node changing the media file since it was '
+                                                    'peeked')
+encode_slots_active = Gauge('handbreak_encode_slots_active', 'Encode slots running on this node')
+post_slots_active = Gauge('handbreak_post_slots_active', 'Post processing slots running on this node')
+encode_fps = Gauge('handbreak_encode_fps', 'Frames per second reported by the running encodes', ['slot'])
+encoded_bytes = Counter('handbreak_encoded_bytes_total', 'Size of the encoded media files')
+encode_seconds = Counter('handbreak_encode_seconds_total', 'Time spent encoding media files')
+db_transaction_wait_seconds = Histogram('handbreak_db_transaction_wait_seconds',
+                                        'Time waiting for the database lock')
+db_transaction_hold_seconds = Histogram('handbreak_db_transaction_hold_seconds',
+                                        'Time the database lock is held')
+ingestion_backlog = Gauge('handbreak_ingestion_backlog', 'File system events and files waiting to be queued',
+                          ['stage'])
+rest_request_seconds = Histogram('handbreak_rest_request_seconds', 'REST API request latency',
+                                 ['method', 'endpoint', 'code'])
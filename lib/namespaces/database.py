@@ -0,0 +1,24 @@
+from flask_restplus import Resource, Namespace
+
+from lib.connection_manager import ConnectionManager
+
+api = Namespace('database', description='Database usage of this node')
+
+
+@api.route('/profile')
+class DatabaseProfile(Resource):
+
+    @api.doc(description='get connect time, lock wait and hold times and query count of every database function')
+    def get(self):
+        profiler = ConnectionManager.get_profiler()
+        if not profiler:
+            return 'Database profiling is disabled', 404
+        return profiler.get_stats(), 200
+
+    @api.doc(description='reset database profiling')
+    def delete(self):
+        profiler = ConnectionManager.get_profiler()
+        if not profiler:
+            return 'Database profiling is disabled', 404
+        profiler.reset()
+        return 'Database profiling reset', 200
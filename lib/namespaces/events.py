@@ -0,0 +1,67 @@
+import json
+
+from flask import Response, request
+from flask_restplus import Resource, Namespace
+
+from lib.exceptions import TooManySubscribersError
+
+es = None
+mp = None
+api = Namespace('events', description='Follow processing queue and nodes changes')
+
+
+def format_event(event_type, data, event_id=None):
+    lines = ['id: {}'.format(event_id)] if event_id is not None else []
+    lines.append('event: {}'.format(event_type))
+    lines.append('data: {}'.format(json.dumps(data)))
+    return '\n'.join(lines) + '\n\n'
+
+
+def get_progress():
+    result = {}
+    for thread in mp.encode_pool.running():
+        media_file = thread.current_processing_file
+        if media_file is not None and thread.progress is not None:
+            result[str(media_file.id)] = thread.progress
+    return result
+
+
+@api.route('/')
+class Events(Resource):
+    parser = api.parser()
+    parser.add_argument('last_event_id', type=int, help='resume after this event id(Last-Event-ID header)',
+                        required=False)
+
+    @api.doc(description='stream of media file and node changes(Server-Sent Events), media files processing '
+                         'progress on this node is sent as events without id; after a reset event the changes it '
+                         'replaces are lost and the processing queue should be reloaded')
+    @api.expect(parser)
+    def get(self):
+        args = self.parser.parse_args()
+        last_event_id = request.headers.get('Last-Event-ID', args.last_event_id)
+        try:
+            last_event_id = int(last_event_id) if last_event_id is not None else None
+        except ValueError:
+            return 'Invalid last event id [{}]'.format(last_event_id), 400
+        try:
+            subscription = es.subscribe(last_event_id)
+        except TooManySubscribersError:
+            return 'Too many event stream clients', 503
+
+        def generate():
+            progress = {}
+            for event in subscription:
+                if event is not None:
+                    event_id, event_type, data = event
+                    yield format_event(event_type, data, event_id)
+                    continue
+                current_progress = get_progress()
+                if current_progress != progress:
+                    progress = current_progress
+                    yield format_event('progress', progress)
+                else:
+                    yield ': keep-alive\n\n'
+
+        response = Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        response.call_on_close(subscription.close)
+        return response
@@ -4,6 +4,7 @@ from flask import jsonify, request
 from flask_restplus import Resource, Namespace, inputs, fields
 from lib.connection_manager import ConnectionManager
 from lib.nodes.node_state import NodeState
+from lib.response_cache import response_cache
 
 TIME_RANGE_PATTERN = re.compile("^([0-9]|0[0-9]|1[0-9]|2[0-3]):[0-5][0-9]-([0-9]|0[0-9]|1[0-9]|2[0-3]):[0-5][0-9]$")
 
@@ -20,6 +21,7 @@ class Nodes(Resource):
 
     @api.doc(description='get information about all processing nodes')
     @api.expect(parser)
+    @response_cache
     def get(self):
         args = self.parser.parse_args()
         if args.full:
@@ -6,6 +6,7 @@ from humanize import naturalsize, naturaldelta, intcomma, apnumber, fractional
 
 from lib.media_file_state import MediaFileState
 from lib.connection_manager import ConnectionManager
+from lib.response_cache import response_cache
 
 mp = None
 api = Namespace('queue', description='Control processing queue')
@@ -23,6 +24,7 @@ class Queue(Resource):
 
     @api.doc(description='get information about media processing queue state')
     @api.expect(parser)
+    @response_cache
     def get(self):
         args = self.parser.parse_args()
         if args.full:
@@ -36,6 +38,8 @@ class QueueStats(Resource):
 
     @api.doc(description='get statistic for media processing queue')
     @api.expect(parser)
+    @response_cache
+    @ConnectionManager.connection
     def get(self):
         args = parser.parse_args()
 
@@ -93,6 +97,8 @@ class QueueStats(Resource):
 class QueueLoad(Resource):
 
     @api.doc(description='get load per day(min:0, max:1)')
+    @response_cache
+    @ConnectionManager.connection
     def get(self):
         time_graph = {}
         for media_file in mp.mfq:
@@ -136,6 +142,7 @@ class QueueSize(Resource):
 
     @api.doc(description='get size of media processing queue')
     @api.expect(parser)
+    @response_cache
     def get(self):
         args = parser.parse_args()
         return intcomma(len(mp.mfq)) if args.humanize else len(mp.mfq), 200
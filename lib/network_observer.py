@@ -0,0 +1,202 @@
+import errno
+import hashlib
+import os
+import socket
+import sqlite3
+import stat
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from threading import Event, Thread
+
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileMovedEvent
+
+from lib import logger
+
+
+class NetworkShareObserver(Thread):
+    """Watches a directory on a network share(NFS/SMB), where file system notifications miss changes made by other hosts.
+
+    The tree is rescanned periodically, in parallel and level by level, against a snapshot of (size, mtime, inode) of
+    every file persisted in sqlite. A directory whose mtime has not changed is not listed again, and only the
+    differences are dispatched to the event handler, files renamed or moved within the share as moved events.
+    """
+
+    SCAN_WORKERS = 8
+    # directories modified that recently are listed again on the next scan, their mtime may not show a later change
+    MTIME_GRANULARITY = 2
+
+    def __init__(self, scan_interval, snapshot_directory):
+        Thread.__init__(self, name=NetworkShareObserver.__module__)
+        self.scan_interval = scan_interval
+        self.snapshot_directory = snapshot_directory
+        self.event_handler = None
+        self.watch_directory = None
+        self.directories = {}
+        self.scan_started = None
+        self.stopped = Event()
+
+    def schedule(self, event_handler, path, recursive=True):
+        self.event_handler = event_handler
+        self.watch_directory = os.path.abspath(path if isinstance(path, unicode)
+                                               else path.decode(sys.getfilesystemencoding()))
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        connection = sqlite3.connect(os.path.join(self.snapshot_directory, 'snapshot-{}-{}.db'.format(
+            socket.gethostname(), hashlib.md5(self.watch_directory.encode('utf-8')).hexdigest()[:8])))
+        pool = ThreadPool(self.SCAN_WORKERS)
+        try:
+            self.__load_snapshot(connection)
+            while not self.stopped.is_set():
+                try:
+                    self.__scan(connection, pool)
+                except Exception:
+                    logger.exception("An error occurred during scanning of [{}]".format(self.watch_directory))
+                self.stopped.wait(self.scan_interval)
+        finally:
+            pool.terminate()
+            connection.close()
+
+    def __load_snapshot(self, connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS directories '
+                           '(path TEXT PRIMARY KEY, parent TEXT, mtime REAL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS files '
+                           '(directory TEXT, name TEXT, size INTEGER, mtime REAL, inode INTEGER, '
+                           'PRIMARY KEY (directory, name))')
+        for path, parent, mtime in connection.execute('SELECT path, parent, mtime FROM directories'):
+            self.directories[path] = [mtime, [], {}]
+        for path, parent, mtime in connection.execute('SELECT path, parent, mtime FROM directories'):
+            if parent in self.directories:
+                self.directories[parent][1].append(path)
+        for directory, name, size, mtime, inode in connection.execute(
+                'SELECT directory, name, size, mtime, inode FROM files'):
+            if directory in self.directories:
+                self.directories[directory][2][name] = (size, mtime, inode)
+        if self.directories:
+            logger.info("Snapshot of [{}] with [{}] directories loaded".format(self.watch_directory,
+                                                                              len(self.directories)))
+
+    def __scan(self, connection, pool):
+        # an unmounted share usually leaves an empty mount point behind
+        if not os.path.isdir(self.watch_directory) or (self.directories and not os.listdir(self.watch_directory)):
+            logger.warn("Network share [{}] is not available, skipping scan".format(self.watch_directory))
+            return
+
+        self.scan_started = time.time()
+        baseline = not self.directories
+        changed_directories = {}
+        seen_directories = set()
+        created = {}
+        deleted = {}
+
+        frontier = [self.watch_directory]
+        while frontier:
+            results = pool.map(self.__scan_directory, frontier)
+            next_frontier = []
+            for directory, result in zip(frontier, results):
+                if result is None:
+                    continue
+                seen_directories.add(directory)
+                mtime, subdirectories, files = result
+                if files is not None:
+                    previous_files = self.directories[directory][2] if directory in self.directories else {}
+                    self.__diff(directory, previous_files, files, created, deleted)
+                    changed_directories[directory] = [mtime, subdirectories, files]
+                next_frontier.extend(subdirectories)
+            frontier = next_frontier
+
+        removed_directories = [directory for directory in self.directories if directory not in seen_directories]
+        for directory in removed_directories:
+            for name, file_stat in self.directories[directory][2].items():
+                deleted[os.path.join(directory, name)] = file_stat
+
+        self.__save_snapshot(connection, changed_directories, removed_directories)
+        for directory in removed_directories:
+            del self.directories[directory]
+        self.directories.update(changed_directories)
+
+        if not baseline:
+            self.__dispatch(created, deleted)
+        logger.debug("Scanned [{}] in [{:.3f}s]: [{}] directories, [{}] listed, [{}] created, [{}] deleted".format(
+            self.watch_directory, time.time() - self.scan_started, len(seen_directories), len(changed_directories),
+            len(created), len(deleted)))
+
+    def __scan_directory(self, directory):
+        cached = self.directories.get(directory)
+        try:
+            mtime = os.stat(directory).st_mtime
+            if cached and cached[0] == mtime:
+                return mtime, cached[1], None
+            names = os.listdir(directory)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR) or not cached:
+                return None
+            # a transient error on the share should not look like the whole directory was deleted
+            logger.debug("Unable to scan [{}]: {}".format(directory, e))
+            return cached[0], cached[1], None
+
+        if mtime >= self.scan_started - self.MTIME_GRANULARITY:
+            mtime = None
+        subdirectories = []
+        files = {}
+        for name in names:
+            if not isinstance(name, unicode):
+                logger.debug("Skipping [{}] in [{}], its name can't be decoded".format(repr(name), directory))
+                continue
+            path = os.path.join(directory, name)
+            try:
+                path_stat = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(path_stat.st_mode):
+                subdirectories.append(path)
+            elif stat.S_ISREG(path_stat.st_mode):
+                files[name] = (path_stat.st_size, path_stat.st_mtime, path_stat.st_ino)
+        return mtime, subdirectories, files
+
+    @staticmethod
+    def __diff(directory, previous_files, files, created, deleted):
+        for name, file_stat in files.items():
+            previous_file_stat = previous_files.get(name)
+            if previous_file_stat is None or previous_file_stat[2] != file_stat[2]:
+                created[os.path.join(directory, name)] = file_stat
+        for name, previous_file_stat in previous_files.items():
+            file_stat = files.get(name)
+            if file_stat is None or previous_file_stat[2] != file_stat[2]:
+                deleted[os.path.join(directory, name)] = previous_file_stat
+
+    def __dispatch(self, created, deleted):
+        deleted_by_inode = {}
+        for path, file_stat in deleted.items():
+            if file_stat[2]:
+                deleted_by_inode.setdefault((file_stat[2], file_stat[0]), []).append(path)
+
+        for path in sorted(created):
+            file_stat = created[path]
+            src_paths = deleted_by_inode.get((file_stat[2], file_stat[0]))
+            if file_stat[2] and src_paths and len(src_paths) == 1:
+                src_path = src_paths.pop()
+                del deleted[src_path]
+                del created[path]
+                self.event_handler.dispatch(FileMovedEvent(src_path, path))
+
+        for path in sorted(deleted):
+            self.event_handler.dispatch(FileDeletedEvent(path))
+        for path in sorted(created):
+            self.event_handler.dispatch(FileCreatedEvent(path))
+
+    @staticmethod
+    def __save_snapshot(connection, changed_directories, removed_directories):
+        with connection:
+            for directory in removed_directories:
+                connection.execute('DELETE FROM directories WHERE path = ?', (directory,))
+                connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+            for directory, (mtime, subdirectories, files) in changed_directories.items():
+                connection.execute('INSERT OR REPLACE INTO directories (path, parent, mtime) VALUES (?, ?, ?)',
+                                   (directory, os.path.dirname(directory), mtime))
+                connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+                connection.executemany('INSERT INTO files (directory, name, size, mtime, inode) VALUES (?, ?, ?, ?, ?)',
+                                       [(directory, name) + file_stat for name, file_stat in files.items()])
@@ -2,7 +2,8 @@ import uuid
 from datetime import datetime
 
 from humanize import naturaltime, apnumber
-from peewee import Proxy, Model, UUIDField, DateTimeField, TextField, IntegerField, CharField
+from peewee import Proxy, Model, UUIDField, DateTimeField, TextField, IntegerField, CharField, BigIntegerField, \
+    FloatField
 
 from lib.nodes.node_state import NodeState, NodeStateField
 
@@ -25,9 +26,15 @@ class Node(BaseModel):
     status = NodeStateField(column_name='status', index=True)
     date_become_online = DateTimeField(column_name='date_become_online', null=True)
     date_become_offline = DateTimeField(column_name='date_become_offline', null=True)
+    last_heartbeat = DateTimeField(column_name='last_heartbeat', null=True)
     cpu_threads = IntegerField(column_name='cpu_threads')
+    cpu_cores = IntegerField(column_name='cpu_cores', null=True)
+    cpu_sockets = IntegerField(column_name='cpu_sockets', null=True)
     cpu_details = CharField(column_name='cpu')
+    memory = BigIntegerField(column_name='memory', null=True)
+    performance_score = FloatField(column_name='performance_score', null=True)
     silent_periods = TextField(column_name='silent_periods', null=True)
+    generation = IntegerField(column_name='generation', default=0)
 
     def __repr__(self):
         return "<{klass} @{id:x} {attrs}>".format(
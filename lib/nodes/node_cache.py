@@ -0,0 +1,52 @@
+import json
+import threading
+
+
+class NodeCache(object):
+
+    def __init__(self, nodes, key):
+        self.nodes = nodes
+        self.key = key
+        self.lock = threading.RLock()
+        self.node = None
+        self.silent_periods = None
+        self.listeners = []
+        nodes.add_listener(self.__on_node_changed)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def invalidate(self):
+        with self.lock:
+            self.node = None
+            self.silent_periods = None
+
+    def get(self):
+        with self.lock:
+            if self.node is None or self.nodes.get_generation(self.key) != self.node.generation:
+                self.__reload()
+            return self.node
+
+    def get_silent_periods(self):
+        with self.lock:
+            self.get()
+            if self.silent_periods is None:
+                raise Exception("no silent periods configured for node [{}]".format(self.key))
+            return self.silent_periods
+
+    def __reload(self):
+        node = self.nodes[self.key]
+        if not node:
+            raise Exception('node not found')
+        self.node = node
+        self.silent_periods = json.loads(node.silent_periods) if node.silent_periods else None
+
+    def __on_node_changed(self, key):
+        if isinstance(key, tuple):
+            key = key[1]
+        key = str(key)
+        node = self.node
+        if key == self.key or (node and key in (str(node.id), node.hostname)):
+            self.invalidate()
+            for listener in self.listeners:
+                listener()
@@ -0,0 +1,112 @@
+import json
+import os
+import random
+import subprocess
+import time
+import uuid
+import zlib
+
+from lib import logger
+
+MACHINE_ID_FILES = ['/etc/machine-id', '/var/lib/dbus/machine-id']
+CALIBRATION_DURATION = 1.0
+CALIBRATION_BLOCK_SIZE = 1024 * 1024
+BUILTIN_CALIBRATION = 'zlib'
+
+
+def get_machine_id():
+    for machine_id_file in MACHINE_ID_FILES:
+        try:
+            with open(machine_id_file) as f:
+                machine_id = f.read().strip()
+            if machine_id:
+                return machine_id
+        except IOError:
+            pass
+    return '{:012x}'.format(uuid.getnode())
+
+
+def get_hardware_info(data_store_directory, calibration_command=None):
+    calibration = calibration_command if calibration_command else BUILTIN_CALIBRATION
+    cache_file = os.path.join(data_store_directory, 'hardware-{}.json'.format(get_machine_id()))
+    try:
+        with open(cache_file) as f:
+            hardware_info = json.load(f)
+        if hardware_info.get('calibration') == calibration:
+            return hardware_info
+    except (IOError, ValueError):
+        pass
+
+    logger.info("Detecting node hardware, this is done once per machine")
+    hardware_info = detect_hardware()
+    hardware_info['calibration'] = calibration
+    hardware_info['performance_score'] = calibrate(hardware_info, calibration_command)
+
+    temp_cache_file = '{}.{}'.format(cache_file, os.getpid())
+    with open(temp_cache_file, 'w') as f:
+        json.dump(hardware_info, f)
+    os.rename(temp_cache_file, cache_file)
+    logger.debug("Node hardware cached in [{}]: {}".format(cache_file, hardware_info))
+    return hardware_info
+
+
+def detect_hardware():
+    import cpuinfo
+
+    info = cpuinfo.get_cpu_info()
+    cpu_cores, cpu_sockets = _get_cpu_topology()
+    return {
+        'cpu_threads': info['count'],
+        'cpu_cores': cpu_cores or info['count'],
+        'cpu_sockets': cpu_sockets or 1,
+        'cpu_details': info['brand'],
+        'memory': _get_memory_size()
+    }
+
+
+def calibrate(hardware_info, calibration_command=None):
+    if calibration_command:
+        started = time.time()
+        exit_code = subprocess.call(calibration_command, shell=True)
+        elapsed = time.time() - started
+        if exit_code != 0:
+            raise Exception("Calibration command failed with exit code [{}]".format(exit_code))
+        return round(1000.0 / max(elapsed, 0.001), 2)
+
+    randomizer = random.Random(0)
+    words = [''.join(chr(randomizer.randint(97, 122)) for _ in range(randomizer.randint(2, 9))) for _ in range(512)]
+    block = ' '.join(randomizer.choice(words) for _ in range(CALIBRATION_BLOCK_SIZE / 6))[:CALIBRATION_BLOCK_SIZE]
+
+    compressed_bytes = 0
+    started = time.time()
+    while time.time() - started < CALIBRATION_DURATION:
+        zlib.compress(block, 6)
+        compressed_bytes += len(block)
+    megabytes_per_second = compressed_bytes / (time.time() - started) / (1024 * 1024)
+    return round(megabytes_per_second * hardware_info['cpu_cores'], 2)
+
+
+def _get_cpu_topology():
+    cores = set()
+    sockets = set()
+    physical_id = None
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'physical id':
+                    physical_id = value.strip()
+                    sockets.add(physical_id)
+                elif key == 'core id':
+                    cores.add((physical_id, value.strip()))
+    except IOError:
+        pass
+    return len(cores) or None, len(sockets) or None
+
+
+def _get_memory_size():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
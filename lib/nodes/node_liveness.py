@@ -0,0 +1,60 @@
+import time
+from threading import Thread, Event
+
+from lib.connection_manager import ConnectionManager
+from lib.nodes.node_state import NodeState
+from lib import logger
+
+
+class NodeLivenessThread(Thread):
+
+    TRIM_INTERVAL = 60
+
+    def __init__(self, nodes, mfq, hostname, heartbeat_interval, node_timeout, **kwargs):
+        Thread.__init__(self, **kwargs)
+        self.setDaemon(True)
+
+        self.nodes = nodes
+        self.mfq = mfq
+        self.hostname = hostname
+        self.heartbeat_interval = heartbeat_interval
+        self.node_timeout = node_timeout
+        self.exiting = Event()
+        self.next_trim = 0
+
+    def run(self):
+        while not self.exiting.wait(self.heartbeat_interval):
+            try:
+                self.__heartbeat()
+                self.__reap_silent_nodes()
+            except Exception:
+                logger.exception("An error occurred during node liveness check")
+
+    def stop(self):
+        self.exiting.set()
+        self.join()
+
+    def __heartbeat(self):
+        status = self.nodes.heartbeat(self.hostname)
+        if status == NodeState.OFFLINE and not self.exiting.is_set():
+            logger.warn("Node [{}] was marked [{}] by another node, bringing it back [{}]".format(
+                self.hostname, NodeState.OFFLINE.value, NodeState.ONLINE.value))
+            self.nodes[self.hostname] = NodeState.ONLINE
+
+    @ConnectionManager.connection(transaction=True)
+    def __reap_silent_nodes(self):
+        alive_nodes = self.nodes.get_alive(self.node_timeout)
+        if not alive_nodes or alive_nodes[0].hostname != self.hostname:
+            return
+
+        silent_nodes = self.nodes.reap(self.node_timeout)
+        if silent_nodes:
+            hostnames = [node.hostname for node in silent_nodes]
+            requeued = self.mfq.requeue_orphaned(hostnames)
+            logger.warn("Nodes {} stopped sending heartbeats, marked [{}] and [{}] media files returned to "
+                        "processing queue".format(hostnames, NodeState.OFFLINE.value, requeued))
+
+        # the leader trims the event log, whether or not any node follows it
+        if self.mfq.event_log and time.time() >= self.next_trim:
+            self.mfq.event_log.trim()
+            self.next_trim = time.time() + self.TRIM_INTERVAL
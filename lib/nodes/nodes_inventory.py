@@ -1,7 +1,7 @@
 import datetime
 import json
 
-import cpuinfo
+from peewee import fn
 
 from lib.connection_manager import ConnectionManager
 from lib.nodes.node import Node
@@ -11,13 +11,31 @@ from lib.nodes.node_state import NodeState
 
 class NodeInventory(object):
 
-    def __init__(self):
+    HARDWARE_FIELDS = ['cpu_threads', 'cpu_cores', 'cpu_sockets', 'cpu_details', 'memory', 'performance_score']
+
+    def __init__(self, hardware_info=None, event_log=None):
+        self.hardware_info = hardware_info
+        self.event_log = event_log
         ConnectionManager.initialize_proxy(proxy)
         self.__create_table()
+        self.__listeners = []
 
     @ConnectionManager.connection(transaction=True)
     def __create_table(self):
         Node.create_table(True)
+        ConnectionManager.migrate_table(Node)
+
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    def __notify_listeners(self, key):
+        for listener in self.__listeners:
+            listener(key)
+
+    def __log_event(self, node, **data):
+        if self.event_log and node:
+            self.event_log.append('node', **dict(data, id=str(node.id), hostname=node.hostname,
+                                                 status=data.get('status', node.status.value)))
 
     @ConnectionManager.connection
     def __len__(self):
@@ -35,16 +53,23 @@ class NodeInventory(object):
                 query = ((Node.id == key) | (Node.hostname == key)) & (Node.status == NodeState.OFFLINE)
             else:
                 query = (Node.id == key) | (Node.hostname == key)
+        node = Node.select().where(query).first()
         Node.delete().where(query).execute()
+        self.__log_event(node, status='removed')
 
-    @ConnectionManager.connection(transaction=True)
     def __setitem__(self, key, status):
+        self.__set_status(key, status)
+        self.__notify_listeners(key)
+
+    @ConnectionManager.connection(transaction=True)
+    def __set_status(self, key, status):
         now = datetime.datetime.now()
-        set_fields = {'status': status}
+        set_fields = {'status': status, 'generation': Node.generation + 1}
 
         if status == NodeState.ONLINE:
             set_fields['date_become_online'] = now
             set_fields['date_become_offline'] = None
+            set_fields['last_heartbeat'] = now
         elif status == NodeState.OFFLINE:
             set_fields['date_become_online'] = None
             set_fields['date_become_offline'] = now
@@ -54,14 +79,14 @@ class NodeInventory(object):
                 Node.update(set_fields).where((Node.id == key[1]) | (Node.hostname == key[1])).execute()
             else:
                 Node.update(set_fields).where((Node.id == key) | (Node.hostname == key)).execute()
+            self.__log_event(self.__getitem__(key[1] if isinstance(key, tuple) else key))
         else:
             if isinstance(key, tuple):
-                info = cpuinfo.get_cpu_info()
+                set_fields.update(self.__get_hardware_fields())
                 set_fields['id'] = key[0]
                 set_fields['hostname'] = key[1]
-                set_fields['cpu_threads'] = info['count']
-                set_fields['cpu_details'] = info['brand']
-                Node.create(**set_fields)
+                set_fields['generation'] = 0
+                self.__log_event(Node.create(**set_fields))
             else:
                 raise Exception('node doesn\'t exist, you must provide both id and hostname')
 
@@ -73,6 +98,51 @@ class NodeInventory(object):
             result = Node.select().where((Node.id == key) | (Node.hostname == key)).limit(1)
         return result.first() if result else None
 
+    @ConnectionManager.connection(transaction=True)
+    def update_hardware_info(self, key):
+        if self.__contains__(key):
+            Node.update(self.__get_hardware_fields()).where((Node.id == key) | (Node.hostname == key)).execute()
+        else:
+            raise Exception('node not found')
+
+    def __get_hardware_fields(self):
+        if not self.hardware_info:
+            raise Exception('node hardware info is not available')
+        return {field: self.hardware_info.get(field) for field in self.HARDWARE_FIELDS}
+
+    @ConnectionManager.connection(transaction=True)
+    def heartbeat(self, key):
+        Node.update(last_heartbeat=datetime.datetime.now()).where((Node.id == key) | (Node.hostname == key)).execute()
+        node = Node.select(Node.status).where((Node.id == key) | (Node.hostname == key)).first()
+        return node.status if node else None
+
+    @ConnectionManager.connection
+    def get_alive(self, timeout):
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        return list(Node.select().where(
+            (Node.status != NodeState.OFFLINE) &
+            (fn.COALESCE(Node.last_heartbeat, Node.date_become_online) >= cutoff)).order_by(Node.hostname))
+
+    @ConnectionManager.connection(transaction=True)
+    def reap(self, timeout):
+        now = datetime.datetime.now()
+        cutoff = now - datetime.timedelta(seconds=timeout)
+        silent_nodes = list(Node.select().where(
+            (Node.status != NodeState.OFFLINE) &
+            ((fn.COALESCE(Node.last_heartbeat, Node.date_become_online) < cutoff) |
+             (fn.COALESCE(Node.last_heartbeat, Node.date_become_online) >> None))))
+        for node in silent_nodes:
+            Node.update(status=NodeState.OFFLINE,
+                        date_become_online=None,
+                        date_become_offline=node.last_heartbeat or now,
+                        generation=Node.generation + 1).where(Node.id == node.id).execute()
+            self.__log_event(node, status=NodeState.OFFLINE.value)
+        return silent_nodes
+
+    @ConnectionManager.connection
+    def get_generation(self, key):
+        return Node.select(Node.generation).where((Node.id == key) | (Node.hostname == key)).scalar()
+
     @ConnectionManager.connection
     def __repr__(self):
         result = []
@@ -138,13 +208,9 @@ class NodeInventory(object):
     def list(self, humanize=False):
         return [node.dict(humanize) for node in Node]
 
-    @ConnectionManager.connection(transaction=True)
     def set_silent_periods(self, key, silent_periods):
-        if self.__contains__(key):
-            Node.update(silent_periods=json.dumps(silent_periods)).where(
-                (Node.id == key) | (Node.hostname == key)).execute()
-        else:
-            raise Exception('node not found')
+        self.__update_silent_periods(key, json.dumps(silent_periods))
+        self.__notify_listeners(key)
 
     @ConnectionManager.connection(transaction=True)
     def get_silent_periods(self, key):
@@ -157,9 +223,14 @@ class NodeInventory(object):
         else:
             raise Exception('node not found')
 
-    @ConnectionManager.connection(transaction=True)
     def clear_silent_periods(self, key):
+        self.__update_silent_periods(key, None)
+        self.__notify_listeners(key)
+
+    @ConnectionManager.connection(transaction=True)
+    def __update_silent_periods(self, key, silent_periods):
         if self.__contains__(key):
-            Node.update(silent_periods=None).where(Node.id == key).execute()
+            Node.update(silent_periods=silent_periods, generation=Node.generation + 1).where(
+                (Node.id == key) | (Node.hostname == key)).execute()
         else:
             raise Exception('node not found')
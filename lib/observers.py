@@ -0,0 +1,61 @@
+from watchdog.events import FileModifiedEvent
+from watchdog.observers import Observer
+
+try:
+    from watchdog.observers.api import BaseObserver, DEFAULT_OBSERVER_TIMEOUT
+    from watchdog.observers.inotify import InotifyEmitter
+    from watchdog.observers.inotify_buffer import InotifyBuffer
+    from watchdog.observers.inotify_c import Inotify, InotifyConstants, WATCHDOG_ALL_EVENTS
+    from watchdog.utils import BaseThread, unicode_paths
+    from watchdog.utils.delayed_queue import DelayedQueue
+except ImportError:
+    InotifyEmitter = None
+
+
+class FileClosedEvent(FileModifiedEvent):
+    """File modified event raised when a file opened for writing is closed(IN_CLOSE_WRITE)."""
+
+    @property
+    def key(self):
+        # distinct from the modified event right before it, which the observer queue would otherwise skip as a repeat
+        return super(FileClosedEvent, self).key + ('closed',)
+
+
+def create_observer():
+    if InotifyEmitter:
+        return CloseWriteObserver()
+    return Observer()
+
+
+if InotifyEmitter:
+    class CloseWriteInotifyBuffer(InotifyBuffer):
+
+        def __init__(self, path, recursive, on_close_write):
+            BaseThread.__init__(self)
+            self.on_close_write = on_close_write
+            self._queue = DelayedQueue(self.delay)
+            self._inotify = Inotify(path, recursive, WATCHDOG_ALL_EVENTS | InotifyConstants.IN_CLOSE_WRITE)
+            self.start()
+
+        def read_event(self):
+            event = InotifyBuffer.read_event(self)
+            if event is not None and not isinstance(event, tuple) \
+                    and event.is_close_write and not event.is_directory:
+                self.on_close_write(event.src_path)
+            return event
+
+
+    class CloseWriteInotifyEmitter(InotifyEmitter):
+
+        def on_thread_start(self):
+            path = unicode_paths.encode(self.watch.path)
+            self._inotify = CloseWriteInotifyBuffer(path, self.watch.is_recursive, self.__queue_close_write)
+
+        def __queue_close_write(self, src_path):
+            self.queue_event(FileClosedEvent(self._decode_path(src_path)))
+
+
+    class CloseWriteObserver(BaseObserver):
+
+        def __init__(self, timeout=DEFAULT_OBSERVER_TIMEOUT):
+            BaseObserver.__init__(self, emitter_class=CloseWriteInotifyEmitter, timeout=timeout)
@@ -0,0 +1,58 @@
+import fnmatch
+import re
+
+GLOB_CHARACTERS = re.compile(r'[*?\[\]]')
+
+
+class PathMatcher(object):
+    """Matches paths against include and exclude glob patterns, compiled once.
+
+    Patterns like `*.mkv` become a suffix lookup; all the other patterns of a kind are joined into a single regular
+    expression. Matching follows `pathtools.patterns.match_path`.
+    """
+
+    def __init__(self, include_patterns=None, exclude_patterns=None, case_sensitive=True):
+        include_patterns = ['*'] if include_patterns is None else include_patterns
+        exclude_patterns = [] if exclude_patterns is None else exclude_patterns
+        if not case_sensitive:
+            include_patterns = [pattern.lower() for pattern in include_patterns]
+            exclude_patterns = [pattern.lower() for pattern in exclude_patterns]
+
+        common_patterns = set(include_patterns) & set(exclude_patterns)
+        if common_patterns:
+            raise ValueError('conflicting patterns `{}` included and excluded'.format(common_patterns))
+
+        self.case_sensitive = case_sensitive
+        self.include_all = '*' in include_patterns
+        self.include_suffixes, self.include_regex = self.__compile(include_patterns)
+        self.exclude_suffixes, self.exclude_regex = self.__compile(exclude_patterns)
+
+    def match(self, path):
+        if not self.case_sensitive:
+            path = path.lower()
+        return (self.include_all or self.__match(path, self.include_suffixes, self.include_regex)) \
+            and not self.__match(path, self.exclude_suffixes, self.exclude_regex)
+
+    @staticmethod
+    def __match(path, suffixes, regex):
+        return bool((suffixes and path.endswith(suffixes)) or (regex and regex.match(path)))
+
+    @staticmethod
+    def __compile(patterns):
+        suffixes = []
+        regexes = []
+        for pattern in set(patterns):
+            if pattern.startswith('*') and len(pattern) > 1 and not GLOB_CHARACTERS.search(pattern[1:]):
+                suffixes.append(pattern[1:])
+            else:
+                regexes.append('(?:{})'.format(PathMatcher.__translate(pattern)))
+        regex = re.compile('(?:{})\\Z'.format('|'.join(regexes)), re.S) if regexes else None
+        return tuple(suffixes), regex
+
+    @staticmethod
+    def __translate(pattern):
+        regex = fnmatch.translate(pattern)
+        for anchor in ('\\Z(?ms)', '\\Z'):
+            if regex.endswith(anchor):
+                return regex[:-len(anchor)]
+        return regex
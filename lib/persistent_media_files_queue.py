@@ -1,34 +1,54 @@
 import datetime
 import logging
 import os
+import socket
+from uuid import uuid4
 
+from peewee import chunked
+
+from lib import metrics
 from lib.connection_manager import ConnectionManager
+from lib.exceptions import MediaFileClaimLostError
+from lib.profiles import Profile, Profiles
 from lib.media_file import MediaFile
 from lib.media_file import proxy
 from lib.media_file_state import MediaFileState
 from lib import logger
 
 class MediaFilesQueue(object):
+    SQLITE_MAX_VARIABLES = 999
 
-    def __init__(self, output_file_extension):
+    def __init__(self, output_file_extension, command=None, profiles=None, event_log=None):
         self.output_file_extension = output_file_extension
+        self.profiles = profiles or Profiles(Profile(None, command, output_file_extension))
+        self.event_log = event_log
         ConnectionManager.initialize_proxy(proxy)
         self.__create_table()
 
     @ConnectionManager.connection(transaction=True)
     def __create_table(self):
         MediaFile.create_table(True)
+        ConnectionManager.migrate_table(MediaFile)
 
     @ConnectionManager.connection
     def __len__(self):
         return MediaFile.select().count()
 
+    def __log_events(self, media_files, **data):
+        if self.event_log and media_files:
+            self.event_log.append_all('media_file', [dict(data, id=str(media_file.id), file_path=media_file.file_path,
+                                                          status=data.get('status', media_file.status.value))
+                                                     for media_file in media_files])
+
     @ConnectionManager.connection(transaction=True)
     def __delitem__(self, key):
+        media_file = self.__getitem__(key)
         if isinstance(key, tuple):
             MediaFile.delete().where(MediaFile.id == key[0]).where(MediaFile.file_path == key[1]).execute()
         else:
             MediaFile.delete().where((MediaFile.id == key) | (MediaFile.file_path == key)).execute()
+        if media_file:
+            self.__log_events([media_file], status='removed')
 
     @ConnectionManager.connection(transaction=True)
     def __setitem__(self, key, status):
@@ -38,44 +58,205 @@ class MediaFilesQueue(object):
 
             if status == MediaFileState.PROCESSING:
                 update_fields['date_started'] = now
-            elif status == MediaFileState.PROCESSED:
+                update_fields['processing_node'] = socket.gethostname()
+                update_fields['command_digest'] = self.profiles[self.__getitem__(key).profile].command_digest
+            elif status in (MediaFileState.PREFETCHING, MediaFileState.POST_PROCESSING):
+                update_fields['processing_node'] = socket.gethostname()
+            elif status in (MediaFileState.ENCODED, MediaFileState.PROCESSED):
                 transcoded_file_path = self.__getitem__(key).transcoded_file_path
+                # without post processing stages a media file goes from processing straight to processed
+                if status == MediaFileState.ENCODED or self.__getitem__(key).status == MediaFileState.PROCESSING:
+                    update_fields['date_encoded'] = now
                 try:
                     update_fields['transcoded_file_size'] = os.path.getsize(transcoded_file_path)
                 except OSError:
-                    logger.warn("Unable to obtain transcoded file size [{}]".format(transcoded_file_path))
-                update_fields['date_finished'] = now
+                    # post processing stages may have renamed or moved it, the size known after encoding is kept
+                    if status == MediaFileState.ENCODED or not self.__getitem__(key).transcoded_file_size:
+                        logger.warn("Unable to obtain transcoded file size [{}]".format(transcoded_file_path))
+                if status == MediaFileState.PROCESSED:
+                    update_fields['date_finished'] = now
             elif status == MediaFileState.FAILED:
                 update_fields['date_finished'] = now
             elif status == MediaFileState.WAITING:
                 update_fields['date_started'] = None
+                update_fields['date_encoded'] = None
                 update_fields['date_finished'] = None
                 update_fields['transcoded_file_size'] = None
+                update_fields['processing_node'] = None
+                update_fields['claim_token'] = None
+                update_fields['skip_reason'] = None
+                try:
+                    update_fields['file_size'] = os.path.getsize(self.__getitem__(key).file_path)
+                    update_fields['date_deleted'] = None
+                except OSError:
+                    pass
 
             if isinstance(key, tuple):
                 MediaFile.update(update_fields).where(
                     (MediaFile.id == key[0]) & (MediaFile.file_path == key[1])).execute()
             else:
                 MediaFile.update(update_fields).where(MediaFile.id == key).execute()
+            self.__log_events([self.__getitem__(key)])
+            if status in (MediaFileState.PROCESSED, MediaFileState.FAILED):
+                metrics.media_files_finished.inc(status=status.value)
         else:
             if isinstance(key, tuple):
-                file_directory = os.path.dirname(key[1])
-                file_name = os.path.splitext(os.path.basename(key[1]))[0]
-                transcoded_file = os.path.join(file_directory,
-                                               "{}_transcoded.{}".format(file_name, self.output_file_extension))
-                log_file = os.path.join(file_directory, "{}_transcoding.log".format(file_name))
-
-                MediaFile.create(id=key[0],
-                                 file_path=key[1],
-                                 transcoded_file_path=transcoded_file,
-                                 log_file_path=log_file,
-                                 status=status,
-                                 file_size=os.path.getsize(key[1]),
-                                 date_added=now,
-                                 last_modified=now)
+                self.__log_events([MediaFile.create(**self.__new_media_file_fields(key[0], key[1], status, now))])
             else:
                 raise Exception('media file doesn\'t exist, you must provide both id and file_path')
 
+    @ConnectionManager.connection(transaction=True)
+    def claim(self, media_file, status):
+        """Claims a media file for this node with a new claim token, set on `media_file`; only the holder of the
+        current token can change its state with `set_claimed`. Claiming a media file another node changed since it
+        was peeked raises MediaFileClaimLostError."""
+        current = self.__getitem__(media_file.id)
+        if not current or current.status != media_file.status \
+                or current.processing_node != media_file.processing_node:
+            metrics.claim_races.inc()
+            raise MediaFileClaimLostError('media file {} changed since it was peeked'.format(media_file.id))
+        claim_token = uuid4().hex
+        self.__setitem__((media_file.id, media_file.file_path), status)
+        MediaFile.update(claim_token=claim_token).where(MediaFile.id == media_file.id).execute()
+        media_file.claim_token = claim_token
+
+    @ConnectionManager.connection(transaction=True)
+    def set_claimed(self, media_file, status):
+        """Sets the state of a media file claimed by this node, unless its claim was taken over since, e.g. after
+        this node was reaped while stalled and another node claimed the media file again."""
+        current = self.__getitem__(media_file.id)
+        if not current or current.processing_node != socket.gethostname() \
+                or current.claim_token != media_file.claim_token:
+            raise MediaFileClaimLostError('media file {} is no longer claimed by this node'.format(media_file.id))
+        self.__setitem__(media_file.id, status)
+
+    def __get_output_files(self, file_path, profile_name=None):
+        file_directory = os.path.dirname(file_path)
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        transcoded_file = os.path.join(file_directory,
+                                       "{}_transcoded.{}".format(file_name,
+                                                                 self.profiles[profile_name].file_extension))
+        log_file = os.path.join(file_directory, "{}_transcoding.log".format(file_name))
+        return transcoded_file, log_file
+
+    def __new_media_file_fields(self, id, file_path, status, now, profile_name=None):
+        transcoded_file, log_file = self.__get_output_files(file_path, profile_name)
+        return {'id': id,
+                'file_path': file_path,
+                'transcoded_file_path': transcoded_file,
+                'log_file_path': log_file,
+                'status': status,
+                'file_size': os.path.getsize(file_path),
+                'date_added': now,
+                'last_modified': now}
+
+    @ConnectionManager.connection(transaction=True)
+    def add_all(self, file_paths, reprocess=False, media_info=None):
+        now = datetime.datetime.now()
+        existing_media_files = {}
+        transcoded_files = set()
+        for file_paths_chunk in chunked(file_paths, self.SQLITE_MAX_VARIABLES):
+            for media_file in MediaFile.select(MediaFile.id, MediaFile.file_path, MediaFile.status,
+                                               MediaFile.date_deleted) \
+                    .where(MediaFile.file_path << file_paths_chunk):
+                existing_media_files[media_file.file_path] = media_file
+            for media_file in MediaFile.select(MediaFile.transcoded_file_path) \
+                    .where(MediaFile.transcoded_file_path << file_paths_chunk):
+                transcoded_files.add(media_file.transcoded_file_path)
+
+        added_media_files = []
+        for file_path in file_paths:
+            media_file = existing_media_files.get(file_path)
+            if file_path in transcoded_files:
+                logger.debug("File [{}] is a transcoded media file, skipping it".format(file_path))
+            elif media_file:
+                if media_file.date_deleted or (reprocess and media_file.status == MediaFileState.PROCESSED):
+                    self.__setitem__((media_file.id, media_file.file_path), MediaFileState.WAITING)
+                    added_media_files.append(media_file)
+            else:
+                try:
+                    fields = self.__new_media_file_fields(uuid4(), file_path, MediaFileState.WAITING, now,
+                                                          media_info.get(file_path, {}).get('profile')
+                                                          if media_info else None)
+                    if media_info and file_path in media_info:
+                        fields.update(media_info[file_path])
+                        if fields.get('skip_reason'):
+                            fields['status'] = MediaFileState.SKIPPED
+                    added_media_files.append(MediaFile(**fields))
+                except OSError:
+                    logger.warn("Unable to obtain media file size [{}], skipping it".format(file_path))
+
+        # every row of a multi-row insert must have the same columns
+        rows = [{field.name: media_file.__data__.get(field.name) for field in MediaFile._meta.sorted_fields}
+                for media_file in added_media_files if media_file.file_path not in existing_media_files]
+        for rows_chunk in chunked(rows, self.SQLITE_MAX_VARIABLES // len(MediaFile._meta.sorted_fields)):
+            MediaFile.insert_many(rows_chunk).execute()
+        self.__log_events([media_file for media_file in added_media_files
+                           if media_file.file_path not in existing_media_files])
+        metrics.media_files_enqueued.inc(len(added_media_files))
+        return added_media_files
+
+    @ConnectionManager.connection
+    def get_new_file_paths(self, file_paths):
+        known_file_paths = set()
+        for file_paths_chunk in chunked(file_paths, self.SQLITE_MAX_VARIABLES):
+            known_file_paths.update(media_file.file_path for media_file in MediaFile.select(MediaFile.file_path)
+                                    .where(MediaFile.file_path << file_paths_chunk))
+            known_file_paths.update(media_file.transcoded_file_path for media_file in
+                                    MediaFile.select(MediaFile.transcoded_file_path)
+                                    .where(MediaFile.transcoded_file_path << file_paths_chunk))
+        return [file_path for file_path in file_paths if file_path not in known_file_paths]
+
+    @ConnectionManager.connection(transaction=True)
+    def move(self, src_path, dest_path):
+        now = datetime.datetime.now()
+        media_file = MediaFile.select().where(MediaFile.file_path == src_path).first()
+        if media_file:
+            update_fields = {'file_path': dest_path, 'last_modified': now, 'date_deleted': None}
+            if media_file.status in (MediaFileState.WAITING, MediaFileState.FAILED):
+                update_fields['transcoded_file_path'], update_fields['log_file_path'] = \
+                    self.__get_output_files(dest_path, media_file.profile)
+            dest_media_file = MediaFile.select().where(MediaFile.file_path == dest_path).first()
+            if dest_media_file and dest_media_file.status in (MediaFileState.PROCESSING, MediaFileState.PREFETCHING,
+                                                              MediaFileState.POST_PROCESSING):
+                # the media file being processed at the destination is kept, the moved one no longer exists
+                MediaFile.update(date_deleted=now, last_modified=now).where(MediaFile.id == media_file.id).execute()
+                self.__log_events([self.__getitem__(media_file.id)], deleted=True)
+                return True
+            if dest_media_file:
+                MediaFile.delete().where(MediaFile.id == dest_media_file.id).execute()
+                self.__log_events([dest_media_file], status='removed')
+            MediaFile.update(update_fields).where(MediaFile.id == media_file.id).execute()
+            self.__log_events([self.__getitem__(media_file.id)], moved_from=src_path)
+            return True
+        else:
+            return MediaFile.update(transcoded_file_path=dest_path, last_modified=now) \
+                       .where(MediaFile.transcoded_file_path == src_path).execute() > 0
+
+    @ConnectionManager.connection
+    def get_statuses(self):
+        return {str(media_file.id): media_file.status.value
+                for media_file in MediaFile.select(MediaFile.id, MediaFile.status)}
+
+    @ConnectionManager.connection
+    def find_processed_duplicate(self, media_file):
+        command_digest = self.profiles[media_file.profile].command_digest
+        if not media_file.fingerprint or not command_digest:
+            return None
+        return MediaFile.select().where((MediaFile.fingerprint == media_file.fingerprint) &
+                                        (MediaFile.command_digest == command_digest) &
+                                        (MediaFile.status == MediaFileState.PROCESSED) &
+                                        (MediaFile.id != media_file.id)).first()
+
+    @ConnectionManager.connection(transaction=True)
+    def mark_deleted(self, file_path):
+        now = datetime.datetime.now()
+        deleted = MediaFile.update(date_deleted=now, last_modified=now) \
+                      .where((MediaFile.file_path == file_path) & (MediaFile.date_deleted >> None)).execute() > 0
+        if deleted:
+            self.__log_events([self.__getitem__(file_path)], deleted=True)
+        return deleted
+
     @ConnectionManager.connection
     def __getitem__(self, key):
         if isinstance(key, tuple):
@@ -129,15 +310,34 @@ class MediaFilesQueue(object):
         return result
 
     @ConnectionManager.connection
-    def peek(self, status=None):
-        if status:
-            result = MediaFile.select().where(MediaFile.status == status).first()
-        else:
-            result = MediaFile.select().first()
+    def peek(self, status=None, profile_names=None):
+        result = self.__select(status, profile_names).first()
         if not result:
             raise Exception('no media file found')
         return result
 
+    @ConnectionManager.connection
+    def peek_many(self, limit, status=None, profile_names=None, max_file_size=None):
+        query = self.__select(status, profile_names)
+        if max_file_size is not None:
+            query = query.where(MediaFile.file_size <= max_file_size)
+        return list(query.limit(limit))
+
+    def __select(self, status=None, profile_names=None):
+        query = MediaFile.select().where(MediaFile.date_deleted >> None)
+        if status:
+            query = query.where(MediaFile.status == status)
+        if profile_names is not None:
+            named_profiles = [name for name in profile_names if name is not None]
+            if None in profile_names:
+                # media files of profiles removed since they were added are processed with the default profile
+                known_profiles = [profile.name for profile in self.profiles]
+                query = query.where((MediaFile.profile << named_profiles) | (MediaFile.profile >> None) |
+                                    ~(MediaFile.profile << known_profiles))
+            else:
+                query = query.where(MediaFile.profile << named_profiles)
+        return query
+
     @ConnectionManager.connection(transaction=True)
     def touch(self, key):
         if self.__contains__(key):
@@ -151,6 +351,34 @@ class MediaFilesQueue(object):
         else:
             raise Exception('no media file found')
 
+    @ConnectionManager.connection(transaction=True)
+    def requeue_orphaned(self, hostnames):
+        now = datetime.datetime.now()
+        orphaned_media_files = list(MediaFile.select().where(
+            (MediaFile.status << [MediaFileState.PROCESSING, MediaFileState.PREFETCHING,
+                                  MediaFileState.POST_PROCESSING]) &
+            (MediaFile.processing_node << hostnames))) if self.event_log else []
+        self.__log_events([media_file for media_file in orphaned_media_files
+                           if media_file.status != MediaFileState.POST_PROCESSING],
+                          status=MediaFileState.WAITING.value)
+        self.__log_events([media_file for media_file in orphaned_media_files
+                           if media_file.status == MediaFileState.POST_PROCESSING],
+                          status=MediaFileState.ENCODED.value)
+        return MediaFile.update(status=MediaFileState.WAITING,
+                                last_modified=now,
+                                date_started=None,
+                                processing_node=None,
+                                claim_token=None) \
+            .where((MediaFile.status << [MediaFileState.PROCESSING, MediaFileState.PREFETCHING]) &
+                   (MediaFile.processing_node << hostnames)) \
+            .execute() + \
+            MediaFile.update(status=MediaFileState.ENCODED,
+                             last_modified=now,
+                             processing_node=None,
+                             claim_token=None) \
+            .where((MediaFile.status == MediaFileState.POST_PROCESSING) & (MediaFile.processing_node << hostnames)) \
+            .execute()
+
     @ConnectionManager.connection(transaction=True)
     def clear(self, safe=True):
         if safe:
@@ -0,0 +1,113 @@
+import socket
+import threading
+import time
+
+from lib.connection_manager import ConnectionManager
+from lib.exceptions import MediaFileClaimLostError
+from lib.media_file_state import MediaFileState
+from lib import logger
+from lib import tracing
+
+
+class Prefetcher(object):
+    """Claims the next media file while the current one is processed and stages it in the background, so the next
+    processing command starts right away instead of waiting for its input to be copied.
+
+    The lock only guards the prefetched media file, the staging thread is joined without it."""
+
+    def __init__(self, mfq, staging_area, progress, budget):
+        self.mfq = mfq
+        self.staging_area = staging_area
+        self.progress = progress
+        self.budget = budget
+        self.media_file = None
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+
+    def is_active(self):
+        return self.media_file is not None
+
+    def on_progress(self, progress, max_cost=None):
+        if progress is not None and progress >= self.progress:
+            self.prefetch(max_cost)
+
+    def prefetch(self, max_cost=None):
+        with self.lock:
+            if self.media_file is None:
+                self.media_file = self.__claim(max_cost)
+                if self.media_file is not None:
+                    logger.info("Prefetching file [{}]".format(self.media_file.identifier))
+                    self.cancelled = threading.Event()
+                    self.thread = threading.Thread(target=self.__stage_in, args=(self.media_file, self.cancelled),
+                                                   name=Prefetcher.__module__)
+                    self.thread.setDaemon(True)
+                    self.thread.start()
+
+    def take(self, max_cost=None):
+        with self.lock:
+            media_file, thread = self.media_file, self.thread
+            if media_file is None:
+                return None
+            if max_cost is not None and self.mfq.profiles[media_file.profile].cost > max_cost:
+                # left for a thread with room for it
+                return None
+            self.media_file = None
+        thread.join()
+        return media_file
+
+    def cancel(self):
+        """Stops staging the prefetched media file, it stays claimed until released."""
+        self.cancelled.set()
+
+    def release(self):
+        with self.lock:
+            media_file, thread, cancelled = self.media_file, self.thread, self.cancelled
+            if media_file is None:
+                return
+            self.media_file = None
+        cancelled.set()
+        thread.join()
+        try:
+            self.staging_area.release(media_file)
+            self.__unclaim(media_file)
+            logger.info("Prefetched file [{}] returned to processing queue, status [{}]".format(
+                media_file.identifier, MediaFileState.WAITING.value))
+        except Exception:
+            logger.exception("Unable to release prefetched file [{}]".format(media_file.identifier))
+
+    def __stage_in(self, media_file, cancelled):
+        try:
+            with tracing.span('stage_in', media_file, prefetch=True):
+                self.staging_area.stage_in(media_file, cancelled)
+            logger.debug("File [{}] prefetched".format(media_file.identifier))
+        except Exception:
+            if not cancelled.is_set():
+                # the file is staged again when it's processed
+                logger.exception("Unable to prefetch file [{}]".format(media_file.identifier))
+
+    @ConnectionManager.connection(transaction=True)
+    def __claim(self, max_cost=None):
+        claim_started = time.time()
+        try:
+            media_file = self.mfq.peek(MediaFileState.WAITING, self.mfq.profiles.get_names(max_cost))
+        except Exception:
+            return None
+        if media_file.file_size > min(self.budget, self.staging_area.get_free_space()):
+            logger.debug("File [{}] doesn't fit the prefetch budget".format(media_file.identifier))
+            return None
+        try:
+            self.mfq.claim(media_file, MediaFileState.PREFETCHING)
+        except MediaFileClaimLostError:
+            return None
+        tracing.record('queue_wait', media_file, tracing.to_timestamp(media_file.last_modified), claim_started,
+                       prefetch=True)
+        tracing.record('claim', media_file, claim_started, time.time(), prefetch=True)
+        return media_file
+
+    @ConnectionManager.connection(transaction=True)
+    def __unclaim(self, media_file):
+        current = self.mfq[media_file.id]
+        if current and current.status == MediaFileState.PREFETCHING and \
+                current.processing_node == socket.gethostname() and current.claim_token == media_file.claim_token:
+            self.mfq[media_file.id] = MediaFileState.WAITING
@@ -0,0 +1,85 @@
+import json
+import os
+
+from lib.fingerprint import get_command_digest
+from lib.media_prober import MediaRule
+from lib.path_matcher import PathMatcher
+
+
+class Profile(object):
+    """How media files are processed: the processing command, the output file extension and the expected cost of
+    processing a file relative to the other profiles(1 being a full encode slot)."""
+
+    def __init__(self, name, command, file_extension, cost=1.0, watch_directory=None, patterns=None, rules=None,
+                 case_sensitive=True):
+        self.name = name
+        self.command = command
+        self.file_extension = file_extension
+        self.cost = float(cost)
+        self.watch_directory = os.path.join(os.path.abspath(os.path.expanduser(watch_directory)), '') \
+            if watch_directory else None
+        self.matcher = PathMatcher(patterns, None, case_sensitive) if patterns else None
+        self.rules = [MediaRule(rule) for rule in rules or []]
+        self.command_digest = get_command_digest(command, file_extension) if command else None
+
+    def __repr__(self):
+        return self.name or 'default'
+
+    def matches(self, file_path, media_info):
+        return (not self.watch_directory or os.path.abspath(file_path).startswith(self.watch_directory)) \
+               and (not self.matcher or self.matcher.match(file_path)) \
+               and (not self.rules or any(rule.matches(media_info) for rule in self.rules))
+
+
+class Profiles(object):
+    """Profiles matched in order against media files, the first matching one is used; media files matching none of
+    them are processed with the default profile, stored without a name, and so are media files of a profile that no
+    longer exists."""
+
+    def __init__(self, default_profile, profiles=None):
+        self.default_profile = default_profile
+        self.profiles = profiles or []
+        self.profiles_by_name = {profile.name: profile for profile in self.profiles}
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def __iter__(self):
+        return iter(self.profiles)
+
+    def __getitem__(self, name):
+        return self.profiles_by_name.get(name, self.default_profile) if name else self.default_profile
+
+    def match(self, file_path, media_info):
+        for profile in self.profiles:
+            if profile.matches(file_path, media_info):
+                return profile
+        return self.default_profile
+
+    def get_names(self, max_cost=None):
+        return [profile.name for profile in [self.default_profile] + self.profiles
+                if max_cost is None or profile.cost <= max_cost]
+
+
+def load_profiles(profiles_file, default_command, default_file_extension, case_sensitive=True):
+    default_profile = Profile(None, default_command, default_file_extension)
+    if not profiles_file:
+        return Profiles(default_profile)
+
+    with open(os.path.expanduser(profiles_file)) as f:
+        definitions = json.load(f)
+    profiles = []
+    for definition in definitions:
+        if not definition.get('name') or not definition.get('command'):
+            raise ValueError('profile {} must have a name and a command'.format(definition))
+        profiles.append(Profile(definition['name'],
+                                definition['command'],
+                                definition.get('file_extension', default_file_extension),
+                                definition.get('cost', 1.0),
+                                definition.get('watch_directory'),
+                                definition.get('patterns'),
+                                definition.get('rules'),
+                                case_sensitive))
+    if len(set(profile.name for profile in profiles)) != len(profiles):
+        raise ValueError('profile names must be unique')
+    return Profiles(default_profile, profiles)
@@ -0,0 +1,59 @@
+import functools
+import hashlib
+import threading
+import time
+
+from flask import request, Response
+
+from lib.connection_manager import ConnectionManager
+
+
+class ResponseCache(object):
+    """Caches GET responses by endpoint and arguments until the database changes.
+
+    Responses carry an ETag so polling clients are answered with 304 while nothing changed. Humanized values
+    depend on the current time too, so responses are also refreshed every `max_age` seconds.
+    """
+
+    def __init__(self, get_data_version, max_age=60, max_entries=256):
+        self.get_data_version = get_data_version
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.version = None
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            version = (self.get_data_version(), int(time.time() // self.max_age))
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            etag = hashlib.sha1(repr((version, key))).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            with self.lock:
+                if self.version != version:
+                    self.version = version
+                    self.responses = {}
+                cached = self.responses.get(key)
+            if cached is None:
+                result = func(*args, **kwargs)
+                data, code = result if isinstance(result, tuple) else (result, 200)
+                if code != 200:
+                    return result
+                cached = data
+                with self.lock:
+                    if self.version == version:
+                        if len(self.responses) >= self.max_entries:
+                            self.responses = {}
+                        self.responses[key] = cached
+            return cached, 200, {'ETag': '"{}"'.format(etag)}
+
+        return wrapper
+
+
+response_cache = ResponseCache(ConnectionManager.get_data_version)
@@ -1,9 +1,15 @@
+import time
+
 from lib import logger
-from flask import Flask, Blueprint
+from lib import metrics
+from flask import Flask, Blueprint, Response, g, request
 from flask_restplus import Api
 
 from lib.JSONEncoder import JSONEncoder
+from lib.event_stream import EventStream
 from lib.flask_thread import FlaskAppWrapper
+from lib.namespaces import database
+from lib.namespaces import events
 from lib.namespaces import nodes
 from lib.namespaces import queue
 
@@ -15,16 +21,54 @@ blueprint = Blueprint('api', __name__)
 api = Api(blueprint, version='0.0.1', title='Handbreak auto processing tool API')
 api.add_namespace(queue.api)
 api.add_namespace(nodes.api)
+api.add_namespace(events.api)
+api.add_namespace(database.api)
 app.register_blueprint(blueprint)
 
 
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.expose(), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+
+
+@app.after_request
+def observe_request_latency(response):
+    if 'request_started' in g:
+        metrics.rest_request_seconds.observe(time.time() - g.request_started,
+                                             method=request.method,
+                                             endpoint=request.url_rule.rule if request.url_rule else 'unknown',
+                                             code=response.status_code)
+    return response
+
+
 class RestApi(object):
 
-    def __init__(self, media_processing, node_inventory):
+    def __init__(self, media_processing, node_inventory, host='0.0.0.0', port=6767, threads=8, request_timeout=30):
         queue.mp = media_processing
         nodes.ni = node_inventory
-        self.flask_process = FlaskAppWrapper(app)
+        # event stream clients hold a request thread each, at least half of them are left for the other requests
+        self.event_stream = EventStream(media_processing.mfq.event_log, max_subscribers=threads // 2,
+                                        name=EventStream.__module__)
+        events.es = self.event_stream
+        events.mp = media_processing
+        queue_depth = metrics.QueueDepth(media_processing.mfq.get_statuses())
+        self.event_stream.add_listener(queue_depth.update)
+        self.event_stream.add_reset_listener(lambda: queue_depth.reset(media_processing.mfq.get_statuses()))
+        self.event_stream.start()
+        metrics.queue_media_files.set_function(queue_depth.get_counts)
+        metrics.encode_slots_active.set_function(lambda: len(media_processing.encode_pool.running()))
+        metrics.post_slots_active.set_function(lambda: len(media_processing.post_pool.running()))
+        metrics.encode_fps.set_function(lambda: {(thread.slot,): thread.fps
+                                                 for thread in media_processing.encode_pool.running()
+                                                 if thread.fps is not None})
+        self.flask_process = FlaskAppWrapper(app, host, port, threads, request_timeout)
         self.flask_process.start()
 
     def stop(self):
+        self.event_stream.stop()
         self.flask_process.join()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import socket
+
+from lib import logger
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def copy_file(src_path, dest_path, cancelled=None):
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        if hasattr(os, 'sendfile'):
+            offset = 0
+            size = os.fstat(src.fileno()).st_size
+            while offset < size:
+                _check_cancelled(src_path, cancelled)
+                sent = os.sendfile(dest.fileno(), src.fileno(), offset, COPY_BUFFER_SIZE)
+                if sent == 0:
+                    break
+                offset += sent
+        else:
+            while True:
+                _check_cancelled(src_path, cancelled)
+                buffer = src.read(COPY_BUFFER_SIZE)
+                if not buffer:
+                    break
+                dest.write(buffer)
+        dest.flush()
+        os.fsync(dest.fileno())
+    shutil.copystat(src_path, dest_path)
+
+
+def _check_cancelled(src_path, cancelled):
+    if cancelled and cancelled.is_set():
+        raise Exception('copying of [{}] cancelled'.format(src_path))
+
+
+def move_file(src_path, dest_path):
+    """Moves a file so it appears at the destination at once: a rename on the same file system, otherwise a copy to
+    a hidden temporary file next to the destination renamed over it."""
+    dest_directory = os.path.dirname(dest_path)
+    if os.stat(src_path).st_dev == os.stat(dest_directory).st_dev:
+        os.rename(src_path, dest_path)
+    else:
+        temp_path = os.path.join(dest_directory, '.{}.staging'.format(os.path.basename(dest_path)))
+        try:
+            copy_file(src_path, temp_path)
+            os.rename(temp_path, dest_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.remove(src_path)
+
+
+def link_file(src_path, dest_path):
+    """Hard links a file, or copies it where links are not possible(another file system or no link support)."""
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        temp_path = os.path.join(os.path.dirname(dest_path), '.{}.staging'.format(os.path.basename(dest_path)))
+        try:
+            copy_file(src_path, temp_path)
+            os.rename(temp_path, dest_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class StagingArea(object):
+    """Local scratch space(SSD or tmpfs) media files are copied to before processing, so the processing command
+    does sequential local I/O instead of random I/O over a network share."""
+
+    def __init__(self, scratch_directory):
+        self.directory = os.path.join(scratch_directory, 'handbreak-auto-processing-{}'.format(socket.gethostname()))
+        if os.path.exists(self.directory):
+            # anything left here belongs to media files already returned to the processing queue
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+    def get_free_space(self):
+        stat = os.statvfs(self.directory)
+        return stat.f_bavail * stat.f_frsize
+
+    def get_paths(self, media_file):
+        job_directory = os.path.join(self.directory, str(media_file.id))
+        return (os.path.join(job_directory, os.path.basename(media_file.file_path)),
+                os.path.join(job_directory, os.path.basename(media_file.transcoded_file_path)))
+
+    def stage_in(self, media_file, cancelled=None):
+        input_path, output_path = self.get_paths(media_file)
+        if os.path.exists(input_path):
+            return input_path, output_path
+
+        job_directory = os.path.dirname(input_path)
+        if not os.path.exists(job_directory):
+            os.mkdir(job_directory)
+        if os.stat(media_file.file_path).st_dev == os.stat(job_directory).st_dev:
+            os.link(media_file.file_path, input_path)
+        else:
+            file_size = os.path.getsize(media_file.file_path)
+            if file_size > self.get_free_space():
+                raise Exception('not enough scratch space to stage [{}] of [{}] bytes'.format(
+                    media_file.file_path, file_size))
+            logger.debug("Staging [{}] in [{}]".format(media_file.file_path, input_path))
+            temp_path = input_path + '.partial'
+            copy_file(media_file.file_path, temp_path, cancelled)
+            os.rename(temp_path, input_path)
+        return input_path, output_path
+
+    def stage_out(self, media_file):
+        output_path = self.get_paths(media_file)[1]
+        logger.debug("Moving [{}] to [{}]".format(output_path, media_file.transcoded_file_path))
+        move_file(output_path, media_file.transcoded_file_path)
+
+    def release(self, media_file):
+        job_directory = os.path.join(self.directory, str(media_file.id))
+        if os.path.exists(job_directory):
+            shutil.rmtree(job_directory)
@@ -0,0 +1,65 @@
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """Writes the timeline of every media file as spans, one JSON line each, sharing the media file id as trace id.
+
+    Span fields follow the OpenTelemetry(OTLP JSON) naming so the file can be loaded without a collector. Nothing
+    is recorded until a trace file is configured.
+    """
+
+    def __init__(self):
+        self.trace_file = None
+        self.hostname = socket.gethostname()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def to_timestamp(date):
+        return time.mktime(date.timetuple()) + date.microsecond / 1e6
+
+    def configure(self, trace_file):
+        self.trace_file = open(trace_file, 'a', 1) if trace_file else None
+
+    @contextmanager
+    def span(self, name, media_file, **attributes):
+        if not self.trace_file:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        except BaseException as e:
+            attributes['error'] = type(e).__name__
+            self.record(name, media_file, start, time.time(), 'error', **attributes)
+            raise
+        self.record(name, media_file, start, time.time(), **attributes)
+
+    def record(self, name, media_file, start, end, status='ok', **attributes):
+        if not self.trace_file:
+            return
+        attributes['node'] = self.hostname
+        attributes['file_path'] = media_file.file_path
+        span = {
+            'trace_id': media_file.id.hex,
+            'span_id': os.urandom(8).encode('hex'),
+            'name': name,
+            'start_time_unix_nano': int(start * 1e9),
+            'end_time_unix_nano': int(end * 1e9),
+            'status': status,
+            'attributes': {key: value for key, value in attributes.items() if value is not None}
+        }
+        line = json.dumps(span) + '\n'
+        with self.lock:
+            self.trace_file.write(line)
+
+
+tracer = Tracer()
+configure = tracer.configure
+span = tracer.span
+record = tracer.record
+to_timestamp = Tracer.to_timestamp
@@ -1,6 +1,8 @@
 import collections
 import logging
+import os
 import sys
+import tempfile
 
 FORMATTER = logging.Formatter('[%(asctime)-15s] [%(threadName)s] [%(levelname)s]: %(message)s')
 
@@ -25,6 +27,18 @@ def compare_list(first, second):
     return collections.Counter(first) == collections.Counter(second)
 
 
+def is_filesystem_case_sensitive(directory):
+    directory = os.path.abspath(directory)
+    name = os.path.basename(directory)
+    if name.lower() != name.upper():
+        swapped_case_directory = os.path.join(os.path.dirname(directory), name.swapcase())
+        return not (os.path.exists(swapped_case_directory) and os.path.samefile(directory, swapped_case_directory))
+
+    with tempfile.NamedTemporaryFile(prefix='CaseProbe', dir=directory) as probe_file:
+        probe_path = os.path.join(directory, os.path.basename(probe_file.name).swapcase())
+        return not os.path.exists(probe_path)
+
+
 def configure_logging(log_file_name, max_log_size, max_log_file_to_keep, log_level, external_libs_logging_level):
     syslog_handler = logging.StreamHandler(sys.stdout)
     file_handler = logging.handlers.RotatingFileHandler(filename=log_file_name,
@@ -36,11 +50,18 @@ def configure_logging(log_file_name, max_log_size, max_log_file_to_keep, log_lev
 
     for logger_name, logger in logging.Logger.manager.loggerDict.items():
         logger.handlers = [syslog_handler, file_handler]
+        logger.propagate = False
         if logger_name == '__main__' or logger_name == 'lib':
             logger.level = log_level
         else:
             logger.level = external_libs_logging_level
 
+    # libraries imported lazily after this point log through the root logger
+    root_logger = logging.getLogger()
+    root_logger.handlers = [syslog_handler, file_handler]
+    root_logger.level = external_libs_logging_level
+
     werkzeug_logger = logging.getLogger('werkzeug')
     werkzeug_logger.handlers = [syslog_handler, file_handler]
+    werkzeug_logger.propagate = False
     werkzeug_logger.level = logging.ERROR if external_libs_logging_level == logging.INFO else logging.DEBUG
@@ -0,0 +1,37 @@
+import time
+
+
+class WorkerPool(object):
+    """Fixed number of slots, each running one processing thread at a time.
+
+    A slot whose thread found nothing to process is left idle for a while before it looks for work again. A slot
+    stays empty while `create_thread` returns None.
+    """
+
+    def __init__(self, name, size, create_thread):
+        self.name = name
+        self.threads = [None] * size
+        self.next_start = [0] * size
+        self.create_thread = create_thread
+
+    def __len__(self):
+        return len(self.threads)
+
+    def running(self):
+        return [thread for thread in self.threads if thread is not None and thread.isAlive()]
+
+    def fill(self, idle_timeout):
+        now = time.time()
+        for slot, thread in enumerate(self.threads):
+            if thread is not None and not thread.isAlive():
+                self.threads[slot] = None
+                if thread.idle:
+                    self.next_start[slot] = now + idle_timeout
+            if self.threads[slot] is None and now >= self.next_start[slot]:
+                self.threads[slot] = self.create_thread('{}-{}'.format(self.name, slot))
+                if self.threads[slot] is not None:
+                    self.threads[slot].start()
+
+    def join(self):
+        for thread in self.running():
+            thread.join()